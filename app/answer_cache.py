@@ -0,0 +1,106 @@
+import json
+import hashlib
+import threading
+import numpy as np
+
+from app.cache import LRUCache
+
+
+def _digest(value) -> str:
+    data = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    LLM 回覆的兩層快取，兩層都有 LRU / TTL 淘汰：
+    - exact:    以 (模型, 生成參數, 含 context 的 system prompt, 問題) 為鍵，完全相同才命中
+    - semantic: 問題向量與快取中的問題 cosine 相似度達 threshold 即命中，
+                只比對範圍 (scope：模型、推理開關、限定文件) 相同的問題
+    generation 為 (索引版本, configs 雜湊)，任何一個改變時清空全部快取
+    """
+
+    def __init__(self, max_entries=1000, ttl_seconds=86400, threshold=0.95):
+        self.exact = LRUCache(max_entries, ttl_seconds)
+        self.semantic = LRUCache(max_entries, ttl_seconds)
+        self.threshold = threshold
+        self.generation = None
+        self._lock = threading.Lock()
+
+    def configure(self, max_entries, ttl_seconds, threshold):
+        self.exact.configure(max_entries, ttl_seconds)
+        self.semantic.configure(max_entries, ttl_seconds)
+        self.threshold = threshold
+
+    def ensure_generation(self, generation):
+        with self._lock:
+            if generation == self.generation:
+                return
+            if self.generation is not None:
+                print("[DEBUG] 索引或配置已變更，清空回覆快取", flush=True)
+            self.exact.clear()
+            self.semantic.clear()
+            self.generation = generation
+
+    @staticmethod
+    def exact_key(model, options, system_prompt, question, think):
+        return _digest([model, options, system_prompt, question, bool(think)])
+
+    def get_exact(self, key):
+        return self.exact.get(key)
+
+    def find_similar(self, scope, vector):
+        """回傳 (快取的回覆, 相似度)，沒有達到門檻的問題時回傳 (None, 最高相似度)"""
+        scope_key = _digest(scope)
+        candidates = [
+            (key, item)
+            for key, item in self.semantic.items()
+            if item["scope"] == scope_key
+        ]
+        if not candidates:
+            self.semantic.misses += 1
+            return None, 0.0
+        matrix = np.vstack([item["vector"] for _, item in candidates])
+        similarities = matrix @ _normalize(vector)
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity < self.threshold:
+            self.semantic.misses += 1
+            return None, similarity
+        # 經由 get 更新 LRU 順序與命中統計
+        item = self.semantic.get(candidates[best][0])
+        if item is None:
+            return None, similarity
+        return item["answer"], similarity
+
+    def put(self, exact_key, scope, question, vector, answer):
+        """answer: {prompt, content, thinking, full_answer}"""
+        self.exact.put(exact_key, answer)
+        if vector is not None:
+            scope_key = _digest(scope)
+            self.semantic.put(
+                _digest([scope_key, question]),
+                {"scope": scope_key, "vector": _normalize(vector), "answer": answer},
+            )
+
+    def clear(self):
+        self.exact.clear()
+        self.semantic.clear()
+
+    def stats(self):
+        return {
+            "exact": self.exact.stats(),
+            "semantic": self.semantic.stats(),
+            "threshold": self.threshold,
+        }
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype="float32").reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def config_signature(config) -> str:
+    """configs 的雜湊，任何設定變更都會改變"""
+    return _digest(config)
@@ -9,6 +9,8 @@ import ollama
 import faiss
 import urllib.parse
 import time
+import threading
+import unicodedata
 
 from typing import Optional, List
 
@@ -31,16 +33,79 @@ from fastapi.responses import (
     RedirectResponse,
 )
 
-from pydantic import BaseModel
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from pydantic import BaseModel, Field
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 from typing import Optional, List, Dict, Any
 from dotenv import load_dotenv
 
 # 匯入整個模組
-from app.model_docling import convert_file_via_docling
-from app.dao import config_dao, conversation_dao, user_dao, llm_request_dao
+from app.model_docling import (
+    convert_files,
+    get_conversion_manifest,
+    summarize_conversion_timing,
+)
+from app.vector_index import (
+    create_index,
+    apply_search_params,
+    describe_index,
+    ensure_id_map,
+    remove_vectors,
+    remap_ids,
+    reconstruct_vectors,
+    index_memory_bytes,
+    storage_report,
+    search_index,
+    l2_to_cosine,
+    index_needs_training,
+    train_sample_size,
+)
+from app.chunk_store import ChunkStore
+from app.snapshot import (
+    IndexSnapshot,
+    IndexWriteLock,
+    read_current_version,
+    current_mtime,
+    read_index_file,
+    load_snapshot,
+    load_sparse_index,
+    load_passage_tokens,
+    write_snapshot,
+    cleanup_snapshots,
+    remove_all_snapshots,
+)
+from app.embedding_cache import EmbeddingCache, content_hash
+from app.embedding_engine import (
+    EmbeddingEngine,
+    embedding_throughput,
+    normalize_rows,
+)
+from app.sparse_index import reciprocal_rank_fusion, RRF_K
+from app.answer_cache import AnswerCache, config_signature
+from app.cache import LRUCache
+from app.reranker import RerankBatcher, load_reranker
+from app.index_jobs import (
+    IndexJobWorker,
+    JobCancelled,
+    JOB_TYPE_FILES,
+    JOB_TYPE_REBUILD,
+    JOB_TYPE_REMOVE,
+    JOB_TYPE_COMPACT,
+    STAGE_CONVERT,
+    STAGE_CHUNK,
+    STAGE_EMBED,
+    STAGE_ADD,
+    STAGE_DONE,
+    STAGE_FAILED,
+    STAGE_QUEUED,
+    format_job,
+)
+from app.dao import (
+    config_dao,
+    conversation_dao,
+    user_dao,
+    llm_request_dao,
+    index_job_dao,
+)
 from app.auth import (
     auth_manager,
     require_admin,
@@ -68,17 +133,39 @@ DOC_PATH = os.path.join(os.path.dirname(BASE_DIR), "documents")
 MD_PATH = os.path.join(DOC_PATH, "markdown")
 # /backend/faiss_data
 FAISS_DIR = os.getenv("FAISS_DIR")
+# 舊版直接放在 FAISS_DIR 的 index 與 chunk，僅在尚未有 snapshot 時讀取
 TEXTS_PATH = os.path.join(FAISS_DIR, "texts.json")
+CHUNKS_PATH = os.path.join(FAISS_DIR, "chunks")
 INDEX_PATH = os.path.join(FAISS_DIR, "faiss.index")
+EMBEDDING_CACHE_PATH = os.path.join(FAISS_DIR, "embedding_cache.sqlite3")
+# 索引工作計算向量時每批的 chunk 數量（回報進度與檢查取消的間隔）
+EMBED_PROGRESS_BATCH = 64
+# /retrieve 一次最多可送出的查詢數量
+RETRIEVE_MAX_QUERIES = 32
 
 
 config = {}
 embedding_model = None
 current_embedding_model = None
-index = None
-texts = []
-reranker_tokenizer = None
-reranker_model = None
+# LLM 回覆快取（每個 worker 各自一份）
+answer_cache = None
+embedding_cache = None
+# 查詢向量快取，key 為 (模型名稱, 正規化後的查詢字串)
+query_embedding_cache = LRUCache(10000)
+# 目前提供查詢的索引版本，更新時整個物件一次換上
+snapshot = IndexSnapshot()
+snapshot_mtime = None
+# 同一時間只允許一個索引更新
+index_write_lock = IndexWriteLock(FAISS_DIR)
+# 背景執行索引工作的 worker
+index_job_worker = None
+reranker = None
+current_reranker_backend = None
+reranker_load_lock = threading.Lock()
+# reranker 分數快取，key 為 (模型, 後端, 正規化後的問題, chunk 內容雜湊)
+rerank_score_cache = LRUCache(50000)
+# 跨請求合併 reranker 推理的批次器
+rerank_batcher = None
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 OLLAMA_HOST = os.getenv("OLLAMA_API_HOST", "http://localhost:11434")
@@ -111,6 +198,19 @@ class QueryTo(BaseModel):
     keyword: Optional[str] = ""
     conv_id: Optional[str] = ""
     think: Optional[bool] = False
+    # 只從指定的文件中尋找答案（符合任一 source_file 或 markdown_file），未指定時搜尋全部文件
+    source_files: Optional[List[str]] = None
+    markdown_files: Optional[List[str]] = None
+
+
+class RetrieveRequest(BaseModel):
+    queries: List[str]
+    # 合併所有查詢的候選後，以 rerank_query 重新排序（預設為第一個查詢）
+    merge: Optional[bool] = True
+    rerank_query: Optional[str] = None
+    top_k: Optional[int] = Field(None, ge=1)
+    source_files: Optional[List[str]] = None
+    markdown_files: Optional[List[str]] = None
 
 
 class AdminUserUpdate(BaseModel):
@@ -381,6 +481,7 @@ def on_startup():
     load_existing_index()
     #load_embedding_model()
     load_reranker_model()
+    start_index_job_worker()
 
 
 def load_config():
@@ -396,11 +497,54 @@ def ensure_faiss_dir_exists():
     os.makedirs(os.path.join(BASE_DIR, "faiss_data"), exist_ok=True)
 
 
+def is_mmap_mode():
+    return str(config.get("index_mmap", "False")).lower() == "true"
+
+
 def load_existing_index():
-    global index
-    if os.path.exists(INDEX_PATH):
-        index = faiss.read_index(INDEX_PATH)
-        load_text_chunks()
+    """載入 CURRENT 指向的 snapshot，尚未有 snapshot 時讀取舊版的 faiss.index"""
+    global snapshot, snapshot_mtime
+    version = read_current_version(FAISS_DIR)
+    if version:
+        mtime = current_mtime(FAISS_DIR)
+        new_snapshot = load_snapshot(FAISS_DIR, version, is_mmap_mode())
+    elif os.path.exists(INDEX_PATH):
+        mtime = None
+        new_snapshot = load_legacy_snapshot()
+    else:
+        return
+    apply_search_params(new_snapshot.index, config)
+    snapshot = new_snapshot
+    snapshot_mtime = mtime
+    print(
+        f"[DEBUG] 已載入索引 {snapshot.version} (mmap={snapshot.is_mmap})，"
+        f"共 {snapshot.index.ntotal} 筆向量",
+        flush=True,
+    )
+
+
+def load_legacy_snapshot():
+    use_mmap = is_mmap_mode()
+    index = read_index_file(INDEX_PATH, use_mmap)
+    texts = []
+    if os.path.exists(CHUNKS_PATH):
+        texts = ChunkStore(CHUNKS_PATH, use_mmap=use_mmap)
+    elif os.path.exists(TEXTS_PATH):
+        with open(TEXTS_PATH, "r", encoding="utf-8") as f:
+            texts = json.load(f)
+    return IndexSnapshot(
+        "legacy", index, texts, is_mmap=use_mmap, index_path=INDEX_PATH
+    )
+
+
+def sync_snapshot():
+    """其他 worker 發佈新版本時（CURRENT 已變更），改用新版本"""
+    mtime = current_mtime(FAISS_DIR)
+    if mtime is not None and mtime != snapshot_mtime:
+        try:
+            load_existing_index()
+        except Exception as e:
+            print(f"[ERROR] 載入新版本索引失敗: {e}", flush=True)
 
 
 def load_embedding_model():
@@ -415,18 +559,33 @@ def load_embedding_model():
 
 
 def load_reranker_model():
-    global reranker_tokenizer, reranker_model  # ✅ 宣告使用全域變數
-
-    print("[DEBUG] 正在載入 BGE Reranker 模型...", flush=True)
-    reranker_tokenizer = AutoTokenizer.from_pretrained("BAAI/bge-reranker-v2-m3")
-    reranker_model = AutoModelForSequenceClassification.from_pretrained(
-        "BAAI/bge-reranker-v2-m3"
-    )
-    reranker_model.to(device)
-    reranker_model.eval()
+    global reranker, rerank_batcher, current_reranker_backend  # ✅ 宣告使用全域變數
+
+    backend = config.get("reranker_backend", "torch")
+    print(f"[DEBUG] 正在載入 BGE Reranker 模型 ({backend})...", flush=True)
+    reranker = load_reranker(backend, device)
+    current_reranker_backend = backend
+    # 換模型或後端後舊的分數已不適用
+    rerank_score_cache.clear()
+    if rerank_batcher is None:
+        rerank_batcher = RerankBatcher(
+            lambda pairs: reranker.score(pairs),
+            int(config.get("rerank_max_batch_size", 64)),
+            float(config.get("rerank_max_wait_ms", 5)),
+        )
     print("[DEBUG] BGE Reranker 模型載入完成", flush=True)
 
 
+def get_reranker():
+    # reranker_backend 變更時重新載入
+    with reranker_load_lock:
+        if reranker is None or current_reranker_backend != config.get(
+            "reranker_backend", "torch"
+        ):
+            load_reranker_model()
+    return reranker
+
+
 def get_embedding_model():
     global embedding_model, current_embedding_model
     requested_model_name = config["embedding_model"]
@@ -435,36 +594,339 @@ def get_embedding_model():
         print(
             f"[DEBUG] 需要載入新的 embedding 模型: {requested_model_name}", flush=True
         )
-        embedding_model = HuggingFaceEmbeddings(
-            model_name=requested_model_name, model_kwargs={"device": device}
-        )
+        embedding_model = EmbeddingEngine(requested_model_name, device)
         current_embedding_model = requested_model_name
+        # 換模型後舊的查詢向量已不適用
+        query_embedding_cache.clear()
     else:
         print(
             f"[DEBUG] 使用快取中的 embedding 模型: {current_embedding_model}",
             flush=True,
         )
+    # 批次大小與 torch 執行緒數量可隨時調整，不需重新載入模型
+    embedding_model.configure(
+        int(config.get("embedding_batch_size", 32)),
+        int(config.get("embedding_num_threads", 0)),
+    )
     return embedding_model
 
 
-# 儲存與載入 index 對應的文字內容
-def save_text_chunks():
-    with open(TEXTS_PATH, "w", encoding="utf-8") as f:
-        json.dump(texts, f, ensure_ascii=False)
+def normalize_query(text):
+    # 全形轉半形並合併多餘空白，只差在空白或全半形的查詢共用同一個向量
+    return " ".join(unicodedata.normalize("NFKC", text).split())
 
 
-def load_text_chunks():
-    global texts
-    if os.path.exists(TEXTS_PATH):
-        with open(TEXTS_PATH, "r", encoding="utf-8") as f:
-            texts = json.load(f)
+def embed_queries_cached(q_strs):
+    """計算查詢向量，重複的查詢直接使用快取，回傳 shape 為 (N, d) 的 float32 陣列"""
+    engine = get_embedding_model()
+    query_embedding_cache.configure(
+        int(config.get("query_embedding_cache_max_entries", 10000)), 0
+    )
+    keys = [(engine.model_name, normalize_query(q)) for q in q_strs]
+    vectors = {key: query_embedding_cache.get(key) for key in set(keys)}
+    missing = [key for key, vec in vectors.items() if vec is None]
+    if missing:
+        computed = engine.embed_queries([text for _, text in missing])
+        for key, vec in zip(missing, computed):
+            vectors[key] = vec
+            query_embedding_cache.put(key, vec)
+    print(
+        f"[DEBUG] 查詢向量快取命中 {len(vectors) - len(missing)}/{len(vectors)}",
+        flush=True,
+    )
+    return np.vstack([vectors[key] for key in keys])
+
+
+def get_embedding_cache():
+    global embedding_cache
+    max_entries = int(config.get("embedding_cache_max_entries", 500000))
+    if max_entries <= 0:
+        return None
+    if embedding_cache is None:
+        os.makedirs(FAISS_DIR, exist_ok=True)
+        embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, max_entries)
+    embedding_cache.max_entries = max_entries
+    return embedding_cache
+
+
+def embed_documents_cached(contents, progress=None):
+    """
+    以 (embedding 模型, 內容雜湊) 查詢磁碟快取，只計算從未看過的內容
+    回傳 (vectors, 快取命中統計)；有 progress 時分批計算並回報進度，可在批次之間取消
+    """
+    model_name = config["embedding_model"]
+    hashes = [content_hash(c) for c in contents]
+    cache = get_embedding_cache()
+    cached = {}
+    if cache is not None:
+        try:
+            cached = cache.get_many(model_name, hashes)
+        except Exception as e:
+            print(f"[ERROR] 讀取 embedding 快取失敗: {e}", flush=True)
+
+    # 相同內容只計算一次，向量寫入第一次出現的位置
+    first_rows = {}
+    for i, h in enumerate(hashes):
+        first_rows.setdefault(h, i)
+    missing = [h for h in first_rows if h not in cached]
+    if progress is not None:
+        progress.add_done_chunks(len(hashes) - len(missing))
+    engine = get_embedding_model() if missing else None
+    if engine is not None:
+        dimension = engine.dimension
+    else:
+        dimension = len(next(iter(cached.values()))) if cached else 0
+    # 結果直接寫入預先配置的陣列
+    vectors = np.empty((len(hashes), dimension), dtype="float32")
+    for h, vector in cached.items():
+        vectors[first_rows[h]] = vector
+    embed_seconds = 0.0
+    if missing:
+        print(f"[DEBUG] 需計算向量 {len(missing)} 筆", flush=True)
+        # 以字元數粗略排序分成進度批次（不需斷詞），批次內再由 engine 依 token 長度排序
+        missing.sort(key=lambda h: -len(contents[first_rows[h]]))
+        batch_size = len(missing) if progress is None else EMBED_PROGRESS_BATCH
+        for start in range(0, len(missing), batch_size):
+            if progress is not None:
+                progress.check_cancelled()
+            batch = missing[start : start + batch_size]
+            rows = [first_rows[h] for h in batch]
+            vectors[rows] = engine.embed_documents([contents[i] for i in rows])
+            embed_seconds += engine.last_run["seconds"]
+            if cache is not None:
+                try:
+                    cache.put_many(model_name, list(zip(batch, vectors[rows])))
+                except Exception as e:
+                    print(f"[ERROR] 寫入 embedding 快取失敗: {e}", flush=True)
+            if progress is not None:
+                progress.add_done_chunks(len(batch))
+
+    # 重複的內容複製第一次出現位置的向量
+    rows = np.fromiter((first_rows[h] for h in hashes), np.int64, len(hashes))
+    duplicates = np.flatnonzero(rows != np.arange(len(hashes)))
+    vectors[duplicates] = vectors[rows[duplicates]]
+    # 舊版快取的向量可能未正規化
+    normalize_rows(vectors)
+    hits = len(hashes) - len(missing)
+    stats = {
+        "hits": hits,
+        "misses": len(missing),
+        "hit_rate": round(hits / len(hashes), 4) if hashes else 0.0,
+        "embed_seconds": round(embed_seconds, 3),
+    }
+    print(f"[DEBUG] embedding 快取: {stats}", flush=True)
+    return vectors, stats
 
 
-# 共用建索引 function
-def process_documents_and_update_index(doc_texts):
-    global texts, index
+def begin_index_update(rebuild=False):
+    """
+    複製目前的 snapshot 作為工作副本，修改完成後以 publish_snapshot 發佈
+    進行中的查詢仍使用原本的 snapshot（呼叫前需持有 index_write_lock）
+    """
+    # 其他 worker 可能已發佈新版本，以最新版本為基礎修改
+    sync_snapshot()
+    current = snapshot
+    if rebuild or current.index is None:
+        return IndexSnapshot(current.version)
+    if current.is_mmap:
+        # mmap 開啟的 index 為唯讀，從檔案重新讀入記憶體
+        print("[DEBUG] 重新以可寫入模式載入 index", flush=True)
+        index = read_index_file(current.index_path, False)
+    else:
+        index = faiss.clone_index(current.index)
+    index = ensure_id_map(index)
+    apply_search_params(index, config)
+    return IndexSnapshot(
+        current.version,
+        index,
+        list(current.texts),
+        dict(current.manifest),
+        parent=current,
+    )
+
+
+def publish_snapshot(work):
+    """將工作副本寫成新版本的 snapshot，並一次換上"""
+    global snapshot, snapshot_mtime
+    if work.index is None:
+        print("[WARN] 沒有任何向量，不發佈新版本索引", flush=True)
+        return snapshot
+    manifest = write_snapshot(
+        FAISS_DIR,
+        work.index,
+        work.texts,
+        {
+            "parent": work.version,
+            "index": describe_index(work.index),
+            "chunks": count_live_chunks(work.texts),
+            "embedding_model": config["embedding_model"],
+            "chunk_size": config["chunk_size"],
+            "chunk_overlap": config["chunk_overlap"],
+        },
+        passage_tokenizer(),
+        parent=work.parent,
+        id_map=work.id_map,
+    )
+    version = manifest["version"]
+    if is_mmap_mode():
+        # 重新以 mmap 開啟剛寫入的檔案，釋放記憶體中的副本
+        new_snapshot = load_snapshot(FAISS_DIR, version, True)
+        apply_search_params(new_snapshot.index, config)
+    else:
+        new_snapshot = IndexSnapshot(
+            version,
+            work.index,
+            work.texts,
+            manifest,
+            sparse=load_sparse_index(FAISS_DIR, version, False),
+            passage_tokens=load_passage_tokens(FAISS_DIR, version, False),
+        )
+    snapshot = new_snapshot
+    snapshot_mtime = current_mtime(FAISS_DIR)
+    print(f"[DEBUG] 已發佈索引版本 {version}: {manifest['chunks']} 筆", flush=True)
+
+    cleanup_snapshots(FAISS_DIR, int(config.get("snapshot_keep", 3)))
+    remove_legacy_index_files()
+    return new_snapshot
+
+
+def passage_tokenizer():
+    """建立索引時預先以 reranker 的 tokenizer 對 chunk 斷詞，reranker 無法載入時略過"""
+    try:
+        return get_reranker()
+    except Exception as e:
+        print(f"[WARN] 無法載入 reranker，略過 passage 預先斷詞: {e}", flush=True)
+        return None
+
+
+def remove_legacy_index_files():
+    for path in (INDEX_PATH, TEXTS_PATH):
+        if os.path.exists(path):
+            os.remove(path)
+    if os.path.exists(CHUNKS_PATH):
+        shutil.rmtree(CHUNKS_PATH)
+
+
+def count_live_chunks(texts):
+    # 已刪除的 chunk 以 None 保留位置
+    return sum(1 for chunk in texts if chunk is not None)
+
+
+def chunk_sources(chunk):
+    """回傳 chunk 的所有出處 [{source_file, markdown_file}]，相容舊版只有單一出處的 chunk"""
+    if chunk.get("sources"):
+        return chunk["sources"]
+    return [
+        {"source_file": chunk["source_file"], "markdown_file": chunk["markdown_file"]}
+    ]
+
+
+def make_chunk(content, sources):
+    # source_file / markdown_file 保留第一個出處，相容原本的欄位
+    return {
+        "content": content,
+        "source_file": sources[0]["source_file"],
+        "markdown_file": sources[0]["markdown_file"],
+        "sources": sources,
+    }
+
+
+def dedup_key(content):
+    # 忽略空白差異，內容相同的 chunk 視為重複
+    return content_hash(" ".join(content.split()))
+
+
+def dedup_chunks(chunks):
+    """相同內容的 chunk 只保留一份，並合併所有出處，回傳 (unique_chunks, 重複數量)"""
+    unique = {}  # dedup_key → (content, 出處)
+    for chunk in chunks:
+        key = dedup_key(chunk["content"])
+        _, sources = unique.setdefault(key, (chunk["content"], []))
+        for source in chunk_sources(chunk):
+            if source not in sources:
+                sources.append(source)
+    unique_chunks = [
+        make_chunk(content, sources) for content, sources in unique.values()
+    ]
+    return unique_chunks, len(chunks) - len(unique_chunks)
 
-    print("[DEBUG] process_documents_and_update_index: 開始", flush=True)
+
+def remove_document_chunks(work, source_files):
+    """
+    將指定來源檔案從工作副本 chunk 的出處中移除，沒有剩餘出處的 chunk 連同向量一併移除，
+    chunk id 位置保留為 None，回傳移除的 chunk 數量
+    """
+    texts = work.texts
+    source_files = set(source_files)
+    ids = []
+    for i, chunk in enumerate(texts):
+        if chunk is None:
+            continue
+        sources = chunk_sources(chunk)
+        remaining = [s for s in sources if s["source_file"] not in source_files]
+        if len(remaining) == len(sources):
+            continue
+        if remaining:
+            # 其他文件也有相同內容，只移除出處
+            texts[i] = make_chunk(chunk["content"], remaining)
+        else:
+            ids.append(i)
+    if not ids:
+        return 0
+    if work.index is not None:
+        work.index = remove_vectors(work.index, ids)
+    if work.chunk_keys is not None:
+        for i in ids:
+            work.chunk_keys.pop(dedup_key(texts[i]["content"]), None)
+    for i in ids:
+        texts[i] = None
+    print(f"[DEBUG] 已移除 {len(ids)} 個 chunk: {source_files}", flush=True)
+    return len(ids)
+
+
+def compact_chunks(work):
+    """回收工作副本中已刪除 chunk 的位置，重新編排 chunk id，回傳回收的數量"""
+    texts = work.texts
+    live_ids = [i for i, chunk in enumerate(texts) if chunk is not None]
+    removed = len(texts) - len(live_ids)
+    if removed == 0:
+        return 0
+    id_mapping = np.full(len(texts), -1, dtype="int64")
+    id_mapping[live_ids] = np.arange(len(live_ids), dtype="int64")
+    if work.index is not None:
+        work.index = remap_ids(work.index, id_mapping)
+    work.texts = [texts[i] for i in live_ids]
+    if work.chunk_keys is not None:
+        work.chunk_keys = {
+            key: int(id_mapping[i]) for key, i in work.chunk_keys.items()
+        }
+    if work.parent is not None:
+        # 與先前的對應合併，發佈時仍能沿用 parent 的 sparse index
+        if work.id_map is None:
+            work.id_map = id_mapping[: len(work.parent.texts)]
+        else:
+            work.id_map = np.where(work.id_map >= 0, id_mapping[work.id_map], -1)
+    print(f"[DEBUG] compaction 完成，回收 {removed} 個 chunk 位置", flush=True)
+    return removed
+
+
+def maybe_compact_chunks(work):
+    # 已刪除的比例超過 index_compact_ratio 時自動 compaction
+    if not work.texts:
+        return 0
+    ratio = float(config.get("index_compact_ratio", 0.3))
+    if (len(work.texts) - count_live_chunks(work.texts)) / len(work.texts) > ratio:
+        return compact_chunks(work)
+    return 0
+
+
+# 切 chunk、去除重複並計算向量，不需持有 index_write_lock，回傳 (new_chunks, vectors, 統計)
+# progress 為索引工作的進度紀錄 (JobProgress)，計算向量的批次之間可以取消
+def prepare_document_chunks(doc_texts, progress=None):
+    print("[DEBUG] prepare_document_chunks: 開始", flush=True)
+    source_files = [doc["source_file"] for doc in doc_texts]
+    if progress is not None:
+        progress.set_stage(source_files, STAGE_CHUNK)
     print("[DEBUG] 原始文件數量:", len(doc_texts), flush=True)
 
     print(
@@ -474,59 +936,235 @@ def process_documents_and_update_index(doc_texts):
         int(config["chunk_overlap"]),
         flush=True,
     )
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=int(config["chunk_size"]), chunk_overlap=int(config["chunk_overlap"])
-    )
-    new_chunks = []
+    splitter = make_text_splitter()
+    split_chunks = []
     for doc in doc_texts:
         # doc: {content, source_file, markdown_file}
         chunks = splitter.split_text(doc["content"])
         for chunk in chunks:
-            new_chunks.append(
+            split_chunks.append(
                 {
                     "content": chunk,
                     "source_file": doc["source_file"],
                     "markdown_file": doc["markdown_file"],
                 }
             )
-    print("[DEBUG] 產生 chunk 數量:", len(new_chunks), flush=True)
-    texts.extend(new_chunks)
+    print("[DEBUG] 產生 chunk 數量:", len(split_chunks), flush=True)
+    # 去除重複的 chunk（例如每頁重複的頁首頁尾），只保留一份並記錄所有出處
+    new_chunks, duplicate_count = dedup_chunks(split_chunks)
+    print("[DEBUG] 去除重複 chunk 數量:", duplicate_count, flush=True)
+
+    vectors = None
+    stats = {
+        "embedding_cache": {"hits": 0, "misses": 0, "hit_rate": 0.0},
+        "embedding": embedding_throughput(0, 0.0),
+        "duplicate_chunks": duplicate_count,
+    }
+    if new_chunks:
+        print("[DEBUG] 開始批次計算向量", flush=True)
+        if progress is not None:
+            progress.set_stage(source_files, STAGE_EMBED)
+            progress.add_total_chunks(len(new_chunks))
+        try:
+            vectors, stats["embedding_cache"] = embed_documents_cached(
+                [chunk["content"] for chunk in new_chunks], progress
+            )
+            stats["embedding"] = embedding_throughput(
+                stats["embedding_cache"]["misses"],
+                stats["embedding_cache"]["embed_seconds"],
+            )
+            print("[DEBUG] 向量 shape:", vectors.shape, flush=True)
+        except Exception as e:
+            print("[ERROR] 向量產生失敗:", str(e), flush=True)
+            raise
+    return new_chunks, vectors, stats
 
-    print("[DEBUG] 開始批次計算向量", flush=True)
-    try:
-        embedding_model = get_embedding_model()
-        vectors = embedding_model.embed_documents(
-            [chunk["content"] for chunk in new_chunks]
-        )
-        vectors = np.array(vectors).astype("float32")
-        print("[DEBUG] 向量 shape:", vectors.shape, flush=True)
-    except Exception as e:
-        print("[ERROR] 向量產生失敗:", str(e), flush=True)
-        raise
 
-    if index is None:
+def add_chunks_to_index(work, doc_texts, new_chunks, vectors):
+    """
+    將新的 chunk 與向量加入工作副本，回傳實際新增的 chunk 數量
+    其餘 chunk 的內容已存在於 index，只合併出處
+    """
+    texts = work.texts
+    # 同一份文件重新建立索引時，先移除舊的 chunk 與向量，避免重複
+    remove_document_chunks(work, (doc["source_file"] for doc in doc_texts))
+    if vectors is None:
+        return 0
+
+    # 已存在於 index 的內容（來自其他文件）只合併出處，不再加入向量
+    existing = existing_chunk_keys(work)
+    keep = []
+    keys = []
+    for n, chunk in enumerate(new_chunks):
+        key = dedup_key(chunk["content"])
+        i = existing.get(key)
+        if i is None:
+            keep.append(n)
+            keys.append(key)
+            continue
+        sources = list(chunk_sources(texts[i]))
+        sources += [s for s in chunk["sources"] if s not in sources]
+        texts[i] = make_chunk(texts[i]["content"], sources)
+    new_chunks = [new_chunks[n] for n in keep]
+    vectors = vectors[keep]
+
+    if work.index is None:
         print("[DEBUG] 尚未初始化 index，建立新 index", flush=True)
         dimension = vectors.shape[1]
-        index = faiss.IndexFlatL2(dimension)
+        # 依 configs.index_type 建立索引（flat / ivf_flat / hnsw / ivf_pq）
+        work.index = create_index(dimension, config, vectors)
     else:
         print("[DEBUG] 使用現有 index", flush=True)
-    index.add(vectors)
-    print("[DEBUG] 新向量已加入 index", flush=True)
-    try:
-        os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)  # 建立資料夾（保險）
-        faiss.write_index(index, INDEX_PATH)
-        print("[DEBUG] Index 已寫入檔案:", INDEX_PATH, flush=True)
-    except Exception as e:
-        print("[ERROR] 寫入 index 時失敗:", str(e), flush=True)
-    try:
-        save_text_chunks()
-        print("[DEBUG] texts.json 已儲存，共", len(texts), "筆", flush=True)
-    except Exception as e:
-        print("[ERROR] 儲存 texts.json 失敗:", str(e), flush=True)
-
+    # chunk id 即為 texts 中的位置，同一份文件的 chunk id 連續
+    start_id = len(texts)
+    if new_chunks:
+        work.index.add_with_ids(
+            vectors, np.arange(start_id, start_id + len(new_chunks), dtype="int64")
+        )
+        texts.extend(new_chunks)
+        existing.update(zip(keys, range(start_id, start_id + len(new_chunks))))
+        print("[DEBUG] 新向量已加入 index", flush=True)
     return len(new_chunks)
 
 
+def existing_chunk_keys(work):
+    """工作副本中 dedup_key → chunk id，第一次使用時建立，之後隨新增、移除 chunk 維護"""
+    if work.chunk_keys is None:
+        work.chunk_keys = {
+            dedup_key(chunk["content"]): i
+            for i, chunk in enumerate(work.texts)
+            if chunk is not None
+        }
+    return work.chunk_keys
+
+
+def make_text_splitter():
+    return RecursiveCharacterTextSplitter(
+        chunk_size=int(config["chunk_size"]), chunk_overlap=int(config["chunk_overlap"])
+    )
+
+
+def stream_rebuild_index(doc_stream, progress=None):
+    """
+    以串流方式重建索引：文件一轉換完成就切 chunk，累積 ingest_batch_size 筆不重複的 chunk
+    即計算向量並加入新的 index，轉換結果、切出的 chunk 清單與向量都不會一次全部留在記憶體
+    doc_stream 依序產生 {content, source_file, markdown_file}，回傳 (chunk 數量, 統計)
+    """
+    batch_size = max(int(config.get("ingest_batch_size", 256)), 1)
+    splitter = make_text_splitter()
+    # 重建期間查詢仍使用目前的 snapshot，完成後才換上新版本
+    work = IndexSnapshot(snapshot.version)
+    seen = {}  # dedup_key → chunk，重複的內容只合併出處
+    pending = []  # 等待計算向量的 chunk
+    pending_files = []  # 已切完 chunk、等待加入 index 的檔案
+    # 需要訓練的索引類型先累積向量（最多 index_train_sample_size 筆）再建立 index
+    needs_training = index_needs_training(config)
+    train_size = train_sample_size(config)
+    train_buffer = []
+    stats = {
+        "embedding_cache": {
+            "hits": 0,
+            "misses": 0,
+            "hit_rate": 0.0,
+            "embed_seconds": 0.0,
+        },
+        "duplicate_chunks": 0,
+    }
+
+    def add_ids(start_id, vectors):
+        work.index.add_with_ids(
+            vectors, np.arange(start_id, start_id + len(vectors), dtype="int64")
+        )
+
+    def build_index():
+        buffered = list(train_buffer)
+        train_buffer.clear()
+        train_vectors = np.vstack([v for _, v in buffered])
+        print(f"[DEBUG] 以 {len(train_vectors)} 筆向量建立新 index", flush=True)
+        work.index = create_index(train_vectors.shape[1], config, train_vectors)
+        del train_vectors
+        for start_id, vectors in buffered:
+            add_ids(start_id, vectors)
+
+    def add_vectors(start_id, vectors):
+        if work.index is not None:
+            add_ids(start_id, vectors)
+            return
+        train_buffer.append((start_id, vectors))
+        if needs_training and sum(len(v) for _, v in train_buffer) < train_size:
+            return
+        build_index()
+
+    def flush_pending():
+        if not pending:
+            return
+        if progress is not None:
+            progress.check_cancelled()
+            progress.set_stage(pending_files, STAGE_EMBED)
+            progress.add_total_chunks(len(pending))
+        vectors, cache_stats = embed_documents_cached(
+            [chunk["content"] for chunk in pending], progress
+        )
+        for key in ("hits", "misses", "embed_seconds"):
+            stats["embedding_cache"][key] += cache_stats[key]
+        # chunk id 即為 texts 中的位置
+        start_id = len(work.texts)
+        work.texts.extend(pending)
+        add_vectors(start_id, vectors)
+        if progress is not None:
+            progress.set_stage(pending_files, STAGE_ADD)
+        pending.clear()
+        pending_files.clear()
+
+    for doc in doc_stream:
+        source = {
+            "source_file": doc["source_file"],
+            "markdown_file": doc["markdown_file"],
+        }
+        for content in splitter.split_text(doc.pop("content")):
+            key = dedup_key(content)
+            chunk = seen.get(key)
+            if chunk is not None:
+                # 去除重複的 chunk（例如每頁重複的頁首頁尾），只保留一份並記錄所有出處
+                stats["duplicate_chunks"] += 1
+                if source not in chunk["sources"]:
+                    chunk["sources"].append(source)
+                continue
+            chunk = make_chunk(content, [source])
+            seen[key] = chunk
+            pending.append(chunk)
+            if len(pending) >= batch_size:
+                flush_pending()
+        pending_files.append(doc["source_file"])
+    flush_pending()
+    if train_buffer:
+        # 向量總數不足訓練樣本數時，以全部向量建立 index
+        build_index()
+
+    total = stats["embedding_cache"]["hits"] + stats["embedding_cache"]["misses"]
+    if total:
+        stats["embedding_cache"]["hit_rate"] = round(
+            stats["embedding_cache"]["hits"] / total, 4
+        )
+    stats["embedding"] = embedding_throughput(
+        stats["embedding_cache"]["misses"], stats["embedding_cache"]["embed_seconds"]
+    )
+    print(
+        f"[DEBUG] 串流重建完成: chunk {len(work.texts)} 筆，重複 {stats['duplicate_chunks']} 筆",
+        flush=True,
+    )
+
+    with index_write_lock:
+        # 其他 worker 可能已發佈新版本，新版本以最新版本為上一版
+        sync_snapshot()
+        work.version = snapshot.version
+        if progress is not None:
+            # 發佈之後就無法取消，最後再檢查一次
+            progress.check_cancelled()
+        publish_snapshot(work)
+    return len(work.texts), stats
+
+
 def save_config(data):
     try:
         config_dao.update_configs(data)
@@ -545,6 +1183,27 @@ def get_config(current_user: Dict[str, Any] = Depends(get_current_user)):
         return {}
 
 
+# 目前索引內的文件，供問答時限定搜尋範圍
+@app.get("/indexed_sources")
+def indexed_sources(current_user: Dict[str, Any] = Depends(get_current_user)):
+    try:
+        sync_snapshot()
+        snap = snapshot
+        if snap.index is None:
+            return {"sources": []}
+        sources = [
+            dict(source, chunks=len(ids))
+            for source, ids in snap.source_chunk_ids()
+            if len(ids)
+        ]
+        return {"sources": sorted(sources, key=lambda s: s["source_file"])}
+    except Exception as e:
+        print(f"[ERROR] 取得索引文件清單失敗: {e}", flush=True)
+        return JSONResponse(
+            status_code=500, content={"status": "error", "message": str(e)}
+        )
+
+
 @app.get("/isEnableThink")
 def isEnableThink(current_user: Dict[str, Any] = Depends(get_current_user)):
     try:
@@ -565,6 +1224,8 @@ def update_config(
         config.update(new_config)
         save_config(new_config)
         load_config()
+        # 查詢參數（nprobe / efSearch）可即時套用，不需重建索引
+        apply_search_params(snapshot.index, config)
         update_ollama_model_options()
         return {"status": "參數已儲存"}
     except Exception as e:
@@ -625,6 +1286,7 @@ def upload_file(
 ):
     require_admin(current_user)
     results = []
+    manifest = get_conversion_manifest()
     for file in files:
         file_path = os.path.join(DOC_PATH, file.filename)
         exists = os.path.exists(file_path)
@@ -636,13 +1298,25 @@ def upload_file(
         try:
             with open(file_path, "wb") as f:
                 f.write(file.file.read())
-            results.append(
-                {"filename": file.filename, "status": "success", "message": "上傳成功"}
-            )
+            result = {
+                "filename": file.filename,
+                "status": "success",
+                "message": "上傳成功",
+            }
+            # 內容與已上傳的其他檔案相同時提示，建立索引時會共用轉換結果
+            duplicates = [
+                name
+                for name in manifest.duplicates_of(file.filename, file_path)
+                if os.path.exists(os.path.join(DOC_PATH, name))
+            ]
+            if duplicates:
+                result["duplicate_of"] = duplicates
+            results.append(result)
         except Exception as e:
             results.append(
                 {"filename": file.filename, "status": "error", "message": str(e)}
             )
+    manifest.save()
     return {"results": results}
 
 
@@ -659,61 +1333,291 @@ def check_file_exists(
     return result
 
 
-# 依照選擇的檔案建立索引
-@app.post("/prepare_file")
-def api_prepare_files(
-    filenames: List[str] = Form(...),
-    current_user: Dict[str, Any] = Depends(get_current_user),
-):
-    require_admin(current_user)
+def start_index_job_worker():
+    global index_job_worker
+    if index_job_worker is None:
+        index_job_worker = IndexJobWorker(
+            index_job_dao,
+            run_index_job,
+            stale_seconds=int(config.get("index_job_stale_seconds", 60)),
+        )
+    index_job_worker.start()
+
+
+def run_index_job(job, progress):
+    """索引工作的 handler，由 IndexJobWorker 在背景執行緒呼叫"""
+    filenames = json.loads(job["filenames"] or "[]")
+    if job["job_type"] == JOB_TYPE_REBUILD:
+        return run_rebuild_job(filenames, progress)
+    if job["job_type"] == JOB_TYPE_REMOVE:
+        return run_remove_job(filenames, progress)
+    if job["job_type"] == JOB_TYPE_COMPACT:
+        return run_compact_job(progress)
+    return run_files_job(filenames, progress)
+
+
+def run_files_job(filenames, progress):
+    # 以 process pool 平行擷取，轉換完成的檔案切 chunk、計算向量後加入同一份工作副本，
+    # 每 index_publish_every 個檔案與最後各發佈一次；取消時已加入的檔案先發佈再結束
     results = []
-    print("[DEBUG] filenames: ", filenames, flush=True)
+    timings = []
+    pending = []
     for filename in filenames:
+        if progress.file_stage(filename) == STAGE_DONE:
+            # 重新啟動後接續執行，跳過已完成的檔案
+            results.append({"filename": filename, "status": "success", "resumed": True})
+            continue
         full_path = os.path.join(DOC_PATH, filename)
         if not os.path.exists(full_path):
+            progress.set_stage(filename, STAGE_FAILED, message="檔案不存在")
             results.append(
                 {"filename": filename, "status": "error", "message": "檔案不存在"}
             )
             continue
+        pending.append((full_path, filename))
+    # worker 實際開始轉換時才進入 convert，等待 pool 空出位置的檔案維持 queued
+    progress.set_stage([filename for _, filename in pending], STAGE_QUEUED)
+
+    publish_every = max(int(config.get("index_publish_every", 20)), 1)
+    # 已加入工作副本、尚未發佈的檔案，其他 worker 先發佈新版本時以最新版本重新加入
+    staged = []
+    state = {"work": None, "chunk_keys": None}
+
+    def rebase():
+        # 呼叫前需持有 index_write_lock
+        work = begin_index_update()
+        version, chunk_keys = state["chunk_keys"] or (None, None)
+        state["chunk_keys"] = None
+        if work.version == version:
+            # 上一版是自己發佈的，沿用維護中的 dedup_key，不必重新計算雜湊
+            work.chunk_keys = chunk_keys
+        for entry in staged:
+            entry["chunks"] = add_chunks_to_index(
+                work, [entry["result"]], entry["new_chunks"], entry["vectors"]
+            )
+        state["work"] = work
+
+    def stage(result, new_chunks, vectors, stats):
+        entry = {
+            "result": result,
+            "new_chunks": new_chunks,
+            "vectors": vectors,
+            "stats": stats,
+        }
+        if state["work"] is None:
+            with index_write_lock:
+                rebase()
         try:
-            result = convert_file_via_docling(full_path, filename)
+            entry["chunks"] = add_chunks_to_index(
+                state["work"], [result], new_chunks, vectors
+            )
+        except Exception:
+            # 工作副本可能只改了一半，下次以已加入的檔案重新建立
+            state["work"] = None
+            raise
+        staged.append(entry)
+
+    def publish_staged():
+        if not staged:
+            return
+        work = state["work"]
+        state["work"] = None
+        try:
+            with index_write_lock:
+                # 其他 worker 可能已發佈新版本，以最新版本重新加入尚未發佈的檔案
+                sync_snapshot()
+                if work is None or work.version != snapshot.version:
+                    rebase()
+                    work = state["work"]
+                    state["work"] = None
+                maybe_compact_chunks(work)
+                published = publish_snapshot(work)
+        except Exception as e:
+            traceback.print_exc()
+            for entry in staged:
+                filename = entry["result"]["source_file"]
+                progress.set_stage(filename, STAGE_FAILED, message=str(e))
+                results.append(
+                    {"filename": filename, "status": "error", "message": str(e)}
+                )
+            staged.clear()
+            return
+        state["chunk_keys"] = (published.version, work.chunk_keys)
+        for entry in staged:
+            result = entry["result"]
+            stats = entry["stats"]
+            stats["duplicate_chunks"] += len(entry["new_chunks"]) - entry["chunks"]
+            progress.set_stage(
+                result["source_file"],
+                STAGE_DONE,
+                chunks=entry["chunks"],
+                pages=result.get("pages"),
+                **result["timing"],
+            )
+            results.append(
+                {
+                    "filename": result["source_file"],
+                    "status": "success",
+                    "chunks": entry["chunks"],
+                    "timing": result["timing"],
+                    "conversion_cache": result.get("conversion_cache"),
+                    "duplicate_of": result.get("duplicate_of"),
+                    "pages": result.get("pages"),
+                    **stats,
+                }
+            )
+        staged.clear()
+
+    def start_converting(filename):
+        progress.set_stage(filename, STAGE_CONVERT)
+
+    conversions = convert_files(pending, config, on_start=start_converting)
+    try:
+        for filename, result in conversions:
+            progress.check_cancelled()
             print("[DEBUG] result: ", result, flush=True)
             if not result:
+                progress.set_stage(filename, STAGE_FAILED, message="無法擷取內容")
                 results.append(
                     {"filename": filename, "status": "error", "message": "無法擷取內容"}
                 )
                 continue
-            chunk_count = process_documents_and_update_index([result])
-            print("[DEBUG] chunk_count: ", chunk_count, flush=True)
-            results.append(
-                {"filename": filename, "status": "success", "chunks": chunk_count}
-            )
-        except Exception as e:
-            traceback.print_exc()
-            results.append({"filename": filename, "status": "error", "message": str(e)})
-    return {"results": results}
+            timings.append(result["timing"])
+            try:
+                new_chunks, vectors, stats = prepare_document_chunks([result], progress)
+                progress.set_stage(filename, STAGE_ADD)
+                stage(result, new_chunks, vectors, stats)
+            except JobCancelled:
+                raise
+            except Exception as e:
+                traceback.print_exc()
+                progress.set_stage(filename, STAGE_FAILED, message=str(e))
+                results.append(
+                    {"filename": filename, "status": "error", "message": str(e)}
+                )
+                continue
+            if len(staged) >= publish_every:
+                publish_staged()
+        publish_staged()
+    except JobCancelled:
+        # 已加入工作副本的檔案仍發佈，保留在索引中
+        publish_staged()
+        raise
+    finally:
+        # 取消或發生例外時，停止尚未開始的轉換
+        conversions.close()
+    return {"results": results, "conversion": summarize_conversion_timing(timings)}
 
 
-# 建立目錄裡全部檔案索引
+def run_rebuild_job(filenames, progress):
+    # 以串流方式重建：邊轉換邊切 chunk、計算向量並加入新的 index，取消時目前的索引維持不變
+    progress.set_stage(filenames, STAGE_QUEUED)
+    pending = []
+    for filename in filenames:
+        full_path = os.path.join(DOC_PATH, filename)
+        if not os.path.isfile(full_path):
+            progress.set_stage(filename, STAGE_FAILED, message="檔案不存在")
+            continue
+        pending.append((full_path, filename))
+
+    counts = {"converted_files": 0, "cached_files": 0}
+    # 各頁面走文字層或 OCR 的統計（只計算本次實際轉換的檔案）
+    pages = {"total": 0, "text_layer": 0, "ocr": 0}
+    done_files = []
+    timings = []
+
+    def converted_docs():
+        # 轉換完成一份就交給串流重建處理，不保留全部文件內容
+        for filename, result in conversions:
+            progress.check_cancelled()
+            if not result:
+                progress.set_stage(filename, STAGE_FAILED, message="無法擷取內容")
+                continue
+            progress.set_stage(filename, STAGE_CHUNK, **result["timing"])
+            if result.get("conversion_cache") == "miss":
+                counts["converted_files"] += 1
+            else:
+                counts["cached_files"] += 1
+            for key, count in (result.get("pages") or {}).items():
+                pages[key] += count
+            done_files.append(result["source_file"])
+            timings.append(result["timing"])
+            yield result
+
+    def start_converting(filename):
+        progress.set_stage(filename, STAGE_CONVERT)
+
+    conversions = convert_files(pending, config, on_start=start_converting)
+    try:
+        chunk_count, stats = stream_rebuild_index(converted_docs(), progress)
+    finally:
+        conversions.close()
+    progress.set_stage(done_files, STAGE_DONE)
+    return {
+        "status": "success",
+        "chunks": chunk_count,
+        **counts,
+        "pages": pages,
+        "conversion": summarize_conversion_timing(timings),
+        **stats,
+    }
+
+
+def run_remove_job(filenames, progress):
+    # 移除後需重寫 chunk store 與 sparse index，在背景執行，不佔用 HTTP 請求
+    with index_write_lock:
+        work = begin_index_update()
+        removed = remove_document_chunks(work, filenames)
+        maybe_compact_chunks(work)
+        progress.check_cancelled()
+        publish_snapshot(work)
+    progress.set_stage(filenames, STAGE_DONE)
+    return {"status": "success", "removed_chunks": removed}
+
+
+def run_compact_job(progress):
+    with index_write_lock:
+        work = begin_index_update()
+        reclaimed = compact_chunks(work)
+        progress.check_cancelled()
+        publish_snapshot(work)
+    return {"status": "success", "reclaimed": reclaimed, "chunks": len(work.texts)}
+
+
+def submit_index_job(job_type, filenames, current_user):
+    job_id = index_job_dao.create_job(
+        job_type, json.dumps(filenames, ensure_ascii=False), current_user["id"]
+    )
+    if job_id < 0:
+        return JSONResponse(
+            status_code=500, content={"status": "error", "message": "無法建立索引工作"}
+        )
+    print(f"[DEBUG] 已建立索引工作 {job_id} ({job_type}): {filenames}", flush=True)
+    return {"status": "queued", "job_id": job_id}
+
+
+# 依照選擇的檔案建立索引（背景工作，立即回傳 job_id）
+@app.post("/prepare_file")
+def api_prepare_files(
+    filenames: List[str] = Form(...),
+    current_user: Dict[str, Any] = Depends(get_current_user),
+):
+    require_admin(current_user)
+    print("[DEBUG] filenames: ", filenames, flush=True)
+    return submit_index_job(JOB_TYPE_FILES, filenames, current_user)
+
+
+# 建立目錄裡全部檔案索引（背景工作，立即回傳 job_id）
 @app.post("/prepare_index")
 def api_prepare_index(current_user: Dict[str, Any] = Depends(get_current_user)):
     require_admin(current_user)
-    global texts, index
     try:
-        docs = []
-        for filename in os.listdir(DOC_PATH):
-            full_path = os.path.join(DOC_PATH, filename)
-            if not os.path.isfile(full_path):
-                continue
-
-            result = convert_file_via_docling(full_path, filename)
-            if result:
-                docs.append(result)
-
-        texts.clear()
-        index = None
-        chunk_count = process_documents_and_update_index(docs)
-        return {"status": "success", "chunks": chunk_count}
+        filenames = sorted(
+            filename
+            for filename in os.listdir(DOC_PATH)
+            if os.path.isfile(os.path.join(DOC_PATH, filename))
+        )
+        return submit_index_job(JOB_TYPE_REBUILD, filenames, current_user)
     except Exception as e:
         traceback.print_exc()
         return JSONResponse(
@@ -721,19 +1625,117 @@ def api_prepare_index(current_user: Dict[str, Any] = Depends(get_current_user)):
         )
 
 
+# 列出最近的索引工作
+@app.get("/index_jobs")
+def api_list_index_jobs(
+    limit: int = 20, current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    require_admin(current_user)
+    return {"jobs": [format_job(job) for job in index_job_dao.list_jobs(limit)]}
+
+
+# 查詢索引工作的進度（各檔案階段、chunks/s、預估剩餘時間）
+@app.get("/index_jobs/{job_id}")
+def api_get_index_job(
+    job_id: int, current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    require_admin(current_user)
+    job = index_job_dao.get_job(job_id)
+    if job is None:
+        return JSONResponse(
+            status_code=404, content={"status": "error", "message": "找不到索引工作"}
+        )
+    return format_job(job)
+
+
+# LLM 回覆快取的命中統計（僅此 worker）
+@app.get("/answer_cache")
+def api_answer_cache_stats(current_user: Dict[str, Any] = Depends(get_current_user)):
+    require_admin(current_user)
+    if answer_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **answer_cache.stats()}
+
+
+# 查詢向量快取的命中統計（僅此 worker）
+@app.get("/query_embedding_cache")
+def api_query_embedding_cache_stats(
+    current_user: Dict[str, Any] = Depends(get_current_user),
+):
+    require_admin(current_user)
+    return query_embedding_cache.stats()
+
+
+# reranker 批次推理的統計（僅此 worker）
+@app.get("/reranker_stats")
+def api_reranker_stats(current_user: Dict[str, Any] = Depends(get_current_user)):
+    require_admin(current_user)
+    if reranker is None:
+        return {"loaded": False}
+    return {
+        "loaded": True,
+        "backend": reranker.backend,
+        "parity": reranker.parity,
+        "batching": rerank_batcher.stats(),
+        "score_cache": rerank_score_cache.stats(),
+    }
+
+
+# 清空 LLM 回覆快取
+@app.post("/answer_cache/clear")
+def api_clear_answer_cache(current_user: Dict[str, Any] = Depends(get_current_user)):
+    require_admin(current_user)
+    if answer_cache is not None:
+        answer_cache.clear()
+    return {"status": "success"}
+
+
+# 取消索引工作
+@app.post("/index_jobs/{job_id}/cancel")
+def api_cancel_index_job(
+    job_id: int, current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    require_admin(current_user)
+    if not index_job_dao.request_cancel(job_id):
+        return JSONResponse(
+            status_code=400,
+            content={"status": "error", "message": "索引工作不存在或已結束"},
+        )
+    return {"status": "cancel_requested", "job_id": job_id}
+
+
+# 從索引移除選擇的檔案（背景工作，立即回傳 job_id）
+@app.post("/remove_file_index")
+def api_remove_file_index(
+    filenames: List[str] = Form(...),
+    current_user: Dict[str, Any] = Depends(get_current_user),
+):
+    require_admin(current_user)
+    return submit_index_job(JOB_TYPE_REMOVE, filenames, current_user)
+
+
+# 回收已刪除 chunk 的空間（背景工作，立即回傳 job_id）
+@app.post("/compact_index")
+def api_compact_index(current_user: Dict[str, Any] = Depends(get_current_user)):
+    require_admin(current_user)
+    return submit_index_job(JOB_TYPE_COMPACT, [], current_user)
+
+
 # 顯示索引前100筆內容
 @app.get("/show_index_summary_100")
 def index_summary_100(current_user: Dict[str, Any] = Depends(get_current_user)):
     require_admin(current_user)
     try:
+        snap = snapshot
         # 從 texts 中提取出所有的 content
         content_chunks = [
-            item["content"] for item in texts[:100]
+            item["content"] for item in snap.texts[:100] if item is not None
         ]  # 最多顯示前100筆內容
         return {
-            "count": len(texts),
+            "count": count_live_chunks(snap.texts),
             "chunks": content_chunks,
-            "index_exists": os.path.exists(INDEX_PATH),
+            "index_exists": snap.index is not None,
+            "version": snap.version,
         }
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -744,12 +1746,16 @@ def index_summary_100(current_user: Dict[str, Any] = Depends(get_current_user)):
 def index_summary(current_user: Dict[str, Any] = Depends(get_current_user)):
     require_admin(current_user)
     try:
+        snap = snapshot
         # 從 texts 中提取出所有的 content
-        content_chunks = [item["content"] for item in texts]  # 顯示全部內容
+        content_chunks = [
+            item["content"] for item in snap.texts if item is not None
+        ]  # 顯示全部內容
         return {
-            "count": len(texts),
+            "count": len(content_chunks),
             "chunks": content_chunks,
-            "index_exists": os.path.exists(INDEX_PATH),
+            "index_exists": snap.index is not None,
+            "version": snap.version,
         }
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -759,11 +1765,13 @@ def index_summary(current_user: Dict[str, Any] = Depends(get_current_user)):
 @app.post("/clear_index")
 def clear_index(current_user: Dict[str, Any] = Depends(get_current_user)):
     require_admin(current_user)
+    global snapshot, snapshot_mtime
     try:
-        if os.path.exists(INDEX_PATH):
-            os.remove(INDEX_PATH)
-        if os.path.exists(TEXTS_PATH):
-            os.remove(TEXTS_PATH)
+        with index_write_lock:
+            remove_all_snapshots(FAISS_DIR)
+            remove_legacy_index_files()
+            snapshot = IndexSnapshot()
+            snapshot_mtime = None
         # 清除 MD_PATH 底下所有檔案
         if os.path.exists(MD_PATH):
             for filename in os.listdir(MD_PATH):
@@ -773,8 +1781,6 @@ def clear_index(current_user: Dict[str, Any] = Depends(get_current_user)):
                 elif os.path.isdir(file_path):
                     shutil.rmtree(file_path)  # 如果是目錄，遞迴刪除
 
-        globals()["index"] = None
-        globals()["texts"] = []
         return {"status": "cleared"}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -784,41 +1790,321 @@ def clear_index(current_user: Dict[str, Any] = Depends(get_current_user)):
 @app.get("/validate_index")
 def validate_index(current_user: Dict[str, Any] = Depends(get_current_user)):
     require_admin(current_user)
-    if index is None or not texts:
+    snap = snapshot
+    index = snap.index
+    if index is None or not snap.texts:
         return {"status": "invalid", "reason": "index 或 texts 為空"}
-    if index.ntotal != len(texts):
+    live_count = count_live_chunks(snap.texts)
+    if index.ntotal != live_count:
         return {
             "status": "invalid",
-            "reason": f"index 向量數 {index.ntotal} 不等於 texts 數 {len(texts)}",
+            "reason": f"index 向量數 {index.ntotal} 不等於 texts 數 {live_count}",
+        }
+    return {
+        "status": "ok",
+        "vectors": index.ntotal,
+        "index": describe_index(index),
+        "version": snap.version,
+        "manifest": snap.manifest,
+    }
+
+
+# 比較各種向量儲存格式的記憶體用量與 recall 損失
+@app.get("/index_storage_report")
+def index_storage_report(
+    sample_size: int = 20000,
+    k: int = 10,
+    current_user: Dict[str, Any] = Depends(get_current_user),
+):
+    require_admin(current_user)
+    try:
+        index = snapshot.index
+        # 優先使用 embedding 快取內的原始向量，沒有時從目前的 index 取回
+        vectors = None
+        cache = get_embedding_cache()
+        if cache is not None:
+            vectors = cache.sample(config["embedding_model"], sample_size)
+        if vectors is None and index is not None and index.ntotal > 0:
+            vectors = reconstruct_vectors(index)[:sample_size]
+        if vectors is None or len(vectors) < 20:
+            return JSONResponse(
+                status_code=400,
+                content={"status": "error", "message": "樣本向量不足，請先建立索引"},
+            )
+        vectors = vectors[np.random.default_rng(0).permutation(len(vectors))]
+        return {
+            "status": "success",
+            "sample_size": len(vectors),
+            "current": {
+                "index": describe_index(index),
+                "memory_bytes": index_memory_bytes(index) if index is not None else 0,
+            },
+            "report": storage_report(vectors, config, k=k),
+        }
+    except Exception as e:
+        traceback.print_exc()
+        return JSONResponse(
+            status_code=500, content={"status": "error", "message": str(e)}
+        )
+
+
+def llm_options():
+    return {
+        "num_ctx": int(config["num_ctx"]),
+        "repeat_last_n": int(config["repeat_last_n"]),
+        "repeat_penalty": float(config["repeat_penalty"]),
+        "temperature": float(config["temperature"]),
+        "seed": int(config["seed"]),
+        "stop": [config["stop"]],
+        "num_predict": int(config["num_predict"]),
+        "top_k": int(config["top_k"]),
+        "top_p": float(config["top_p"]),
+        "min_p": float(config["min_p"]),
+    }
+
+
+def get_answer_cache(snap):
+    """回傳 LLM 回覆快取，停用時為 None；索引版本或配置改變時先清空快取"""
+    global answer_cache
+    if str(config.get("answer_cache_enabled", "True")).lower() != "true":
+        return None
+    max_entries = int(config.get("answer_cache_max_entries", 1000))
+    ttl_seconds = float(config.get("answer_cache_ttl_seconds", 86400))
+    threshold = float(config.get("answer_cache_semantic_threshold", 0.95))
+    if answer_cache is None:
+        answer_cache = AnswerCache(max_entries, ttl_seconds, threshold)
+    answer_cache.configure(max_entries, ttl_seconds, threshold)
+    answer_cache.ensure_generation((snap.version, config_signature(config)))
+    return answer_cache
+
+
+def answer_scope(query):
+    # 只有模型、推理開關、關鍵字與限定文件都相同的問題才能共用回覆
+    return [
+        config["llm_model"],
+        bool(query.think),
+        query.keyword or "",
+        sorted(query.source_files or []),
+        sorted(query.markdown_files or []),
+    ]
+
+
+def cached_answer_stream(cached, tier, query, current_user):
+    """以與 LLM 串流相同的 JSON 格式回傳快取的回覆"""
+    print(f"[DEBUG] 回覆快取命中 ({tier})", flush=True)
+    yield json.dumps(
+        {
+            "prompt": cached["prompt"],
+            "answer": "",
+            "thinking": "",
+            "answer_cache": tier,
         }
-    return {"status": "ok", "vectors": index.ntotal}
+    )
+    yield json.dumps({"content": cached["content"], "thinking": cached["thinking"]})
+    store_conversation(
+        query.conv_id, query.question, cached["full_answer"], current_user["id"]
+    )
+
+
+def resolve_allowed_ids(snap, source_files, markdown_files):
+    """查詢限定文件時回傳允許的 chunk ids，未限定時為 None"""
+    if not source_files and not markdown_files:
+        return None
+    # 在 FAISS 搜尋時就限定文件（精確搜尋或 ID selector，見 search_index），不是先多取再過濾
+    allowed_ids = snap.chunk_ids_for(source_files or (), markdown_files or ())
+    print(f"[DEBUG] 限定文件搜尋: {len(allowed_ids)} 個 chunk", flush=True)
+    if len(allowed_ids) == 0:
+        raise HTTPException(status_code=400, detail="指定的文件尚未建立索引")
+    return allowed_ids
+
+
+def is_hybrid_search():
+    return str(config.get("hybrid_search", "True")).lower() == "true"
+
+
+def hybrid_search(snap, q_str, k, allowed_ids=None):
+    """
+    以向量 (FAISS) 與 BM25 (sparse index) 兩種方式檢索，再以 reciprocal rank fusion 合併
+    回傳 (依融合排名排序的 chunk id, 各檢索器耗時 ms, {chunk id: 向量相似度})；
+    沒有 sparse index 時只使用向量檢索
+    allowed_ids 為允許的 chunk id（已排序），兩種檢索都只在這些 chunk 內搜尋
+    """
+    rankings, retrieval_ms, dense_scores = hybrid_search_many(
+        snap, [q_str], k, allowed_ids
+    )
+    return rankings[0], retrieval_ms, dense_scores[0]
+
+
+def hybrid_search_many(snap, q_strs, k, allowed_ids=None):
+    """
+    多個查詢一起檢索：一次計算全部查詢的向量，以 (N, d) 矩陣做一次 FAISS 搜尋
+    回傳 (每個查詢依融合排名排序的 chunk ids, 各檢索器耗時 ms,
+    每個查詢向量檢索命中的 {chunk id: cosine 相似度})
+    """
+    retrieval_ms = {}
+    started = time.perf_counter()
+    q_vecs = embed_queries_cached(q_strs)
+    # k值控制向量回傳結果數量,數量越多代表不相干的結果就會越多..通常是設定3~5就好
+    D, I = search_index(snap.index, q_vecs, k, allowed_ids)
+    retrieval_ms["dense"] = round((time.perf_counter() - started) * 1000, 2)
+    print("[DEBUG] D: ", D, flush=True)
+    print("[DEBUG] I: ", I, flush=True)
+    # I 內的 -1 代表沒有足夠的結果（例如 IVF 搜尋的分群內向量不足）
+    dense_rankings = [[int(i) for i in row if i >= 0] for row in I]
+    dense_scores = [
+        {int(i): float(s) for i, s in zip(ids, l2_to_cosine(dists)) if i >= 0}
+        for ids, dists in zip(I, D)
+    ]
+    if snap.sparse is None or not is_hybrid_search():
+        print(f"[DEBUG] 檢索耗時 (ms): {retrieval_ms}", flush=True)
+        return dense_rankings, retrieval_ms, dense_scores
+
+    started = time.perf_counter()
+    sparse_rankings = []
+    for q_str in q_strs:
+        sparse_ids, sparse_scores = snap.sparse.search(
+            q_str, int(config.get("bm25_top_k", k)), allowed_ids
+        )
+        print(
+            "[DEBUG] BM25: ",
+            list(zip(sparse_ids.tolist(), sparse_scores.tolist())),
+            flush=True,
+        )
+        sparse_rankings.append(sparse_ids.tolist())
+    retrieval_ms["sparse"] = round((time.perf_counter() - started) * 1000, 2)
+
+    started = time.perf_counter()
+    rankings = [
+        [
+            chunk_id
+            for chunk_id, _ in reciprocal_rank_fusion(
+                [dense, sparse], k=int(config.get("rrf_k", RRF_K)), limit=k
+            )
+        ]
+        for dense, sparse in zip(dense_rankings, sparse_rankings)
+    ]
+    retrieval_ms["fusion"] = round((time.perf_counter() - started) * 1000, 2)
+    print(f"[DEBUG] 檢索耗時 (ms): {retrieval_ms}", flush=True)
+    return rankings, retrieval_ms, dense_scores
 
 
 # 使用 BGE Reranker 模型進行重排序
-def rerank_with_bge(query, candidate_texts, top_k):
-    pairs = [(query, passage) for passage in candidate_texts]
-    print("[DEBUG] rerank top_k: ", top_k, flush=True)
-    # Tokenize
-    inputs = reranker_tokenizer(
-        [q for q, p in pairs],
-        [p for q, p in pairs],
-        padding=True,
-        truncation=True,
-        return_tensors="pt",
-        max_length=512,
+def rerank_scores(pairs):
+    """
+    以 BGE reranker 計算 [(query, passage)] 或 [(query, passage, passage token ids)]
+    的相關分數，同時進行的查詢由 rerank_batcher 合併成一批推理
+    """
+    model = get_reranker()
+    rerank_batcher.configure(
+        int(config.get("rerank_max_batch_size", 64)),
+        float(config.get("rerank_max_wait_ms", 5)),
     )
-    # 因為 device 選擇用GPU，為避免使用CPU推理造成異常，故此處需使用GPU推理
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    rerank_score_cache.configure(
+        int(config.get("rerank_score_cache_max_entries", 50000)), 0
+    )
+    # 已計算過的 (問題, passage) 直接使用快取的分數，只有其餘配對送進模型
+    keys = [
+        (
+            model.model_name,
+            model.backend,
+            normalize_query(pair[0]),
+            content_hash(pair[1]),
+        )
+        for pair in pairs
+    ]
+    scores = [rerank_score_cache.get(key) for key in keys]
+    missing = [i for i, score in enumerate(scores) if score is None]
+    if missing:
+        computed = rerank_batcher.score([pairs[i] for i in missing])
+        for i, score in zip(missing, computed):
+            scores[i] = score
+            rerank_score_cache.put(keys[i], score)
+    print(
+        f"[DEBUG] reranker 分數快取命中 {len(pairs) - len(missing)}/{len(pairs)}",
+        flush=True,
+    )
+    return scores
+
+
+def passage_token_ids(snap, chunk_ids):
+    """
+    chunk 預先斷詞的 token ids，snapshot 沒有預先斷詞或 tokenizer 與目前的 reranker 不同時為 None
+    """
+    tokens = snap.passage_tokens
+    if tokens is None or tokens.tokenizer != get_reranker().model_name:
+        return [None] * len(chunk_ids)
+    return [tokens[i] for i in chunk_ids]
 
-    with torch.no_grad():
-        scores = reranker_model(**inputs).logits.squeeze(-1)
 
+def is_rerank_cascade():
+    return str(config.get("rerank_cascade", "True")).lower() == "true"
+
+
+def plan_rerank(chunk_ids, chunks, dense_scores, top_k):
+    """
+    依序判斷是否需要 cross-encoder，回傳 (候選 [(chunk id, chunk)], 實際走的路徑與數量)，
+    路徑為 cross_encoder 時候選需再以 cross-encoder 排序，否則前 top_k 個候選即為結果：
+    1. 第一階段過濾：向量相似度低於 rerank_min_similarity 的候選直接淘汰，
+       只由 BM25 命中（沒有向量相似度）的候選保留
+    2. 候選數量不超過 top_k 時全部都會使用，不需排序          → few_candidates
+    3. 向量相似度第一名領先第二名達 rerank_margin 時視為明確答案，
+       直接使用第一階段（融合排名）的順序                     → margin
+    4. 只將第一階段前 rerank_max_candidates 個候選送進 cross-encoder → cross_encoder
+    chunk_ids / chunks 為依第一階段排名排序的候選
+    """
+    info = {"path": "cross_encoder", "candidates": len(chunks), "reranked": 0}
+    candidates = list(zip(chunk_ids, chunks))
+    if is_rerank_cascade():
+        min_similarity = float(config.get("rerank_min_similarity", 0))
+        if min_similarity > 0:
+            candidates = [
+                (i, c)
+                for i, c in candidates
+                if dense_scores.get(i, min_similarity) >= min_similarity
+            ]
+            info["filtered"] = len(chunks) - len(candidates)
+        if len(candidates) <= top_k:
+            info["path"] = "few_candidates"
+        else:
+            similarities = sorted(
+                (dense_scores[i] for i, _ in candidates if i in dense_scores),
+                reverse=True,
+            )
+            margin = float(config.get("rerank_margin", 0.15))
+            if (
+                margin > 0
+                and len(similarities) >= 2
+                and similarities[0] - similarities[1] >= margin
+            ):
+                info["path"] = "margin"
+                info["margin"] = round(similarities[0] - similarities[1], 4)
+            else:
+                max_candidates = int(config.get("rerank_max_candidates", 20))
+                if max_candidates > 0:
+                    candidates = candidates[: max(max_candidates, top_k)]
+    if info["path"] != "cross_encoder":
+        print(f"[DEBUG] 略過 cross-encoder: {info}", flush=True)
+    return candidates, info
+
+
+def cascade_rerank(question, snap, chunk_ids, chunks, dense_scores, top_k):
+    """依 plan_rerank 的判斷進行 rerank，回傳 (前 top_k 個 chunk, 實際走的路徑與數量)"""
+    candidates, info = plan_rerank(chunk_ids, chunks, dense_scores, top_k)
+    if info["path"] != "cross_encoder":
+        return [c for _, c in candidates[:top_k]], info
+
+    print("[DEBUG] rerank top_k: ", top_k, flush=True)
+    ids = [i for i, _ in candidates]
+    scores = rerank_scores(
+        [
+            (question, chunk["content"], tokens)
+            for (_, chunk), tokens in zip(candidates, passage_token_ids(snap, ids))
+        ]
+    )
+    info["reranked"] = len(candidates)
     # 排序並選出 top_k
-    top_k_indices = torch.topk(
-        scores, k=min(top_k, len(candidate_texts))
-    ).indices.tolist()
-    reranked_texts = [candidate_texts[i] for i in top_k_indices]
-    return reranked_texts
+    top_k_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+    return [candidates[i][1] for i in top_k_indices[:top_k]], info
 
 
 # 儲存對話記錄
@@ -875,6 +2161,129 @@ def delete_conversation(
         raise HTTPException(status_code=500, detail="刪除對話記錄失敗")
 
 
+# 批次檢索：多個查詢（例如名詞分析產生的同義詞變化）一次計算向量、做一次 FAISS 搜尋，
+# 候選 chunk 去除重複後依 cascade 判斷是否 rerank，只回傳檢索結果，不呼叫 LLM
+@app.post("/retrieve")
+def retrieve(
+    req: RetrieveRequest, current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    queries = [q.strip() for q in req.queries if q and q.strip()]
+    if not queries:
+        raise HTTPException(status_code=400, detail="queries 不可為空")
+    if len(queries) > RETRIEVE_MAX_QUERIES:
+        raise HTTPException(
+            status_code=400, detail=f"一次最多 {RETRIEVE_MAX_QUERIES} 個查詢"
+        )
+    try:
+        sync_snapshot()
+        snap = snapshot
+        if snap.index is None or len(snap.texts) == 0:
+            raise HTTPException(status_code=400, detail="尚未建立索引，請先分析文件")
+        allowed_ids = resolve_allowed_ids(snap, req.source_files, req.markdown_files)
+        k = int(config["idx_result_count"])
+        top_k = req.top_k
+        if top_k is None:
+            top_k = int(config["rerank_top_k_final"])
+        rankings, retrieval_ms, dense_scores = hybrid_search_many(
+            snap, queries, k, allowed_ids
+        )
+
+        if req.merge:
+            # 各查詢的排名再以 RRF 合併，同一個 chunk 只保留一次，
+            # 候選數量與單一查詢相同，rerank 成本不隨查詢數量增加
+            merged = reciprocal_rank_fusion(
+                rankings, k=int(config.get("rrf_k", RRF_K)), limit=k
+            )
+            # 向量相似度取各查詢中最高者
+            merged_scores = {}
+            for scores in dense_scores:
+                for chunk_id, score in scores.items():
+                    merged_scores[chunk_id] = max(
+                        score, merged_scores.get(chunk_id, score)
+                    )
+            groups = [
+                (
+                    req.rerank_query or queries[0],
+                    queries,
+                    [cid for cid, _ in merged],
+                    merged_scores,
+                )
+            ]
+        else:
+            groups = [
+                (q, [q], ranking, scores)
+                for q, ranking, scores in zip(queries, rankings, dense_scores)
+            ]
+
+        # 每組依 cascade 判斷是否需要 cross-encoder，需要的配對一次送進 reranker
+        started = time.perf_counter()
+        plans, pairs, owners = [], [], []
+        for g, (rerank_query, _, chunk_ids, scores) in enumerate(groups):
+            candidates = [
+                (i, snap.texts[i]) for i in chunk_ids if snap.texts[i] is not None
+            ]
+            candidates, info = plan_rerank(
+                [i for i, _ in candidates],
+                [c for _, c in candidates],
+                scores,
+                top_k,
+            )
+            plans.append((candidates, info))
+            if info["path"] != "cross_encoder":
+                continue
+            tokens = passage_token_ids(snap, [i for i, _ in candidates])
+            for (chunk_id, chunk), chunk_tokens in zip(candidates, tokens):
+                pairs.append((rerank_query, chunk["content"], chunk_tokens))
+                owners.append((g, chunk_id))
+        rerank = rerank_scores(pairs) if pairs else []
+        retrieval_ms["rerank"] = round((time.perf_counter() - started) * 1000, 2)
+        rerank_by_chunk = dict(zip(owners, rerank))
+
+        results = []
+        for g, (rerank_query, group_queries, _, _) in enumerate(groups):
+            candidates, info = plans[g]
+            if info["path"] == "cross_encoder":
+                info["reranked"] = len(candidates)
+                # 依 cross-encoder 分數排序
+                candidates = sorted(
+                    candidates,
+                    key=lambda item: rerank_by_chunk[(g, item[0])],
+                    reverse=True,
+                )
+            chunks = []
+            for chunk_id, chunk in candidates[:top_k]:
+                # 略過 cross-encoder 的組別沿用第一階段的順序，沒有 reranker 分數
+                score = rerank_by_chunk.get((g, chunk_id))
+                chunks.append(
+                    {
+                        "chunk_id": chunk_id,
+                        "score": round(score, 4) if score is not None else None,
+                        "content": chunk["content"],
+                        "sources": chunk_sources(chunk),
+                    }
+                )
+            results.append(
+                {
+                    "query": rerank_query,
+                    "queries": group_queries,
+                    "chunks": chunks,
+                    "rerank": info,
+                }
+            )
+        print(
+            f"[DEBUG] /retrieve {len(queries)} 個查詢，耗時 (ms): {retrieval_ms}",
+            flush=True,
+        )
+        return {"status": "success", "results": results, "retrieval_ms": retrieval_ms}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"[ERROR] 批次檢索失敗: {e}", flush=True)
+        return JSONResponse(
+            status_code=500, content={"status": "error", "message": str(e)}
+        )
+
+
 # 名詞分析
 @app.post("/noun/analysis")
 def noun_analysis(
@@ -958,6 +2367,10 @@ def query(query: QueryTo, current_user: Dict[str, Any] = Depends(get_current_use
     )
     start_time = time.time()
     try:
+        # 整個查詢都使用同一個 snapshot，索引更新時不受影響
+        sync_snapshot()
+        snap = snapshot
+        index, texts = snap.index, snap.texts
         if index is None or len(texts) == 0:
             print("[ERROR] 尚未建立索引，請先分析文件", flush=True)
             raise HTTPException(status_code=400, detail="尚未建立索引，請先分析文件")
@@ -977,21 +2390,34 @@ def query(query: QueryTo, current_user: Dict[str, Any] = Depends(get_current_use
             query.question + " " + query.keyword if query.question else query.keyword
         )
         print("[DEBUG] q_str: ", q_str, flush=True)
-        q_vec = get_embedding_model().embed_query(q_str)
-        # print("[DEBUG] q_vec: ", q_vec, flush=True)
-        # print("[DEBUG] idx_result_count: ", int(config["idx_result_count"]), flush=True)
-
-        # k值控制向量回傳結果數量,數量越多代表不相干的結果就會越多..通常是設定3~5就好
-        D, I = index.search(
-            np.array([q_vec]).astype("float32"), k=int(config["idx_result_count"])
+        allowed_ids = resolve_allowed_ids(
+            snap, query.source_files, query.markdown_files
         )
 
-        print("[DEBUG] D: ", D, flush=True)
-        print("[DEBUG] I: ", I, flush=True)
+        # 相似的問題已回答過時，直接回傳快取的回覆，不再檢索與生成
+        cache = get_answer_cache(snap)
+        scope = answer_scope(query)
+        question_vec = None
+        if cache is not None and query.question:
+            question_vec = embed_queries_cached([query.question])[0]
+            cached, similarity = cache.find_similar(scope, question_vec)
+            print(f"[DEBUG] 回覆快取最高相似度: {similarity:.4f}", flush=True)
+            if cached is not None:
+                return StreamingResponse(
+                    cached_answer_stream(cached, "semantic", query, current_user),
+                    media_type="application/json",
+                )
+
+        # 向量檢索與 BM25 關鍵字檢索的結果以 reciprocal rank fusion 合併
+        candidate_ids, retrieval_ms, dense_scores = hybrid_search(
+            snap, q_str, int(config["idx_result_count"]), allowed_ids
+        )
 
         #### reranker start ####
-        # 用回傳的向量索引取出原始文字內容
-        candidate_chunks = [texts[i] for i in I[0]]  # texts 是 dict 結構
+        # 用回傳的 chunk id 取出原始文字內容
+        candidates = [(i, texts[i]) for i in candidate_ids]  # texts 是 dict 結構
+        candidate_ids = [i for i, c in candidates if c is not None]
+        candidate_chunks = [c for _, c in candidates if c is not None]
         if not candidate_chunks:
             raise HTTPException(
                 status_code=500, detail="找不到對應的文字內容，請重新建立索引"
@@ -1001,25 +2427,28 @@ def query(query: QueryTo, current_user: Dict[str, Any] = Depends(get_current_use
         #    print("[DEBUG] chunk: ", chunk, flush=True)
         #    print("[DEBUG] ---------- candidate_chunks ----------", flush=True)
 
-        # Rerank
-        top_passages = rerank_with_bge(
+        # Rerank（cascade：第一階段結果已足夠時不使用 cross-encoder）
+        started = time.perf_counter()
+        top_chunks, rerank_info = cascade_rerank(
             query.question,
-            [c["content"] for c in candidate_chunks],
+            snap,
+            candidate_ids,
+            candidate_chunks,
+            dense_scores,
             int(config["rerank_top_k_final"]),
         )
+        retrieval_ms["rerank"] = round((time.perf_counter() - started) * 1000, 2)
 
-        # print("[DEBUG] top_passages: ", top_passages, flush=True)
-        passage_to_chunk = {c["content"]: c for c in candidate_chunks}
         md_files = set()
         src_files = set()
         chunk_context = ""
-        for passage in top_passages:
-            chunk = passage_to_chunk.get(passage)
-            if chunk:
-                md_files.add(chunk["markdown_file"])
-                src_files.add(chunk["source_file"])
-                chunk_context += chunk["content"]
-                # print("[DEBUG] chunk_context: ", chunk_context, flush=True)
+        for chunk in top_chunks:
+            # 重複內容的 chunk 有多個出處，全部列入引用來源
+            for source in chunk_sources(chunk):
+                md_files.add(source["markdown_file"])
+                src_files.add(source["source_file"])
+            chunk_context += chunk["content"]
+            # print("[DEBUG] chunk_context: ", chunk_context, flush=True)
 
         context = chunk_context
 
@@ -1034,12 +2463,32 @@ def query(query: QueryTo, current_user: Dict[str, Any] = Depends(get_current_use
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": query.question},
         ]
+        options = llm_options()
+
+        # 完全相同的 prompt 已回答過時，略過生成
+        exact_key = AnswerCache.exact_key(
+            config["llm_model"], options, system_prompt, query.question, query.think
+        )
+        if cache is not None:
+            cached = cache.get_exact(exact_key)
+            if cached is not None:
+                return StreamingResponse(
+                    cached_answer_stream(cached, "exact", query, current_user),
+                    media_type="application/json",
+                )
 
         def stream_generator():
             try:
                 full_answer = '<i class="fa-solid fa-robot"> 回覆如下 : </i><BR/>'
+                content, thinking = "", ""
                 yield json.dumps(
-                    {"prompt": system_prompt, "answer": "", "thinking": ""}
+                    {
+                        "prompt": system_prompt,
+                        "answer": "",
+                        "thinking": "",
+                        "retrieval_ms": retrieval_ms,
+                        "rerank": rerank_info,
+                    }
                 )  # [:-2]
                 print("start call ollama", flush=True)
                 stream = ollama_client.chat(
@@ -1047,23 +2496,14 @@ def query(query: QueryTo, current_user: Dict[str, Any] = Depends(get_current_use
                     messages=messages,
                     think=query.think,
                     stream=True,
-                    options={
-                        "num_ctx": int(config["num_ctx"]),
-                        "repeat_last_n": int(config["repeat_last_n"]),
-                        "repeat_penalty": float(config["repeat_penalty"]),
-                        "temperature": float(config["temperature"]),
-                        "seed": int(config["seed"]),
-                        "stop": [config["stop"]],
-                        "num_predict": int(config["num_predict"]),
-                        "top_k": int(config["top_k"]),
-                        "top_p": float(config["top_p"]),
-                        "min_p": float(config["min_p"]),
-                    },
+                    options=options,
                 )
                 print("end call ollama", flush=True)
                 for chunk in stream:
                     if chunk and getattr(chunk, "message", None):
                         full_answer += chunk.message.content
+                        content += chunk.message.content
+                        thinking += chunk.message.thinking or ""
                         yield json.dumps(
                             {
                                 "content": chunk.message.content,
@@ -1087,6 +2527,19 @@ def query(query: QueryTo, current_user: Dict[str, Any] = Depends(get_current_use
                 store_conversation(
                     query.conv_id, query.question, full_answer, current_user["id"]
                 )
+                if cache is not None:
+                    cache.put(
+                        exact_key,
+                        scope,
+                        query.question,
+                        question_vec,
+                        {
+                            "prompt": system_prompt,
+                            "content": content,
+                            "thinking": thinking,
+                            "full_answer": full_answer,
+                        },
+                    )
 
             except Exception as e:
                 print(f"[ERROR] 儲存對話記錄失敗: {e}", flush=True)
@@ -0,0 +1,83 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    執行緒安全的記憶體快取，超過 max_entries 時淘汰最久未使用的項目 (LRU)，
+    ttl_seconds > 0 時超過存活時間的項目視為不存在
+    """
+
+    def __init__(self, max_entries=1000, ttl_seconds=0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key → (寫入時間, value)
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_entries, ttl_seconds):
+        with self._lock:
+            self.max_entries = max_entries
+            self.ttl_seconds = ttl_seconds
+            self._evict()
+
+    def _expired(self, stored_at, now):
+        return self.ttl_seconds > 0 and now - stored_at > self.ttl_seconds
+
+    def _evict(self):
+        while len(self._data) > max(self.max_entries, 0):
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or self._expired(item[0], now):
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def items(self):
+        """回傳未過期的 [(key, value)]，不影響 LRU 順序"""
+        now = time.time()
+        with self._lock:
+            expired = [k for k, (t, _) in self._data.items() if self._expired(t, now)]
+            for key in expired:
+                del self._data[key]
+            return [(k, v) for k, (_, v) in self._data.items()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
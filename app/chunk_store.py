@@ -0,0 +1,275 @@
+import os
+import json
+import mmap
+import shutil
+import numpy as np
+
+from collections.abc import Sequence
+
+# chunk store 目錄內的檔案
+TEXT_BLOB_FILE = "text.bin"
+TEXT_OFFSETS_FILE = "text_offsets.npy"
+SOURCE_IDS_FILE = "source_ids.npy"
+SOURCE_OFFSETS_FILE = "source_offsets.npy"
+SOURCES_FILE = "sources.json"
+# reranker 預先斷詞的 passage token ids
+PASSAGE_TOKENS_FILE = "passage_tokens.bin"
+PASSAGE_TOKEN_OFFSETS_FILE = "passage_token_offsets.npy"
+PASSAGE_TOKENS_META_FILE = "passage_tokens.json"
+# 預先斷詞時每批的 chunk 數量
+TOKENIZE_BATCH = 1024
+
+
+def write_chunk_store(path, chunks, tokenizer=None, previous=None, id_map=None):
+    """
+    將 chunk 清單寫成欄式 (columnar) 檔案：
+    - text.bin         所有 chunk 內容 (UTF-8) 串接成連續的 blob
+    - text_offsets.npy   每個 chunk 在 blob 內的起訖位置 (int64, N+1)
+    - source_offsets.npy 每個 chunk 的出處在 source_ids 內的起訖位置 (int64, N+1)，
+                         沒有出處表示已刪除
+    - source_ids.npy     所有 chunk 的出處，對應 sources.json 的索引 (int32)
+    - sources.json       來源檔案清單 [{source_file, markdown_file}]
+    提供 tokenizer (reranker) 時另外寫出 passage 的 token ids，見 write_passage_tokens，
+    previous / id_map 為上一版的 passage token ids 與 chunk id 對應，用來沿用未變動的 chunk
+    先寫到暫存目錄再整個換上，避免其他 process 讀到寫一半的檔案
+    回傳 passage token ids 的 meta，沒有 tokenizer 時為 None
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    sources = []
+    source_lookup = {}
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    source_offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    source_ids = []
+    with open(os.path.join(tmp_path, TEXT_BLOB_FILE), "wb") as blob:
+        position = 0
+        for i, chunk in enumerate(chunks):
+            if chunk is None:
+                # 已刪除的 chunk 保留位置，讓 chunk id 維持不變
+                offsets[i + 1] = position
+                source_offsets[i + 1] = len(source_ids)
+                continue
+            data = chunk["content"].encode("utf-8")
+            blob.write(data)
+            position += len(data)
+            offsets[i + 1] = position
+
+            chunk_sources = chunk.get("sources") or [chunk]
+            for source in chunk_sources:
+                key = (source["source_file"], source["markdown_file"])
+                if key not in source_lookup:
+                    source_lookup[key] = len(sources)
+                    sources.append({"source_file": key[0], "markdown_file": key[1]})
+                source_ids.append(source_lookup[key])
+            source_offsets[i + 1] = len(source_ids)
+
+    np.save(os.path.join(tmp_path, TEXT_OFFSETS_FILE), offsets)
+    np.save(os.path.join(tmp_path, SOURCE_OFFSETS_FILE), source_offsets)
+    np.save(
+        os.path.join(tmp_path, SOURCE_IDS_FILE), np.asarray(source_ids, dtype=np.int32)
+    )
+    with open(os.path.join(tmp_path, SOURCES_FILE), "w", encoding="utf-8") as f:
+        json.dump(sources, f, ensure_ascii=False)
+    meta = None
+    if tokenizer is not None:
+        meta = write_passage_tokens(tmp_path, chunks, tokenizer, previous, id_map)
+
+    # 以 rename 換上新目錄，已開啟 (mmap) 舊檔案的 process 不受影響
+    old_path = path + ".old"
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    return meta
+
+
+def write_passage_tokens(path, chunks, tokenizer, previous=None, id_map=None):
+    """
+    以 reranker 的 tokenizer 預先將 chunk 內容斷詞，查詢時只需對問題斷詞：
+    - passage_tokens.bin             所有 chunk 的 token ids 串接 (int32)
+    - passage_token_offsets.npy      每個 chunk 的起訖位置 (int64, N+1)，已刪除的 chunk 長度為 0
+    - passage_tokens.json            tokenizer 名稱，tokenizer 不同時不使用
+    tokenizer 需提供 model_name 與 tokenize_passages(texts)
+    提供上一版的 passage token ids (previous) 且 tokenizer 相同時直接複製，只對新增的 chunk 斷詞；
+    id_map 為上一版 chunk id 對應到本版的 id（-1 表示已移除），None 表示 id 不變
+    """
+    # 本版 chunk id → 上一版 chunk id，-1 表示需要斷詞
+    reuse = np.full(len(chunks), -1, dtype=np.int64)
+    if previous is not None and previous.tokenizer == tokenizer.model_name:
+        if id_map is None:
+            id_map = np.arange(len(previous), dtype=np.int64)
+        id_map = np.asarray(id_map, dtype=np.int64)
+        if len(id_map) == len(previous) and id_map.max(initial=-1) < len(chunks):
+            old_ids = np.flatnonzero(id_map >= 0)
+            reuse[id_map[old_ids]] = old_ids
+
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    tokenized = reused = 0
+    with open(os.path.join(path, PASSAGE_TOKENS_FILE), "wb") as blob:
+        for start in range(0, len(chunks), TOKENIZE_BATCH):
+            end = min(start + TOKENIZE_BATCH, len(chunks))
+            missing = [
+                i for i in range(start, end) if chunks[i] is not None and reuse[i] < 0
+            ]
+            computed = {}
+            if missing:
+                token_ids = tokenizer.tokenize_passages(
+                    [chunks[i]["content"] for i in missing]
+                )
+                computed = dict(zip(missing, token_ids))
+                tokenized += len(missing)
+            for i in range(start, end):
+                if chunks[i] is None:
+                    offsets[i + 1] = offsets[i]
+                    continue
+                if i in computed:
+                    ids = np.asarray(computed[i], dtype="<i4")
+                else:
+                    ids = previous[reuse[i]]
+                    reused += 1
+                blob.write(ids.astype("<i4", copy=False).tobytes())
+                offsets[i + 1] = offsets[i] + len(ids)
+    print(
+        f"[DEBUG] passage token ids: 沿用 {reused} 個 chunk，"
+        f"斷詞 {tokenized} 個 chunk",
+        flush=True,
+    )
+    np.save(os.path.join(path, PASSAGE_TOKEN_OFFSETS_FILE), offsets)
+    meta = {"tokenizer": tokenizer.model_name, "tokens": int(offsets[-1])}
+    with open(os.path.join(path, PASSAGE_TOKENS_META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return meta
+
+
+class PassageTokens:
+    """唯讀的 passage token ids，pt[i] 回傳 chunk i 的 token ids (int32)"""
+
+    def __init__(self, path, use_mmap=True):
+        with open(
+            os.path.join(path, PASSAGE_TOKENS_META_FILE), "r", encoding="utf-8"
+        ) as f:
+            self.meta = json.load(f)
+        self.tokenizer = self.meta["tokenizer"]
+        mmap_mode = "r" if use_mmap else None
+        self._offsets = np.load(
+            os.path.join(path, PASSAGE_TOKEN_OFFSETS_FILE), mmap_mode=mmap_mode
+        )
+        blob_path = os.path.join(path, PASSAGE_TOKENS_FILE)
+        if use_mmap and os.path.getsize(blob_path) > 0:
+            self._ids = np.memmap(blob_path, dtype="<i4", mode="r")
+        else:
+            self._ids = np.fromfile(blob_path, dtype="<i4")
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return self._ids[int(self._offsets[i]) : int(self._offsets[i + 1])]
+
+
+def load_passage_tokens(path, use_mmap=True):
+    """chunk store 沒有預先斷詞的 token ids 時回傳 None"""
+    if not os.path.exists(os.path.join(path, PASSAGE_TOKENS_META_FILE)):
+        return None
+    return PassageTokens(path, use_mmap=use_mmap)
+
+
+class ChunkStore(Sequence):
+    """
+    唯讀的 chunk store，介面與原本的 texts (list of dict) 相同，已刪除的 chunk 為 None
+    use_mmap=True 時以 mmap 開啟，多個 worker 可共用相同的 page cache，
+    啟動時間也不會隨著 chunk 數量成長
+    """
+
+    def __init__(self, path, use_mmap=True):
+        self.path = path
+        self.use_mmap = use_mmap
+        mmap_mode = "r" if use_mmap else None
+        self._offsets = np.load(
+            os.path.join(path, TEXT_OFFSETS_FILE), mmap_mode=mmap_mode
+        )
+        self._source_offsets = np.load(
+            os.path.join(path, SOURCE_OFFSETS_FILE), mmap_mode=mmap_mode
+        )
+        self._source_ids = np.load(
+            os.path.join(path, SOURCE_IDS_FILE), mmap_mode=mmap_mode
+        )
+        with open(os.path.join(path, SOURCES_FILE), "r", encoding="utf-8") as f:
+            self._sources = json.load(f)
+
+        blob_path = os.path.join(path, TEXT_BLOB_FILE)
+        if use_mmap and os.path.getsize(blob_path) > 0:
+            # mmap 建立後即可關閉檔案，映射會保留到物件被回收為止
+            with open(blob_path, "rb") as f:
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            with open(blob_path, "rb") as f:
+                self._blob = f.read()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("chunk index out of range")
+        source_start = int(self._source_offsets[i])
+        source_end = int(self._source_offsets[i + 1])
+        if source_start == source_end:
+            return None
+        sources = [
+            self._sources[int(s)] for s in self._source_ids[source_start:source_end]
+        ]
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        return {
+            "content": self._blob[start:end].decode("utf-8"),
+            "source_file": sources[0]["source_file"],
+            "markdown_file": sources[0]["markdown_file"],
+            "sources": sources,
+        }
+
+    def source_chunk_ids(self):
+        """回傳 [(出處, 該出處的 chunk ids)]，直接由欄式檔案計算，不需讀取 chunk 內容"""
+        counts = np.diff(self._source_offsets)
+        chunk_of = np.repeat(np.arange(len(self), dtype=np.int64), counts)
+        source_ids = np.asarray(self._source_ids)
+        order = np.argsort(source_ids, kind="stable")
+        chunk_of = chunk_of[order]
+        bounds = np.searchsorted(source_ids[order], np.arange(len(self._sources) + 1))
+        return [
+            (source, chunk_of[bounds[s] : bounds[s + 1]])
+            for s, source in enumerate(self._sources)
+        ]
+
+
+def source_chunk_ids(texts):
+    """
+    每個出處 (source_file, markdown_file) 的 chunk ids（已排序），
+    texts 可以是 ChunkStore 或 list of dict（已刪除的 chunk 為 None）
+    """
+    if isinstance(texts, ChunkStore):
+        return texts.source_chunk_ids()
+    grouped = {}
+    for i, chunk in enumerate(texts):
+        if chunk is None:
+            continue
+        for source in chunk.get("sources") or [chunk]:
+            key = (source["source_file"], source["markdown_file"])
+            grouped.setdefault(key, []).append(i)
+    return [
+        (
+            {"source_file": source_file, "markdown_file": markdown_file},
+            np.asarray(ids, dtype=np.int64),
+        )
+        for (source_file, markdown_file), ids in grouped.items()
+    ]
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import threading
+
+MANIFEST_FILE = ".conversion_manifest.json"
+# 多個 process 寫入 manifest 時以此檔案的 fcntl.flock 互斥
+MANIFEST_LOCK_FILE = ".conversion_manifest.lock"
+# 計算檔案雜湊時每次讀取的大小
+_READ_SIZE = 1024 * 1024
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def options_signature(options_key) -> str:
+    return json.dumps(dict(options_key), sort_keys=True)
+
+
+class ConversionManifest:
+    """
+    記錄來源檔案內容雜湊與轉換結果 (markdown) 的對應
+    - entries: {內容雜湊|pipeline 選項: markdown 檔名與其內容雜湊}，內容與選項都相同時直接使用已轉換的 markdown
+    - files:   {來源檔名: 雜湊, 大小, 修改時間}，檔案大小與修改時間未變時不必重新計算雜湊
+    以檔案內容為鍵，不同檔名但內容相同的檔案也能共用轉換結果
+    多個 process 各自持有一份：儲存時在檔案鎖內重新讀取並合併，只寫入自己變更的項目，
+    不會覆蓋其他 process 已儲存的結果
+    """
+
+    def __init__(self, markdown_dir: str):
+        self.markdown_dir = markdown_dir
+        self.path = os.path.join(markdown_dir, MANIFEST_FILE)
+        self.lock_path = os.path.join(markdown_dir, MANIFEST_LOCK_FILE)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._data = {"entries": {}, "files": {}}
+        # 上次儲存之後本 process 變更的項目
+        self._changed = {"entries": set(), "files": set()}
+        self._data.update(self._read())
+
+    def _read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[WARN] 轉換快取 manifest 無法讀取，重新建立: {e}", flush=True)
+            return {}
+
+    def source_hash(self, filename: str, file_path: str) -> str:
+        stat = os.stat(file_path)
+        with self._lock:
+            known = self._data["files"].get(filename)
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["hash"]
+        digest = file_hash(file_path)
+        with self._lock:
+            self._data["files"][filename] = {
+                "hash": digest,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+            self._changed["files"].add(filename)
+        return digest
+
+    def lookup(self, filename: str, file_path: str, options_key):
+        """
+        回傳 (內容雜湊, 快取的 markdown 檔名, markdown 內容)，沒有快取時後兩者為 None
+        markdown 檔案已被刪除或被其他轉換結果覆寫時視為沒有快取
+        """
+        digest = self.source_hash(filename, file_path)
+        key = f"{digest}|{options_signature(options_key)}"
+        with self._lock:
+            entry = self._data["entries"].get(key)
+        if not entry:
+            return digest, None, None
+        markdown_path = os.path.join(self.markdown_dir, entry["markdown_file"])
+        try:
+            with open(markdown_path, "r", encoding="utf-8") as f:
+                content = f.read()
+        except OSError:
+            return digest, None, None
+        if text_hash(content) != entry["markdown_hash"]:
+            return digest, None, None
+        return digest, entry["markdown_file"], content
+
+    def record(self, digest: str, options_key, markdown_file: str, content: str):
+        key = f"{digest}|{options_signature(options_key)}"
+        with self._lock:
+            self._data["entries"][key] = {
+                "markdown_file": markdown_file,
+                "markdown_hash": text_hash(content),
+            }
+            self._changed["entries"].add(key)
+
+    def duplicates_of(self, filename: str, file_path: str):
+        """回傳與 filename 內容相同的其他來源檔名"""
+        digest = self.source_hash(filename, file_path)
+        with self._lock:
+            return sorted(
+                name
+                for name, info in self._data["files"].items()
+                if name != filename and info["hash"] == digest
+            )
+
+    def save(self):
+        """
+        在檔案鎖內重新讀取磁碟上的 manifest，套用本 process 變更的項目後寫回，
+        其他 process 儲存的項目同時合併進記憶體中的這一份
+        """
+        os.makedirs(self.markdown_dir, exist_ok=True)
+        with self._save_lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                stored = self._read()
+                with self._lock:
+                    changed = self._changed
+                    self._changed = {"entries": set(), "files": set()}
+                    for section, keys in changed.items():
+                        # 本 process 變更的項目優先，其餘以磁碟上的為準
+                        merged = dict(self._data[section])
+                        merged.update(stored.get(section) or {})
+                        merged.update((key, self._data[section][key]) for key in keys)
+                        self._data[section] = merged
+                    data = json.dumps(self._data, ensure_ascii=False)
+                tmp_path = f"{self.path}.{os.getpid()}.{time.time_ns()}.tmp"
+                try:
+                    with open(tmp_path, "w", encoding="utf-8") as f:
+                        f.write(data)
+                    os.replace(tmp_path, self.path)
+                except OSError:
+                    # 寫入失敗時保留變更紀錄，下次儲存再寫入
+                    with self._lock:
+                        for section, keys in changed.items():
+                            self._changed[section] |= keys
+                    raise
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -475,9 +475,161 @@ class LLMRequestDAO:
             return 0
 
 
+class IndexJobDAO:
+    def __init__(self, db_manager: DatabaseManager):
+        self.db_manager = db_manager
+
+    def create_job(self, job_type: str, filenames: str, user_id: int) -> int:
+        """新增一筆排隊中的索引工作，回傳 job_id"""
+        try:
+            connection = self.db_manager.get_connection()
+            with connection.cursor() as cursor:
+                query = """
+                    INSERT INTO index_jobs (job_type, filenames, status, created_by)
+                    VALUES (%s, %s, 'queued', %s)
+                """
+                cursor.execute(query, (job_type, filenames, user_id))
+                job_id = cursor.lastrowid
+            connection.commit()
+            return job_id
+        except Exception as e:
+            logger.error(f"新增索引工作失敗: {e}")
+            return -1
+
+    def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """根據 job_id 取得索引工作"""
+        try:
+            connection = self.db_manager.get_connection()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT * FROM index_jobs WHERE id = %s", (job_id,))
+                result = cursor.fetchone()
+            return result
+        except Exception as e:
+            logger.error(f"取得索引工作 {job_id} 失敗: {e}")
+            return None
+
+    def list_jobs(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """列出最近的索引工作"""
+        try:
+            connection = self.db_manager.get_connection()
+            with connection.cursor() as cursor:
+                query = "SELECT * FROM index_jobs ORDER BY id DESC LIMIT %s"
+                cursor.execute(query, (limit,))
+                results = cursor.fetchall()
+            return results
+        except Exception as e:
+            logger.error(f"列出索引工作失敗: {e}")
+            return []
+
+    def claim_next_job(self, worker: str) -> Optional[Dict[str, Any]]:
+        """
+        取出最早排隊的工作並標記為 running，成功才回傳工作內容
+        同一時間只執行一個工作，避免多個 worker 同時寫入索引
+        """
+        connection = self.db_manager.get_connection()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT id FROM index_jobs WHERE status = 'queued' ORDER BY id ASC LIMIT 1"
+            )
+            row = cursor.fetchone()
+            if not row:
+                return None
+            query = """
+                UPDATE index_jobs
+                SET status = 'running', worker = %s, started_at = NOW(), heartbeat_at = NOW()
+                WHERE id = %s AND status = 'queued'
+                AND (SELECT COUNT(*) FROM (SELECT id FROM index_jobs WHERE status = 'running') AS running) = 0
+            """
+            claimed = cursor.execute(query, (worker, row["id"]))
+        connection.commit()
+        return self.get_job(row["id"]) if claimed else None
+
+    def heartbeat(self, job_id: int, progress: Optional[str] = None) -> bool:
+        """更新 heartbeat（與進度），回傳是否已被要求取消"""
+        connection = self.db_manager.get_connection()
+        with connection.cursor() as cursor:
+            if progress is not None:
+                query = "UPDATE index_jobs SET heartbeat_at = NOW(), progress = %s WHERE id = %s"
+                cursor.execute(query, (progress, job_id))
+            else:
+                query = "UPDATE index_jobs SET heartbeat_at = NOW() WHERE id = %s"
+                cursor.execute(query, (job_id,))
+            cursor.execute(
+                "SELECT cancel_requested FROM index_jobs WHERE id = %s", (job_id,)
+            )
+            result = cursor.fetchone()
+        connection.commit()
+        return bool(result and result["cancel_requested"])
+
+    def finish_job(
+        self,
+        job_id: int,
+        status: str,
+        result: Optional[str] = None,
+        error_message: Optional[str] = None,
+    ):
+        """將工作標記為 completed / failed / cancelled"""
+        try:
+            connection = self.db_manager.get_connection()
+            with connection.cursor() as cursor:
+                query = """
+                    UPDATE index_jobs
+                    SET status = %s, result = %s, error_message = %s, finished_at = NOW()
+                    WHERE id = %s
+                """
+                cursor.execute(query, (status, result, error_message, job_id))
+            connection.commit()
+        except Exception as e:
+            logger.error(f"標記索引工作 {job_id} 結束失敗: {e}")
+
+    def request_cancel(self, job_id: int) -> bool:
+        """要求取消工作；尚未開始的工作直接取消，執行中的工作由 worker 在下個檢查點停止"""
+        try:
+            connection = self.db_manager.get_connection()
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE index_jobs SET status = 'cancelled', cancel_requested = TRUE, "
+                    "finished_at = NOW() WHERE id = %s AND status = 'queued'",
+                    (job_id,),
+                )
+                updated = cursor.execute(
+                    "UPDATE index_jobs SET cancel_requested = TRUE "
+                    "WHERE id = %s AND status IN ('cancelled', 'running')",
+                    (job_id,),
+                )
+            connection.commit()
+            return updated > 0
+        except Exception as e:
+            logger.error(f"取消索引工作 {job_id} 失敗: {e}")
+            return False
+
+    def requeue_stale_jobs(self, stale_seconds: int) -> int:
+        """將超過 stale_seconds 沒有 heartbeat 的執行中工作重新排隊，回傳筆數"""
+        connection = self.db_manager.get_connection()
+        with connection.cursor() as cursor:
+            query = """
+                UPDATE index_jobs SET status = 'queued', worker = NULL
+                WHERE status = 'running' AND cancel_requested = FALSE
+                AND heartbeat_at < NOW() - INTERVAL %s SECOND
+            """
+            requeued = cursor.execute(query, (stale_seconds,))
+            # 中斷前已要求取消的工作直接標記為取消
+            cursor.execute(
+                """
+                UPDATE index_jobs SET status = 'cancelled', finished_at = NOW()
+                WHERE status = 'running' AND cancel_requested = TRUE
+                AND heartbeat_at < NOW() - INTERVAL %s SECOND
+                """,
+                (stale_seconds,),
+            )
+        connection.commit()
+        return requeued
+
+
 # 全域資料庫管理器
 db_manager = DatabaseManager()
 config_dao = ConfigDAO(db_manager)
 conversation_dao = ConversationDAO(db_manager)
 user_dao = UserDAO(db_manager)
 llm_request_dao = LLMRequestDAO(db_manager)
+index_job_dao = IndexJobDAO(db_manager)
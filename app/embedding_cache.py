@@ -0,0 +1,156 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+
+# SQLite 單一語句可用的參數數量有限，分批查詢
+_SQL_BATCH = 500
+# 超過上限時一次淘汰到上限的此比例，之後可再寫入一段時間才需要再淘汰
+_EVICT_TARGET = 0.9
+# 隨機抽樣時最多查詢的輪數
+_SAMPLE_ROUNDS = 4
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    磁碟上的 embedding 快取，以 (embedding 模型名稱, chunk 內容雜湊) 為鍵
+    超過 max_entries 時依最後使用時間淘汰最舊的資料 (LRU)
+    筆數以寫入次數累計估算（重複寫入同一筆也會計入，只會高估），
+    估計值超過上限時才以 COUNT(*) 取得實際筆數，避免每次寫入都掃描整個資料表
+    """
+
+    def __init__(self, path, max_entries=500000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    dim INTEGER NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, hash)
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings (last_used)"
+            )
+            self._conn.commit()
+            self._count = self._exact_count()
+
+    def _exact_count(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return count
+
+    def get_many(self, model, hashes):
+        """回傳 {hash: vector}，只包含快取中存在的項目"""
+        found = {}
+        hashes = list(set(hashes))
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(hashes), _SQL_BATCH):
+                batch = hashes[start : start + _SQL_BATCH]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({marks})",
+                    [model, *batch],
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype="float32")
+                if rows:
+                    hit_marks = ",".join("?" * len(rows))
+                    self._conn.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE model = ? AND hash IN ({hit_marks})",
+                        [now, model, *[h for h, _ in rows]],
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, model, items):
+        """items: [(hash, vector)]"""
+        if not items:
+            return
+        now = time.time()
+        rows = [
+            (model, h, len(vec), np.asarray(vec, dtype="float32").tobytes(), now)
+            for h, vec in items
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, dim, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._count += len(rows)
+            if self._count > self.max_entries:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # 其他 worker 也會寫入同一個檔案，淘汰前重新取得實際筆數
+        self._count = self._exact_count()
+        if self._count <= self.max_entries:
+            return
+        overflow = self._count - int(self.max_entries * _EVICT_TARGET)
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN "
+                "(SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                (overflow,),
+            )
+            self._count -= overflow
+            print(f"[DEBUG] embedding 快取淘汰 {overflow} 筆", flush=True)
+
+    def count(self):
+        with self._lock:
+            self._count = self._exact_count()
+            return self._count
+
+    def sample(self, model, n):
+        """
+        隨機取出最多 n 筆向量，供索引儲存格式評估使用
+        以 rowid 範圍內的隨機值直接查詢主鍵，不對整個資料表排序 (ORDER BY RANDOM())
+        """
+        rng = np.random.default_rng()
+        found = {}
+        with self._lock:
+            lo, hi = self._conn.execute(
+                "SELECT MIN(rowid), MAX(rowid) FROM embeddings"
+            ).fetchone()
+            if lo is None:
+                return None
+            if hi - lo + 1 <= n * 2:
+                # 資料量與樣本數相近時直接全部取出
+                rows = self._conn.execute(
+                    "SELECT rowid, vector FROM embeddings WHERE model = ? LIMIT ?",
+                    (model, n),
+                ).fetchall()
+                found.update(rows)
+            for _ in range(_SAMPLE_ROUNDS):
+                need = n - len(found)
+                if need <= 0:
+                    break
+                # 淘汰後 rowid 會有空洞，多抽一些再補足
+                candidates = np.unique(rng.integers(lo, hi + 1, size=need * 2))
+                candidates = [int(r) for r in candidates if int(r) not in found]
+                for start in range(0, len(candidates), _SQL_BATCH):
+                    batch = candidates[start : start + _SQL_BATCH]
+                    marks = ",".join("?" * len(batch))
+                    rows = self._conn.execute(
+                        f"SELECT rowid, vector FROM embeddings WHERE model = ? AND rowid IN ({marks})",
+                        [model, *batch],
+                    ).fetchall()
+                    found.update(rows)
+        if not found:
+            return None
+        blobs = list(found.values())[:n]
+        return np.vstack([np.frombuffer(blob, dtype="float32") for blob in blobs])
@@ -0,0 +1,125 @@
+import time
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+
+class EmbeddingEngine:
+    """
+    以 SentenceTransformer 計算 embedding，取代 LangChain HuggingFaceEmbeddings 的預設批次
+    - 每段文字只斷詞一次，依 token 長度排序後分批，同一批的長度相近，padding 較少
+    - 每批的結果直接寫入預先配置的 float32 陣列，不經過 Python list
+    - 輸出一律正規化為單位向量，與 l2_to_cosine 及 cascade 的相似度門檻一致
+    - 每次計算記錄 chunk 數量、耗時與 chunks/s (last_run)
+    """
+
+    def __init__(self, model_name, device, batch_size=32, num_threads=0):
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name, device=str(device))
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.last_run = None
+        self.configure(batch_size, num_threads)
+
+    def configure(self, batch_size, num_threads=0):
+        self.batch_size = max(int(batch_size), 1)
+        # 0 表示使用 torch 預設的執行緒數量
+        if num_threads > 0 and torch.get_num_threads() != num_threads:
+            torch.set_num_threads(num_threads)
+            print(f"[DEBUG] torch 執行緒數量設為 {num_threads}", flush=True)
+
+    def tokenize(self, texts):
+        """
+        與 SentenceTransformer 相同的方式斷詞（不 padding），超過模型上限的部分截斷
+        第一個模組沒有 tokenizer（非 Transformer 模型）時回傳 None
+        """
+        module = self.model[0]
+        tokenizer = getattr(module, "tokenizer", None)
+        if tokenizer is None:
+            return None
+        texts = [str(text).strip() for text in texts]
+        if getattr(module, "do_lower_case", False):
+            texts = [text.lower() for text in texts]
+        return tokenizer(
+            texts,
+            truncation=True,
+            max_length=self.model.get_max_seq_length(),
+            padding=False,
+        )
+
+    def embed_documents(self, texts):
+        """
+        回傳 shape 為 (len(texts), dimension) 的 float32 單位向量，順序與 texts 相同
+        斷詞結果依 token 長度由長到短分批（長的先算，記憶體不足時能及早發現），
+        每批只做 padding 與模型推理，不再重新斷詞
+        """
+        started = time.perf_counter()
+        vectors = np.empty((len(texts), self.dimension), dtype="float32")
+        encoded = self.tokenize(texts) if len(texts) else None
+        if encoded is None:
+            if len(texts):
+                vectors[:] = self.model.encode(
+                    list(texts),
+                    batch_size=self.batch_size,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False,
+                )
+        else:
+            tokenizer = self.model[0].tokenizer
+            lengths = np.fromiter(map(len, encoded["input_ids"]), np.int64, len(texts))
+            order = np.argsort(-lengths, kind="stable")
+            with torch.inference_mode():
+                for start in range(0, len(order), self.batch_size):
+                    batch = order[start : start + self.batch_size]
+                    features = tokenizer.pad(
+                        {key: [encoded[key][i] for i in batch] for key in encoded},
+                        padding=True,
+                        return_tensors="pt",
+                    )
+                    features = {
+                        key: value.to(self.model.device)
+                        for key, value in features.items()
+                    }
+                    embeddings = self.model(features)["sentence_embedding"]
+                    embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+                    vectors[batch] = embeddings.float().cpu().numpy()
+        elapsed = time.perf_counter() - started
+        self.last_run = {
+            "chunks": len(texts),
+            "seconds": round(elapsed, 3),
+            "chunks_per_sec": round(len(texts) / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+        print(
+            f"[DEBUG] embedding {len(texts)} 筆，{self.last_run['seconds']} 秒，"
+            f"{self.last_run['chunks_per_sec']} chunks/s",
+            flush=True,
+        )
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts):
+        """多個查詢一次計算，回傳 shape 為 (len(texts), dimension) 的 float32 單位向量"""
+        return self.model.encode(
+            list(texts),
+            batch_size=max(len(texts), 1),
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        ).astype("float32", copy=False)
+
+
+def normalize_rows(vectors):
+    """將每一列正規化為單位向量（L2 距離才能換算成 cosine 相似度），零向量維持不變"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+def embedding_throughput(chunks, seconds):
+    return {
+        "chunks": chunks,
+        "seconds": round(seconds, 3),
+        "chunks_per_sec": round(chunks / seconds, 2) if seconds > 0 else 0.0,
+    }
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import socket
+import threading
+import traceback
+
+# 工作類型
+JOB_TYPE_FILES = "files"  # 依勾選的檔案逐一建立索引
+JOB_TYPE_REBUILD = "rebuild"  # 以目錄內全部檔案重建索引
+JOB_TYPE_REMOVE = "remove"  # 從索引移除勾選的檔案
+JOB_TYPE_COMPACT = "compact"  # 回收已刪除 chunk 的位置
+
+# 每個檔案的處理階段，依序為 queued → convert → chunk → embed → add → done
+STAGE_QUEUED = "queued"
+STAGE_CONVERT = "convert"
+STAGE_CHUNK = "chunk"
+STAGE_EMBED = "embed"
+STAGE_ADD = "add"
+STAGE_DONE = "done"
+STAGE_FAILED = "failed"
+
+# 已結束的工作狀態
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    """工作已被要求取消"""
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobProgress:
+    """
+    工作進度：每個檔案的階段、已處理的 chunk 數量、吞吐量 (chunks/s) 與預估剩餘時間
+    進度先記錄在記憶體，由背景執行緒定期寫回資料庫（同時更新 heartbeat 並讀取取消旗標）
+    """
+
+    def __init__(self, job_dao, job, flush_interval=2.0):
+        self.job_dao = job_dao
+        self.job_id = job["id"]
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._dirty = True
+        self.cancelled = False
+
+        previous = parse_json(job.get("progress")) or {}
+        # 重新啟動後接續執行時，保留已完成檔案的紀錄
+        self.files = previous.get("files") or {}
+        for filename in parse_json(job.get("filenames")) or []:
+            self.files.setdefault(filename, {"stage": STAGE_QUEUED})
+        self.total_chunks = 0
+        self.done_chunks = 0
+        self.started_at = time.time()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def file_stage(self, filename):
+        return self.files.get(filename, {}).get("stage")
+
+    def set_stage(self, filenames, stage, **info):
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        with self._lock:
+            for filename in filenames:
+                entry = self.files.setdefault(filename, {})
+                entry.update(info, stage=stage, updated_at=time.time())
+            self._dirty = True
+        print(f"[DEBUG] 索引工作 {self.job_id}: {list(filenames)} → {stage}", flush=True)
+
+    def add_total_chunks(self, count):
+        with self._lock:
+            self.total_chunks += count
+            self._dirty = True
+
+    def add_done_chunks(self, count):
+        with self._lock:
+            self.done_chunks += count
+            self._dirty = True
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(f"索引工作 {self.job_id} 已取消")
+
+    def to_dict(self):
+        with self._lock:
+            elapsed = time.time() - self.started_at
+            files = {name: dict(entry) for name, entry in self.files.items()}
+            total_chunks, done_chunks = self.total_chunks, self.done_chunks
+        finished = sum(
+            1 for entry in files.values() if entry["stage"] in (STAGE_DONE, STAGE_FAILED)
+        )
+        chunks_per_sec = done_chunks / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if total_chunks > done_chunks and chunks_per_sec > 0:
+            # 正在計算向量時，以 chunk 吞吐量估計
+            eta = (total_chunks - done_chunks) / chunks_per_sec
+        elif 0 < finished < len(files):
+            # 其餘時間以已完成檔案的平均耗時估計
+            eta = elapsed / finished * (len(files) - finished)
+        return {
+            "files": files,
+            "total_files": len(files),
+            "finished_files": finished,
+            "total_chunks": total_chunks,
+            "done_chunks": done_chunks,
+            "chunks_per_sec": round(chunks_per_sec, 2),
+            "elapsed_seconds": round(elapsed, 1),
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+        }
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, False
+        progress = json.dumps(self.to_dict(), ensure_ascii=False) if dirty else None
+        # 沒有變更時仍需更新 heartbeat，讓其他 worker 知道工作還在執行
+        if self.job_dao.heartbeat(self.job_id, progress):
+            self.cancelled = True
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[ERROR] 寫入索引工作進度失敗: {e}", flush=True)
+
+
+class IndexJobWorker:
+    """
+    背景執行緒，從資料庫依序取出排隊中的索引工作交給 handler 執行
+    handler(job, progress) 回傳工作結果 (dict)，過程中應定期呼叫 progress.check_cancelled()
+    超過 stale_seconds 沒有 heartbeat 的執行中工作（例如後端重啟）會重新排隊
+    """
+
+    def __init__(self, job_dao, handler, poll_interval=2.0, stale_seconds=60):
+        self.job_dao = job_dao
+        self.handler = handler
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self.name = worker_name()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, name="index-job-worker", daemon=True
+        )
+        self._thread.start()
+        print(f"[DEBUG] 索引工作 worker 已啟動: {self.name}", flush=True)
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                requeued = self.job_dao.requeue_stale_jobs(self.stale_seconds)
+                if requeued:
+                    print(f"[WARN] 重新排隊中斷的索引工作 {requeued} 筆", flush=True)
+                job = self.job_dao.claim_next_job(self.name)
+            except Exception as e:
+                print(f"[ERROR] 取得索引工作失敗: {e}", flush=True)
+                job = None
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job):
+        job_id = job["id"]
+        print(f"[DEBUG] 開始執行索引工作 {job_id} ({job['job_type']})", flush=True)
+        progress = JobProgress(self.job_dao, job)
+        progress.start()
+        status, result, error_message = "completed", None, None
+        try:
+            progress.flush()
+            progress.check_cancelled()
+            result = self.handler(job, progress)
+        except JobCancelled as e:
+            status, error_message = "cancelled", str(e)
+        except Exception as e:
+            traceback.print_exc()
+            status, error_message = "failed", str(e)
+        finally:
+            progress.stop()
+        self.job_dao.finish_job(
+            job_id,
+            status,
+            json.dumps(result, ensure_ascii=False) if result is not None else None,
+            error_message,
+        )
+        print(f"[DEBUG] 索引工作 {job_id} 結束: {status}", flush=True)
+
+
+def parse_json(value):
+    if not value:
+        return None
+    if isinstance(value, (dict, list)):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+
+def format_job(job):
+    """將資料庫的工作紀錄轉為 API 回傳格式"""
+    if job is None:
+        return None
+    return {
+        "job_id": job["id"],
+        "job_type": job["job_type"],
+        "status": job["status"],
+        "cancel_requested": bool(job.get("cancel_requested")),
+        "filenames": parse_json(job.get("filenames")) or [],
+        "progress": parse_json(job.get("progress")) or {},
+        "result": parse_json(job.get("result")),
+        "error_message": job.get("error_message"),
+        "worker": job.get("worker"),
+        "created_at": job.get("created_at"),
+        "started_at": job.get("started_at"),
+        "finished_at": job.get("finished_at"),
+    }
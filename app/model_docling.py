@@ -1,13 +1,21 @@
 import os
+import time
 import logging
+import itertools
+import threading
+import multiprocessing
 from typing import Optional
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 from docling.document_converter import DocumentConverter, PdfFormatOption
 from docling.datamodel.pipeline_options import PdfPipelineOptions
 from docling.datamodel.base_models import InputFormat
 from docling_core.types.doc import  TextItem
 
+from app.conversion_cache import ConversionManifest
+
 # /backend/app
 BASE_DIR = os.path.dirname(__file__)
 # /backend/documents
@@ -18,6 +26,31 @@ MD_PATH = os.path.join(DOC_PATH, "markdown")
 config = {}
 _log = logging.getLogger(__name__)
 
+# 轉換用的 process pool
+_conversion_pool = None
+_conversion_pool_workers = 0
+# worker 開始轉換時把工作編號送回主程式，由背景執行緒呼叫登記的 callback
+_started_queue = None
+_started_callbacks = {}
+_task_ids = itertools.count()
+
+# 常駐的 DocumentConverter，以 pipeline 選項為鍵，選項相同的呼叫共用已載入的模型
+MAX_CONVERTERS = 4
+_converters = {}
+_converters_lock = threading.Lock()
+
+# 只用於判斷頁面是否需要 OCR 的選項，不影響 converter 本身
+PLANNING_OPTIONS = ("ocr_auto", "text_layer_min_chars")
+# 少於此頁數的連續文字頁不單獨轉換，併入前後的 OCR 頁面
+MIN_TEXT_RUN_PAGES = 3
+
+# 來源檔案內容雜湊 → 已轉換 markdown 的對應，內容未變更的檔案不再重新轉換
+_conversion_manifest = None
+# 每記錄幾筆轉換結果寫回一次 manifest
+MANIFEST_SAVE_INTERVAL = 20
+# 每個 worker 最多同時送出的轉換工作數，呼叫端處理較慢時不再送出新工作（backpressure）
+INFLIGHT_PER_WORKER = 2
+
 def load_config():
     global config
     try:
@@ -67,61 +100,617 @@ def output_picture_as_markdown_table(doc, picture):
 
 
 
-# Docling API 文件擷取
-def convert_file_via_docling(file_path: str, filename: str) -> Optional[dict]:
+def pipeline_options_key(app_config=None) -> tuple:
+    """由 docling 相關配置產生 pipeline 選項，作為 converter 的鍵"""
+    source = config if app_config is None else app_config
+
+    def flag(key, default):
+        return str(source.get(key, default)).lower() == "true"
+
+    return (
+        ("images_scale", float(source.get("docling_images_scale", 2))),
+        ("do_ocr", flag("docling_do_ocr", "True")),
+        ("do_table_structure", flag("docling_do_table_structure", "True")),
+        ("generate_page_images", True),
+        ("ocr_auto", flag("docling_ocr_auto", "True")),
+        (
+            "text_layer_min_chars",
+            int(source.get("docling_text_layer_min_chars", 32)),
+        ),
+    )
+
+
+def converter_key(options_key: tuple, **overrides) -> tuple:
+    """去掉只影響頁面分流判斷的選項，得到建立 converter 用的鍵"""
+    options = dict(options_key)
+    for key in PLANNING_OPTIONS:
+        options.pop(key, None)
+    options.update(overrides)
+    return tuple(options.items())
+
+
+def open_pdf(file_path: str):
+    """以 pypdfium2 開啟 PDF，非 PDF 或無法開啟時回傳 None"""
+    if not file_path.lower().endswith(".pdf"):
+        return None
     try:
-        load_config()
-        print("========== file_path==========")
-        print(file_path)
-        print("========== filename==========")
-        print(filename)
+        import pypdfium2 as pdfium
+    except ImportError:
+        print("[WARN] 未安裝 pypdfium2，無法讀取 PDF 頁面資訊", flush=True)
+        return None
+    try:
+        return pdfium.PdfDocument(file_path)
+    except Exception as e:
+        print(f"[WARN] 無法開啟 {file_path}：{e}", flush=True)
+        return None
+
+
+def pdf_page_count(file_path: str) -> Optional[int]:
+    pdf = open_pdf(file_path)
+    if pdf is None:
+        return None
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def detect_text_layer(
+    file_path: str, min_chars: int, page_range: Optional[tuple] = None
+) -> Optional[list]:
+    """
+    以 pypdfium2 讀取 PDF 每頁內嵌的文字層，回傳每頁是否有可用的文字（True 表示不需 OCR）
+    page_range 為 docling 格式（從 1 開始且包含結尾頁），非 PDF 或無法讀取時回傳 None
+    """
+    pdf = open_pdf(file_path)
+    if pdf is None:
+        return None
+    try:
+        first, last = page_range or (1, len(pdf))
+        has_text = []
+        for i in range(first - 1, min(last, len(pdf))):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            text = textpage.get_text_range()
+            textpage.close()
+            page.close()
+            chars = sum(1 for c in text if not c.isspace())
+            # 字型沒有 unicode 對應時會擷取出 U+FFFD 或控制字元，這種文字層不可用
+            broken = sum(
+                1 for c in text if c == "\ufffd" or (ord(c) < 32 and not c.isspace())
+            )
+            has_text.append(chars >= min_chars and broken <= chars * 0.1)
+        return has_text
+    finally:
+        pdf.close()
 
-        # 透過原生 Docling LIB 處理
-        pipeline_options = PdfPipelineOptions()
-        pipeline_options.images_scale = 2
-        pipeline_options.generate_page_images = True
-        pipeline_options.do_ocr = True
-        pipeline_options.do_table_structure = True
-        pipeline_options.table_structure_options.do_cell_matching = True
-        # pipeline_options.generate_picture_images = True
-        doc_converter = DocumentConverter(
-            format_options={
-                InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
-            }
+
+def plan_page_runs(file_path: str, options_key: tuple, page_range=None):
+    """
+    依每頁是否有文字層決定轉換方式，回傳 ([(page_range, converter 鍵)], 頁數統計)
+    有文字層的頁面關閉 OCR 與頁面影像；page_range 為 None 表示整份文件使用同一個 converter
+    指定 page_range 時只處理該範圍（分片轉換）
+    """
+    options = dict(options_key)
+    ocr_key = converter_key(options_key)
+    if not options["do_ocr"] or not options["ocr_auto"]:
+        return [(page_range, ocr_key)], None
+    has_text = detect_text_layer(file_path, options["text_layer_min_chars"], page_range)
+    if not has_text:
+        return [(page_range, ocr_key)], None
+    text_key = converter_key(options_key, do_ocr=False, generate_page_images=False)
+    first_page = page_range[0] if page_range else 1
+
+    # 連續相同處理方式的頁面合併成一段 [start, end)
+    runs = []
+    for page_no, text_layer in enumerate(has_text):
+        if runs and runs[-1][2] == text_layer:
+            runs[-1][1] = page_no + 1
+        else:
+            runs.append([page_no, page_no + 1, text_layer])
+    # 夾在需要 OCR 頁面之間的零星文字頁併入 OCR，避免切成太多段
+    for run in runs:
+        if run[2] and run[1] - run[0] < MIN_TEXT_RUN_PAGES and len(runs) > 1:
+            run[2] = False
+    merged = []
+    for start, end, text_layer in runs:
+        if merged and merged[-1][2] == text_layer:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end, text_layer])
+
+    text_pages = sum(end - start for start, end, text_layer in merged if text_layer)
+    stats = {
+        "total": len(has_text),
+        "text_layer": text_pages,
+        "ocr": len(has_text) - text_pages,
+    }
+    if len(merged) == 1:
+        return [(page_range, text_key if merged[0][2] else ocr_key)], stats
+    # docling 的 page_range 從 1 開始且包含結尾頁
+    return [
+        (
+            (first_page + start, first_page + end - 1),
+            text_key if text_layer else ocr_key,
         )
-        result = doc_converter.convert(file_path)
-        mdtext = result.document.export_to_markdown()
-        mdtext += mdtext + "\n"
-        
-        print("========== mdtext ==========")
-        print(mdtext)
+        for start, end, text_layer in merged
+    ], stats
+
+
+def build_document_converter(options_key: tuple):
+    # 透過原生 Docling LIB 處理
+    options = dict(options_key)
+    pipeline_options = PdfPipelineOptions()
+    pipeline_options.images_scale = options["images_scale"]
+    pipeline_options.generate_page_images = options["generate_page_images"]
+    pipeline_options.do_ocr = options["do_ocr"]
+    pipeline_options.do_table_structure = options["do_table_structure"]
+    pipeline_options.table_structure_options.do_cell_matching = True
+    # pipeline_options.generate_picture_images = True
+    doc_converter = DocumentConverter(
+        format_options={
+            InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
+        }
+    )
+    # 先載入 layout / OCR / table 模型，避免第一個檔案的轉換時間包含模型載入
+    doc_converter.initialize_pipeline(InputFormat.PDF)
+    return doc_converter
 
+
+def get_document_converter(options_key: tuple):
+    """
+    取得對應 pipeline 選項的 converter，不存在時才建立
+    回傳 (converter, 本次載入模型花費的秒數)
+    """
+    with _converters_lock:
+        converter = _converters.pop(options_key, None)
+        load_seconds = 0.0
+        if converter is None:
+            start = time.perf_counter()
+            converter = build_document_converter(options_key)
+            load_seconds = time.perf_counter() - start
+            print(
+                f"[DEBUG] 已建立 docling converter {dict(options_key)}，"
+                f"載入模型 {load_seconds:.1f} 秒",
+                flush=True,
+            )
+        # 重新放到最後，超過上限時淘汰最久沒用到的 converter
+        _converters[options_key] = converter
+        while len(_converters) > MAX_CONVERTERS:
+            del _converters[next(iter(_converters))]
+        return converter, load_seconds
+
+
+def convert_pages(file_path: str, options_key: tuple, page_range=None) -> dict:
+    """
+    轉換整份文件或指定的頁面範圍，回傳 markdown 片段、圖片表格與統計
+    分片轉換時各範圍的結果依頁序以 merge_conversion 合併
+    """
+    start = time.perf_counter()
+    load_seconds = 0.0
+    # 有文字層的頁面不做 OCR，其餘頁面照原本方式處理
+    page_runs, page_stats = plan_page_runs(file_path, options_key, page_range)
+    if page_stats:
+        print(f"[DEBUG] {file_path} {page_range or ''} 頁面處理方式: {page_stats}", flush=True)
+    md_parts = []
+    picture_parts = []
+    for run_range, run_key in page_runs:
+        doc_converter, run_load_seconds = get_document_converter(run_key)
+        load_seconds += run_load_seconds
+        if run_range is None:
+            result = doc_converter.convert(file_path)
+        else:
+            result = doc_converter.convert(file_path, page_range=run_range)
         doc = result.document
+        md_parts.append(doc.export_to_markdown())
 
         #mdtext += picture.export_to_markdown()
         for picture in doc.pictures:
             md_lines = output_picture_as_markdown_table(doc, picture)
-            mdtext += "\n".join(md_lines) + "\n\n"
-
-        # 新增：儲存 markdown 內容到 documents/markdown/ 目錄
-        markdown_dir = os.path.join(MD_PATH)
-        os.makedirs(markdown_dir, exist_ok=True)
-        markdown_filename = f"{filename}.md"
-        markdown_path = os.path.join(markdown_dir, markdown_filename)
-        with open(markdown_path, "w", encoding="utf-8") as md_file:
-            md_file.write(mdtext)
-
-        if not mdtext:
-            print(f"[WARN] 無法擷取內容：{filename}", flush=True)
-            return None
-
-        # 回傳 dict 結構，包含內容與檔案資訊
-        return {
-            "content": mdtext ,
-            "source_file": filename,
-            "markdown_file": markdown_filename
+            picture_parts.append("\n".join(md_lines) + "\n\n")
+    return {
+        "markdown": md_parts,
+        "pictures": picture_parts,
+        "pages": page_stats,
+        "load_seconds": load_seconds,
+        "convert_seconds": time.perf_counter() - start - load_seconds,
+        # 在 process pool 內執行時為 worker 的 pid，模型載入只發生在各 worker 第一次使用時
+        "worker": os.getpid(),
+    }
+
+
+def merge_conversion(filename: str, parts: list) -> Optional[dict]:
+    """
+    依頁序合併 convert_pages 的結果並寫出 markdown
+    圖片轉成的表格與未分片時相同，統一接在全文之後
+    """
+    md_parts = [md for part in parts for md in part["markdown"]]
+    picture_parts = [picture for part in parts for picture in part["pictures"]]
+    mdtext = "\n\n".join(md_parts) + "\n" + "".join(picture_parts)
+
+    print("========== mdtext ==========")
+    print(mdtext)
+
+    # 新增：儲存 markdown 內容到 documents/markdown/ 目錄
+    markdown_dir = os.path.join(MD_PATH)
+    os.makedirs(markdown_dir, exist_ok=True)
+    markdown_filename = f"{filename}.md"
+    markdown_path = os.path.join(markdown_dir, markdown_filename)
+    with open(markdown_path, "w", encoding="utf-8") as md_file:
+        md_file.write(mdtext)
+
+    if not mdtext:
+        print(f"[WARN] 無法擷取內容：{filename}", flush=True)
+        return None
+
+    load_seconds = sum(part["load_seconds"] for part in parts)
+    convert_seconds = sum(part["convert_seconds"] for part in parts)
+    workers = {}
+    for part in parts:
+        worker = workers.setdefault(
+            str(part["worker"]),
+            {"model_load_seconds": 0.0, "convert_seconds": 0.0, "shards": 0},
+        )
+        worker["model_load_seconds"] += part["load_seconds"]
+        worker["convert_seconds"] += part["convert_seconds"]
+        worker["shards"] += 1
+    for worker in workers.values():
+        worker["model_load_seconds"] = round(worker["model_load_seconds"], 2)
+        worker["convert_seconds"] = round(worker["convert_seconds"], 2)
+    print(
+        f"[DEBUG] {filename} 轉換 {convert_seconds:.1f} 秒"
+        f"（模型載入 {load_seconds:.1f} 秒，{len(parts)} 個分片）",
+        flush=True,
+    )
+    page_stats = None
+    if all(part["pages"] for part in parts):
+        page_stats = {
+            key: sum(part["pages"][key] for part in parts)
+            for key in ("total", "text_layer", "ocr")
         }
+
+    # 回傳 dict 結構，包含內容與檔案資訊
+    return {
+        "content": mdtext ,
+        "source_file": filename,
+        "markdown_file": markdown_filename,
+        "timing": {
+            "model_load_seconds": round(load_seconds, 2),
+            "convert_seconds": round(convert_seconds, 2),
+            "shards": len(parts),
+            "workers": workers,
+        },
+        "pages": page_stats,
+    }
+
+
+def summarize_conversion_timing(timings) -> dict:
+    """
+    合併一批檔案的轉換耗時 (result["timing"])，依 worker 分開統計模型載入與轉換時間，
+    供索引工作結果顯示；快取命中的檔案沒有轉換，不列入統計
+    """
+    summary = {"model_load_seconds": 0.0, "convert_seconds": 0.0, "workers": {}}
+    for timing in timings:
+        for pid, worker in (timing.get("workers") or {}).items():
+            total = summary["workers"].setdefault(
+                pid, {"model_load_seconds": 0.0, "convert_seconds": 0.0, "shards": 0}
+            )
+            for key in total:
+                total[key] += worker[key]
+    for total in summary["workers"].values():
+        summary["model_load_seconds"] += total["model_load_seconds"]
+        summary["convert_seconds"] += total["convert_seconds"]
+        total["model_load_seconds"] = round(total["model_load_seconds"], 2)
+        total["convert_seconds"] = round(total["convert_seconds"], 2)
+    summary["model_load_seconds"] = round(summary["model_load_seconds"], 2)
+    summary["convert_seconds"] = round(summary["convert_seconds"], 2)
+    return summary
+
+
+# Docling API 文件擷取
+def convert_file_via_docling(
+    file_path: str, filename: str, options_key: Optional[tuple] = None
+) -> Optional[dict]:
+    try:
+        if options_key is None:
+            options_key = pipeline_options_key()
+        print("========== file_path==========")
+        print(file_path)
+        print("========== filename==========")
+        print(filename)
+        return merge_conversion(filename, [convert_pages(file_path, options_key)])
     except Exception as e:
         print(f"[ERROR] 處理 {filename} 時發生例外：{e}", flush=True)
         return None
 
+
+def shard_page_ranges(file_path: str, shard_pages: int) -> Optional[list]:
+    """頁數超過 shard_pages 的 PDF 切成多個頁面範圍，不需分片時回傳 None"""
+    if shard_pages <= 0:
+        return None
+    page_count = pdf_page_count(file_path)
+    if not page_count or page_count <= shard_pages:
+        return None
+    return [
+        (first, min(first + shard_pages - 1, page_count))
+        for first in range(1, page_count + 1, shard_pages)
+    ]
+
+
+def get_conversion_workers(app_config=None) -> int:
+    # docling_workers = 0 時使用全部 CPU 核心
+    source = config if app_config is None else app_config
+    workers = int(source.get("docling_workers", 2))
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def _init_conversion_worker(options_key, started_queue):
+    """worker process 啟動時先建立 converter，之後的檔案共用已載入的模型"""
+    global _started_queue
+    _started_queue = started_queue
+    get_document_converter(converter_key(options_key))
+    print(f"[DEBUG] docling worker {os.getpid()} 已就緒", flush=True)
+
+
+def _convert_in_worker(
+    file_path: str, options_key: tuple, page_range=None, task_id=None
+):
+    # 選項變更時 worker 內的 registry 會自行建立新的 converter，不需重建 pool
+    if task_id is not None:
+        _started_queue.put(task_id)
+    return convert_pages(file_path, options_key, page_range)
+
+
+def _watch_started(started_queue):
+    """主程式的背景執行緒：worker 開始轉換某個工作時，呼叫該工作登記的 callback"""
+    while True:
+        task_id = started_queue.get()
+        if task_id is None:
+            return
+        callback = _started_callbacks.pop(task_id, None)
+        if callback is None:
+            continue
+        try:
+            callback()
+        except Exception as e:
+            print(f"[ERROR] 回報轉換開始時發生例外：{e}", flush=True)
+
+
+def get_conversion_pool(workers: int, options_key: tuple):
+    global _conversion_pool, _conversion_pool_workers, _started_queue
+    if _conversion_pool is None or _conversion_pool_workers != workers:
+        shutdown_conversion_pool()
+        # 使用 spawn，避免 fork 複製主程式的資料庫連線與 torch 執行緒狀態
+        context = multiprocessing.get_context("spawn")
+        _started_queue = context.SimpleQueue()
+        threading.Thread(
+            target=_watch_started, args=(_started_queue,), daemon=True
+        ).start()
+        _conversion_pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_conversion_worker,
+            initargs=(options_key, _started_queue),
+        )
+        _conversion_pool_workers = workers
+        print(f"[DEBUG] 已建立 docling process pool: {workers} 個 worker", flush=True)
+    return _conversion_pool
+
+
+def shutdown_conversion_pool():
+    global _conversion_pool, _conversion_pool_workers, _started_queue
+    if _conversion_pool is not None:
+        _conversion_pool.shutdown(wait=False, cancel_futures=True)
+        _conversion_pool = None
+        _conversion_pool_workers = 0
+    if _started_queue is not None:
+        # 結束背景執行緒
+        _started_queue.put(None)
+        _started_queue = None
+
+
+def get_conversion_manifest():
+    global _conversion_manifest
+    if _conversion_manifest is None:
+        _conversion_manifest = ConversionManifest(MD_PATH)
+    return _conversion_manifest
+
+
+def cached_conversion(filename: str, markdown_file: str, content: str) -> dict:
+    """以快取的 markdown 建立與 convert_file_via_docling 相同格式的結果"""
+    own_markdown_file = f"{filename}.md"
+    duplicate_of = None
+    if markdown_file != own_markdown_file:
+        # 內容相同但檔名不同的檔案，複製一份 markdown 供檢視原文使用
+        duplicate_of = markdown_file[: -len(".md")]
+        with open(os.path.join(MD_PATH, own_markdown_file), "w", encoding="utf-8") as f:
+            f.write(content)
+        print(f"[DEBUG] {filename} 與 {duplicate_of} 內容相同，使用已轉換的結果", flush=True)
+    else:
+        print(f"[DEBUG] {filename} 未變更，使用已轉換的結果", flush=True)
+    return {
+        "content": content,
+        "source_file": filename,
+        "markdown_file": own_markdown_file,
+        "timing": {"model_load_seconds": 0.0, "convert_seconds": 0.0},
+        "conversion_cache": "duplicate" if duplicate_of else "hit",
+        "duplicate_of": duplicate_of,
+    }
+
+
+def read_cached_conversion(filename: str, markdown_file: Optional[str]):
+    if markdown_file is None:
+        return None
+    try:
+        with open(os.path.join(MD_PATH, markdown_file), "r", encoding="utf-8") as f:
+            content = f.read()
+    except OSError as e:
+        print(f"[ERROR] 讀取 {markdown_file} 失敗：{e}", flush=True)
+        return None
+    return cached_conversion(filename, markdown_file, content)
+
+
+def convert_files(files, app_config=None, on_start=None):
+    """
+    以 process pool 平行轉換多個檔案，files: [(file_path, filename)]
+    依完成順序 yield (filename, result)，呼叫端可以邊轉換邊進行分割與向量計算；
+    同時送出的工作數有上限，已完成但尚未被取用的結果不會無限累積；
+    提前結束迭代（例如工作取消）時，尚未開始的檔案會被取消
+    app_config 為呼叫端已載入的配置，未提供時才從資料庫讀取（整批只讀一次）
+    on_start(filename) 在 worker 實際開始轉換檔案時呼叫（每個檔案一次，可能在背景執行緒），
+    已送出但還在排隊的檔案不會呼叫
+    """
+    if app_config is None:
+        load_config()
+    options_key = pipeline_options_key(app_config)
+    manifest = get_conversion_manifest()
+
+    # 內容與 pipeline 選項都沒變的檔案直接使用已轉換的 markdown
+    cached = []
+    pending = []
+    digests = {}
+    for file_path, filename in files:
+        try:
+            digest, markdown_file, content = manifest.lookup(
+                filename, file_path, options_key
+            )
+        except OSError as e:
+            print(f"[ERROR] 讀取 {filename} 失敗：{e}", flush=True)
+            cached.append((filename, None))
+            continue
+        del content
+        digests[filename] = digest
+        if markdown_file:
+            # 只記錄檔名，yield 時才讀入 markdown，避免一次載入全部內容
+            cached.append((filename, markdown_file))
+        else:
+            pending.append((file_path, filename))
+    print(
+        f"[DEBUG] 轉換快取命中 {len(cached)} 個檔案，需轉換 {len(pending)} 個檔案",
+        flush=True,
+    )
+
+    recorded = 0
+    started = set()
+    started_lock = threading.Lock()
+
+    def notify_started(filename):
+        # 背景執行緒與 yield 前的呼叫都經過這裡，每個檔案只回報一次
+        if on_start is None:
+            return
+        with started_lock:
+            if filename in started:
+                return
+            started.add(filename)
+            on_start(filename)
+
+    def record(filename, result):
+        nonlocal recorded
+        if result and not result.get("conversion_cache"):
+            result["conversion_cache"] = "miss"
+            manifest.record(
+                digests[filename], options_key, result["markdown_file"], result["content"]
+            )
+            recorded += 1
+            if recorded % MANIFEST_SAVE_INTERVAL == 0:
+                manifest.save()
+        return filename, result
+
+    # 大型 PDF 依頁面範圍切成多個分片，分散到不同 worker 轉換
+    source = config if app_config is None else app_config
+    max_workers = get_conversion_workers(app_config)
+    shard_pages = int(source.get("docling_shard_pages", 100))
+    tasks = []
+    for file_path, filename in pending:
+        ranges = None
+        if max_workers > 1:
+            ranges = shard_page_ranges(file_path, shard_pages)
+        if ranges:
+            print(f"[DEBUG] {filename} 切成 {len(ranges)} 個分片: {ranges}", flush=True)
+        for shard_no, page_range in enumerate(ranges or [None]):
+            tasks.append((file_path, filename, shard_no, page_range))
+    shard_counts = {}
+    for _, filename, _, _ in tasks:
+        shard_counts[filename] = shard_counts.get(filename, 0) + 1
+
+    futures = {}
+    queued = iter(tasks)
+    workers = min(max_workers, len(tasks))
+    max_inflight = workers * INFLIGHT_PER_WORKER
+
+    def submit_more():
+        # worker 異常結束後 pool 會被關閉，尚未送出的工作改送到重新建立的 pool
+        pool = get_conversion_pool(workers, options_key)
+        while len(futures) < max_inflight:
+            task = next(queued, None)
+            if task is None:
+                return
+            file_path, filename, shard_no, page_range = task
+            task_id = None
+            if on_start is not None:
+                task_id = next(_task_ids)
+                _started_callbacks[task_id] = lambda f=filename: notify_started(f)
+            future = pool.submit(
+                _convert_in_worker, file_path, options_key, page_range, task_id
+            )
+            futures[future] = (filename, shard_no, task_id)
+
+    try:
+        if workers > 1:
+            # 先送出第一批轉換工作，處理快取命中的檔案時 worker 已在轉換
+            submit_more()
+        for filename, markdown_file in cached:
+            notify_started(filename)
+            yield filename, read_cached_conversion(filename, markdown_file)
+        if workers <= 1:
+            for file_path, filename in pending:
+                notify_started(filename)
+                yield record(
+                    filename, convert_file_via_docling(file_path, filename, options_key)
+                )
+            return
+
+        # 同一個檔案的所有分片都完成後，依頁序合併成一份 markdown
+        remaining = dict(shard_counts)
+        shards = {}
+        failed = set()
+        while futures:
+            done_futures, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done_futures:
+                filename, shard_no, task_id = futures.pop(future)
+                _started_callbacks.pop(task_id, None)
+                # 背景執行緒可能還沒處理開始的通知，先補上，避免階段倒退回 convert
+                notify_started(filename)
+                remaining[filename] -= 1
+                try:
+                    shards.setdefault(filename, {})[shard_no] = future.result()
+                except BrokenProcessPool as e:
+                    # worker 異常結束（例如記憶體不足）時 pool 無法再使用，下次重新建立
+                    print(f"[ERROR] 處理 {filename} 時 worker 異常結束：{e}", flush=True)
+                    shutdown_conversion_pool()
+                    failed.add(filename)
+                except Exception as e:
+                    print(f"[ERROR] 處理 {filename} 時發生例外：{e}", flush=True)
+                    failed.add(filename)
+                if remaining[filename] > 0:
+                    continue
+                done = shards.pop(filename, {})
+                result = None
+                if filename not in failed:
+                    try:
+                        result = merge_conversion(
+                            filename, [done[i] for i in sorted(done)]
+                        )
+                    except Exception as e:
+                        print(f"[ERROR] 合併 {filename} 時發生例外：{e}", flush=True)
+                del done
+                yield record(filename, result)
+            # 呼叫端取用結果後才送出新的工作
+            submit_more()
+    finally:
+        for future, (_, _, task_id) in futures.items():
+            future.cancel()
+            _started_callbacks.pop(task_id, None)
+        manifest.save()
@@ -0,0 +1,460 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import inspect
+import argparse
+import threading
+import statistics
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+RERANKER_MODEL_NAME = "BAAI/bge-reranker-v2-m3"
+# cross-encoder 的輸入長度上限 (query + passage)
+MAX_LENGTH = 512
+# 可選用的推理後端
+BACKENDS = ("torch", "onnx", "onnx_int8")
+# ONNX 匯出目錄內的檔案
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model_int8.onnx"
+PARITY_FILE = "parity.json"
+# 與 PyTorch 分數比對的容許誤差：fp32 看分數差，int8 看排名是否一致
+FP32_MAX_ABS_DIFF = 1e-3
+INT8_MIN_RANK_CORRELATION = 0.9
+# 比對分數與效能測試用的 (query, passage) 配對
+SAMPLE_PAIRS = [
+    ("請假需要提前幾天申請？", "員工請特休假應於三日前提出申請，並經直屬主管核准。"),
+    ("請假需要提前幾天申請？", "出差旅費應於返回後七日內檢附單據辦理核銷。"),
+    ("請假需要提前幾天申請？", "病假得於當日以電話告知主管，事後補辦請假手續。"),
+    ("加班費如何計算？", "延長工作時間在二小時以內者，按平日每小時工資加給三分之一以上。"),
+    ("加班費如何計算？", "公司每年定期辦理員工健康檢查，費用由公司負擔。"),
+    ("How do I reset my password?", "Open the login page and choose Forgot password."),
+    ("How do I reset my password?", "The cafeteria is open from 11:30 to 13:30."),
+    ("表單 HR-001 在哪裡下載？", "人事相關表單（HR-001 請假單、HR-002 加班單）可於內部網站下載。"),
+]
+
+
+def default_onnx_dir(model_name=RERANKER_MODEL_NAME):
+    """ONNX 匯出結果放在 HF_HOME 下，與 Hugging Face 模型快取一起保存"""
+    root = os.getenv("HF_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(root, "onnx", model_name.replace("/", "--"))
+
+
+class Reranker:
+    """以 cross-encoder 計算 (query, passage) 的相關分數 (PyTorch)"""
+
+    backend = "torch"
+
+    def __init__(self, model_name=RERANKER_MODEL_NAME, device="cpu"):
+        self.model_name = model_name
+        self.device = device
+        self.parity = None
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        self.model.to(device)
+        self.model.eval()
+
+    def tokenize_passages(self, texts):
+        return tokenize_passages(self.tokenizer, texts)
+
+    def score(self, pairs):
+        inputs = encode_pairs(self.tokenizer, pairs)
+        # 因為 device 選擇用GPU，為避免使用CPU推理造成異常，故此處需使用GPU推理
+        inputs = {k: torch.from_numpy(v).to(self.device) for k, v in inputs.items()}
+        with torch.no_grad():
+            scores = self.model(**inputs).logits.squeeze(-1)
+        return scores.float().cpu().reshape(-1).tolist()
+
+
+def tokenize_passages(tokenizer, texts):
+    """passage 的 token ids（不含特殊 token），超過 MAX_LENGTH 的部分截斷"""
+    if not texts:
+        return []
+    return tokenizer(
+        list(texts), add_special_tokens=False, truncation=True, max_length=MAX_LENGTH
+    )["input_ids"]
+
+
+def _truncate_longest_first(query_len, passage_len, budget):
+    """與 tokenizer 的 longest_first 相同：較長的一方先截斷，一樣長時先截斷 passage"""
+    excess = query_len + passage_len - budget
+    if excess <= 0:
+        return query_len, passage_len
+    cut = min(abs(query_len - passage_len), excess)
+    if query_len > passage_len:
+        query_len -= cut
+    else:
+        passage_len -= cut
+    excess -= cut
+    return query_len - excess // 2, passage_len - (excess - excess // 2)
+
+
+def encode_pairs(tokenizer, pairs, max_length=MAX_LENGTH):
+    """
+    組成 cross-encoder 的輸入，回傳 {input_ids, attention_mask} (numpy int64)
+    pairs 為 (query, passage) 或 (query, passage, passage token ids)；
+    有預先計算的 token ids 時只需對 query 斷詞，同一個 query 也只斷詞一次
+    """
+    queries = list(dict.fromkeys(pair[0] for pair in pairs))
+    query_ids = dict(
+        zip(queries, tokenizer(queries, add_special_tokens=False)["input_ids"])
+    )
+    passage_ids = [pair[2] if len(pair) > 2 else None for pair in pairs]
+    missing = [i for i, ids in enumerate(passage_ids) if ids is None]
+    computed = tokenize_passages(tokenizer, [pairs[i][1] for i in missing])
+    for i, ids in zip(missing, computed):
+        passage_ids[i] = ids
+
+    budget = max_length - tokenizer.num_special_tokens_to_add(pair=True)
+    rows = []
+    for pair, p_ids in zip(pairs, passage_ids):
+        q_ids = query_ids[pair[0]]
+        q_len, p_len = _truncate_longest_first(len(q_ids), len(p_ids), budget)
+        rows.append(
+            tokenizer.build_inputs_with_special_tokens(
+                list(q_ids[:q_len]), np.asarray(p_ids[:p_len]).tolist()
+            )
+        )
+    input_ids = np.full(
+        (len(rows), max(len(row) for row in rows)), tokenizer.pad_token_id, np.int64
+    )
+    attention_mask = np.zeros(input_ids.shape, dtype=np.int64)
+    for i, row in enumerate(rows):
+        input_ids[i, : len(row)] = row
+        attention_mask[i, : len(row)] = 1
+    return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+class OnnxReranker:
+    """
+    以 ONNX Runtime 在 CPU 上執行 cross-encoder，quantize=True 時使用動態 int8 量化的模型
+    第一次使用時由 PyTorch 模型匯出，並與 PyTorch 的分數比對 (parity) 後存檔
+    """
+
+    def __init__(
+        self, model_name=RERANKER_MODEL_NAME, onnx_dir=None, quantize=True, num_threads=0
+    ):
+        import onnxruntime as ort
+
+        self.model_name = model_name
+        self.backend = "onnx_int8" if quantize else "onnx"
+        self.onnx_dir = onnx_dir or default_onnx_dir(model_name)
+        path = export_onnx(model_name, self.onnx_dir, quantize)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.parity = read_parity(self.onnx_dir).get(self.backend)
+        if self.parity is None:
+            self.parity = record_parity(self.onnx_dir, self, Reranker(model_name))
+        if not self.parity["passed"]:
+            print(
+                f"[WARN] {self.backend} reranker 與 PyTorch 分數差異超出容許範圍: "
+                f"{self.parity}",
+                flush=True,
+            )
+
+    def tokenize_passages(self, texts):
+        return tokenize_passages(self.tokenizer, texts)
+
+    def score(self, pairs):
+        inputs = encode_pairs(self.tokenizer, pairs)
+        feeds = {name: inputs[name] for name in self.input_names}
+        logits = self.session.run(None, feeds)[0]
+        return logits.astype(np.float32).reshape(-1).tolist()
+
+
+def export_onnx(model_name, onnx_dir, quantize=True):
+    """
+    將 cross-encoder 匯出成 ONNX (batch 與序列長度為動態維度)，quantize=True 時再做動態 int8 量化
+    已匯出過時直接回傳檔案路徑；先寫到暫存目錄再搬移，中斷時不會留下不完整的模型
+    """
+    fp32_path = os.path.join(onnx_dir, ONNX_FILE)
+    int8_path = os.path.join(onnx_dir, ONNX_INT8_FILE)
+    target = int8_path if quantize else fp32_path
+    if os.path.exists(target):
+        return target
+    os.makedirs(onnx_dir, exist_ok=True)
+
+    if not os.path.exists(fp32_path):
+        print(f"[DEBUG] 匯出 reranker ONNX 模型: {onnx_dir}", flush=True)
+        tmp_dir = onnx_dir + ".tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        reference = Reranker(model_name)
+        sample = reference.tokenizer(
+            ["query"], ["passage"], return_tensors="pt", padding=True
+        )
+        kwargs = {}
+        # 新版 torch 預設使用 dynamo 匯出，這裡固定使用支援 dynamic_axes 的 TorchScript 匯出
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            kwargs["dynamo"] = False
+        dynamic_axes = {0: "batch", 1: "sequence"}
+        torch.onnx.export(
+            reference.model,
+            (sample["input_ids"], sample["attention_mask"]),
+            os.path.join(tmp_dir, ONNX_FILE),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": dynamic_axes,
+                "attention_mask": dynamic_axes,
+                "logits": {0: "batch"},
+            },
+            opset_version=17,
+            **kwargs,
+        )
+        del reference
+        # 模型超過 2GB 時權重另存成 external data 檔，model.onnx 最後搬移
+        for name in sorted(os.listdir(tmp_dir), key=lambda n: n == ONNX_FILE):
+            os.replace(os.path.join(tmp_dir, name), os.path.join(onnx_dir, name))
+        shutil.rmtree(tmp_dir)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        print("[DEBUG] 以動態 int8 量化 reranker ONNX 模型", flush=True)
+        tmp_path = int8_path + ".tmp"
+        quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, int8_path)
+    return target
+
+
+def parity_check(reference_scores, candidate_scores, pairs=None):
+    """
+    比對兩個後端的分數：最大/平均絕對誤差，以及排名相關係數 (Spearman)
+    有提供 pairs 時另外檢查每個 query 分數最高的 passage 是否相同
+    """
+    ref = np.asarray(reference_scores, dtype=np.float64)
+    cand = np.asarray(candidate_scores, dtype=np.float64)
+    diff = np.abs(ref - cand)
+    result = {
+        "pairs": len(ref),
+        "max_abs_diff": round(float(diff.max()), 6) if len(ref) else 0.0,
+        "mean_abs_diff": round(float(diff.mean()), 6) if len(ref) else 0.0,
+        "rank_correlation": 1.0,
+    }
+    if len(ref) > 1:
+        ref_rank = ref.argsort().argsort()
+        cand_rank = cand.argsort().argsort()
+        if ref_rank.std() > 0 and cand_rank.std() > 0:
+            result["rank_correlation"] = round(
+                float(np.corrcoef(ref_rank, cand_rank)[0, 1]), 4
+            )
+    if pairs is not None:
+        groups = {}
+        for i, pair in enumerate(pairs):
+            groups.setdefault(pair[0], []).append(i)
+        result["top1_agreement"] = round(
+            sum(
+                max(ids, key=lambda i: ref[i]) == max(ids, key=lambda i: cand[i])
+                for ids in groups.values()
+            )
+            / len(groups),
+            4,
+        )
+    return result
+
+
+def read_parity(onnx_dir):
+    path = os.path.join(onnx_dir, PARITY_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def record_parity(onnx_dir, candidate, reference):
+    """以 SAMPLE_PAIRS 比對 candidate 與 PyTorch 的分數，結果寫入 parity.json"""
+    result = parity_check(
+        reference.score(SAMPLE_PAIRS), candidate.score(SAMPLE_PAIRS), SAMPLE_PAIRS
+    )
+    if candidate.backend == "onnx":
+        result["passed"] = result["max_abs_diff"] <= FP32_MAX_ABS_DIFF
+    else:
+        result["passed"] = (
+            result["rank_correlation"] >= INT8_MIN_RANK_CORRELATION
+            and result["top1_agreement"] == 1.0
+        )
+    data = read_parity(onnx_dir)
+    data[candidate.backend] = result
+    with open(os.path.join(onnx_dir, PARITY_FILE), "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    print(f"[DEBUG] {candidate.backend} reranker parity: {result}", flush=True)
+    return result
+
+
+def load_reranker(backend="torch", device="cpu", model_name=RERANKER_MODEL_NAME):
+    """依 backend 載入 reranker，ONNX Runtime 未安裝時改用 PyTorch"""
+    if backend in ("onnx", "onnx_int8"):
+        try:
+            return OnnxReranker(model_name, quantize=backend == "onnx_int8")
+        except ImportError as e:
+            print(f"[WARN] 無法使用 {backend} reranker，改用 PyTorch: {e}", flush=True)
+    elif backend != "torch":
+        print(f"[WARN] 未知的 reranker_backend: {backend}，使用 PyTorch", flush=True)
+    return Reranker(model_name, device)
+
+
+class _Request:
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class RerankBatcher:
+    """
+    跨請求的動態批次 (micro-batching)：同時進來的查詢把 (query, passage) 配對放進佇列，
+    由單一背景執行緒收集成一批，一次推理後把分數分送回各請求
+    - 第一個請求到達後最多再等 max_wait_ms 收集其他請求，湊滿 max_batch_size 個配對即提早送出
+    - 只有一個執行緒做推理，並行的查詢不會互搶 CPU 執行緒
+    """
+
+    def __init__(self, score_fn, max_batch_size=64, max_wait_ms=5):
+        self.score_fn = score_fn
+        self.configure(max_batch_size, max_wait_ms)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.pairs = 0
+        self._thread = threading.Thread(
+            target=self._run, name="rerank-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def configure(self, max_batch_size, max_wait_ms):
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.max_wait = max(float(max_wait_ms), 0.0) / 1000
+
+    def score(self, pairs):
+        """回傳 pairs 的分數 (list)，呼叫端會等到所屬的批次推理完成"""
+        if not pairs:
+            return []
+        request = _Request(list(pairs))
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        size = len(batch[0].pairs)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    request = self._queue.get(timeout=remaining)
+                else:
+                    request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.pairs)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            pairs = [pair for request in batch for pair in request.pairs]
+            try:
+                scores = []
+                # 單一請求超過 max_batch_size 時分成多次推理
+                for start in range(0, len(pairs), self.max_batch_size):
+                    scores.extend(
+                        self.score_fn(pairs[start : start + self.max_batch_size])
+                    )
+                position = 0
+                for request in batch:
+                    end = position + len(request.pairs)
+                    request.scores = scores[position:end]
+                    position = end
+            except Exception as e:
+                print(f"[ERROR] reranker 批次推理失敗: {e}", flush=True)
+                for request in batch:
+                    request.error = e
+            finally:
+                for request in batch:
+                    request.done.set()
+            with self._lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.pairs += len(pairs)
+            if len(batch) > 1:
+                print(
+                    f"[DEBUG] reranker 合併 {len(batch)} 個請求，"
+                    f"共 {len(pairs)} 個配對一次推理",
+                    flush=True,
+                )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "requests": self.requests,
+                "pairs": self.pairs,
+                "avg_requests_per_batch": (
+                    round(self.requests / self.batches, 2) if self.batches else 0.0
+                ),
+                "avg_pairs_per_batch": (
+                    round(self.pairs / self.batches, 2) if self.batches else 0.0
+                ),
+                "queued": self._queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+
+def benchmark(backend, n_pairs=20, runs=10, passage_repeat=8):
+    """
+    比較 PyTorch (CPU) 與指定後端的 reranker 延遲，回傳報告 (dict)
+    passage 由範例文字重複 passage_repeat 次組成，接近實際 chunk 的長度
+    """
+    pairs = [
+        (q, " ".join([p] * passage_repeat))
+        for q, p in (SAMPLE_PAIRS * (n_pairs // len(SAMPLE_PAIRS) + 1))[:n_pairs]
+    ]
+    reference = Reranker(RERANKER_MODEL_NAME, "cpu")
+    candidate = load_reranker(backend, "cpu")
+    report = {"backend": candidate.backend, "pairs": n_pairs, "runs": runs}
+    scores = {}
+    for name, model in (("torch", reference), (candidate.backend, candidate)):
+        scores[name] = model.score(pairs)  # warmup
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            model.score(pairs)
+            timings.append((time.perf_counter() - started) * 1000)
+        report[f"{name}_ms"] = round(statistics.median(timings), 2)
+    report["speedup"] = round(report["torch_ms"] / report[f"{candidate.backend}_ms"], 2)
+    report["parity"] = parity_check(scores["torch"], scores[candidate.backend], pairs)
+    return report
+
+
+if __name__ == "__main__":
+    # python -m app.reranker export --backend onnx_int8
+    # python -m app.reranker benchmark --backend onnx_int8 --pairs 20 --runs 10
+    parser = argparse.ArgumentParser(description="BGE reranker ONNX 匯出與效能測試")
+    parser.add_argument("command", choices=["export", "benchmark"])
+    parser.add_argument("--backend", choices=BACKENDS[1:], default="onnx_int8")
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+    if args.command == "export":
+        model = OnnxReranker(quantize=args.backend == "onnx_int8")
+        print(json.dumps(model.parity, indent=2))
+        sys.exit(0 if model.parity["passed"] else 1)
+    print(json.dumps(benchmark(args.backend, args.pairs, args.runs), indent=2))
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import threading
+import faiss
+import numpy as np
+
+from app.chunk_store import (
+    ChunkStore,
+    write_chunk_store,
+    source_chunk_ids,
+    load_passage_tokens as load_chunk_passage_tokens,
+)
+from app.sparse_index import SparseIndex, write_sparse_index
+
+# FAISS_DIR 底下的快照目錄與指向目前版本的檔案
+SNAPSHOTS_DIR = "snapshots"
+CURRENT_FILE = "CURRENT"
+INDEX_FILE = "faiss.index"
+CHUNKS_DIR = "chunks"
+SPARSE_DIR = "sparse"
+MANIFEST_FILE = "manifest.json"
+# 跨 process 的索引更新鎖
+LOCK_FILE = "index.lock"
+
+
+class IndexSnapshot:
+    """
+    一個版本的索引：FAISS index + chunk store + BM25 倒排索引 (sparse) + manifest，
+    以及 reranker 預先斷詞的 passage token ids (passage_tokens)
+    發佈後視為唯讀，查詢在開始時取得目前的 snapshot，整個請求都使用同一個版本；
+    更新時複製一份工作用的 snapshot 修改，完成後再整個換上；
+    工作副本記錄來源版本 (parent) 與 chunk id 的對應 (id_map)，發佈時沿用來源版本未變動的部分
+    """
+
+    def __init__(
+        self,
+        version=None,
+        index=None,
+        texts=None,
+        manifest=None,
+        is_mmap=False,
+        index_path=None,
+        sparse=None,
+        passage_tokens=None,
+        parent=None,
+    ):
+        self.version = version
+        self.index = index
+        self.texts = texts if texts is not None else []
+        self.manifest = manifest or {}
+        self.is_mmap = is_mmap
+        # index 檔案位置，mmap 開啟的唯讀 index 需要從檔案重新讀入才能修改
+        self.index_path = index_path
+        # 舊版 snapshot 沒有 sparse index，此時只使用向量檢索
+        self.sparse = sparse
+        # 沒有預先斷詞時 reranker 在查詢時才對 passage 斷詞
+        self.passage_tokens = passage_tokens
+        self.parent = parent
+        # parent 的 chunk id 對應到本版的 id（-1 表示已移除），None 表示 id 不變
+        self.id_map = None
+        # 工作副本中 dedup_key → chunk id，隨新增、移除 chunk 維護，不必每次重新計算雜湊
+        self.chunk_keys = None
+        self._source_chunk_ids = None
+
+    def source_chunk_ids(self):
+        """[(出處, chunk ids)]，在第一次使用時建立，snapshot 發佈後不再變動"""
+        if self._source_chunk_ids is None:
+            self._source_chunk_ids = source_chunk_ids(self.texts)
+        return self._source_chunk_ids
+
+    def chunk_ids_for(self, source_files=(), markdown_files=()):
+        """
+        出處符合任一 source_file / markdown_file 的 chunk ids（已排序），供搜尋時過濾
+        """
+        source_files, markdown_files = set(source_files), set(markdown_files)
+        matched = [
+            ids
+            for source, ids in self.source_chunk_ids()
+            if source["source_file"] in source_files
+            or source["markdown_file"] in markdown_files
+        ]
+        if not matched:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(matched))
+
+
+class IndexWriteLock:
+    """
+    同一時間只允許一個索引更新：process 內以 threading.Lock 排隊，
+    process 之間以 FAISS_DIR 內鎖定檔的 fcntl.flock 互斥
+    多個 uvicorn worker 同時更新時，begin_index_update → publish_snapshot
+    整段不會交錯，不會有一方的 CURRENT 更新被另一方覆蓋
+    """
+
+    def __init__(self, faiss_dir):
+        self.path = os.path.join(faiss_dir, LOCK_FILE)
+        self._lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "a")
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+        finally:
+            self._file = None
+            self._lock.release()
+
+
+def new_version() -> str:
+    return time.strftime("v%Y%m%d-%H%M%S-") + f"{time.time_ns() % 1000000000:09d}"
+
+
+def read_current_version(faiss_dir):
+    current_path = os.path.join(faiss_dir, CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path, "r", encoding="utf-8") as f:
+        return f.read().strip() or None
+
+
+def current_mtime(faiss_dir):
+    try:
+        return os.stat(os.path.join(faiss_dir, CURRENT_FILE)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def read_index_file(index_path, use_mmap):
+    if use_mmap:
+        # 以 mmap 唯讀開啟，多個 worker 共用同一份 page cache
+        # 新版 FAISS 的 IO_FLAG_MMAP_IFC 可 mmap 所有類型，但不能與 IO_FLAG_MMAP 同時使用
+        mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+        try:
+            return faiss.read_index(index_path, mmap_flag | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            print(f"[WARN] 無法以 mmap 開啟索引，改為完整載入：{e}", flush=True)
+    return faiss.read_index(index_path)
+
+
+def snapshot_path(faiss_dir, version):
+    return os.path.join(faiss_dir, SNAPSHOTS_DIR, version)
+
+
+def load_sparse_index(faiss_dir, version, use_mmap):
+    path = os.path.join(snapshot_path(faiss_dir, version), SPARSE_DIR)
+    if not os.path.isdir(path):
+        return None
+    return SparseIndex(path, use_mmap=use_mmap)
+
+
+def load_passage_tokens(faiss_dir, version, use_mmap):
+    path = os.path.join(snapshot_path(faiss_dir, version), CHUNKS_DIR)
+    return load_chunk_passage_tokens(path, use_mmap=use_mmap)
+
+
+def load_snapshot(faiss_dir, version, use_mmap):
+    path = snapshot_path(faiss_dir, version)
+    index_path = os.path.join(path, INDEX_FILE)
+    index = read_index_file(index_path, use_mmap)
+    texts = ChunkStore(os.path.join(path, CHUNKS_DIR), use_mmap=use_mmap)
+    manifest = {}
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    return IndexSnapshot(
+        version,
+        index,
+        texts,
+        manifest,
+        is_mmap=use_mmap,
+        index_path=index_path,
+        sparse=load_sparse_index(faiss_dir, version, use_mmap),
+        passage_tokens=load_passage_tokens(faiss_dir, version, use_mmap),
+    )
+
+
+def write_snapshot(
+    faiss_dir, index, texts, manifest, tokenizer=None, parent=None, id_map=None
+):
+    """
+    在 snapshots/<version> 寫出新版本（index + chunk store + sparse index + manifest），
+    提供 tokenizer (reranker) 時 chunk store 另外存放預先斷詞的 passage token ids
+    提供來源版本 (parent) 時沿用其 sparse index 的 posting 與 passage token ids，
+    只處理新增的 chunk
+    全部寫完後才更新 CURRENT，回傳新版本的 manifest
+    """
+    version = new_version()
+    path = snapshot_path(faiss_dir, version)
+    tmp_path = path + ".tmp"
+    os.makedirs(tmp_path)
+    faiss.write_index(index, os.path.join(tmp_path, INDEX_FILE))
+    passage_tokens = write_chunk_store(
+        os.path.join(tmp_path, CHUNKS_DIR),
+        texts,
+        tokenizer,
+        parent.passage_tokens if parent is not None else None,
+        id_map,
+    )
+    sparse = write_sparse_index(
+        os.path.join(tmp_path, SPARSE_DIR),
+        texts,
+        parent.sparse if parent is not None else None,
+        id_map,
+    )
+    manifest = dict(
+        manifest,
+        version=version,
+        created_at=time.time(),
+        sparse=sparse,
+        passage_tokens=passage_tokens,
+    )
+    with open(os.path.join(tmp_path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.rename(tmp_path, path)
+
+    # CURRENT 以 rename 原子性地切換版本
+    current_tmp = os.path.join(faiss_dir, CURRENT_FILE + ".tmp")
+    with open(current_tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(current_tmp, os.path.join(faiss_dir, CURRENT_FILE))
+    return manifest
+
+
+def cleanup_snapshots(faiss_dir, keep):
+    """只保留最新的 keep 個版本；已被 mmap 開啟的舊檔案在 Linux 上刪除後仍可使用"""
+    root = os.path.join(faiss_dir, SNAPSHOTS_DIR)
+    if not os.path.isdir(root):
+        return
+    current = read_current_version(faiss_dir)
+    versions = sorted(
+        name
+        for name in os.listdir(root)
+        if os.path.isdir(os.path.join(root, name)) and not name.endswith(".tmp")
+    )
+    for name in versions[: max(len(versions) - max(keep, 1), 0)]:
+        if name != current:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    # 清除中斷時留下超過一天的暫存目錄
+    for name in os.listdir(root):
+        tmp_path = os.path.join(root, name)
+        if name.endswith(".tmp") and time.time() - os.path.getmtime(tmp_path) > 86400:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def remove_all_snapshots(faiss_dir):
+    shutil.rmtree(os.path.join(faiss_dir, SNAPSHOTS_DIR), ignore_errors=True)
+    current_path = os.path.join(faiss_dir, CURRENT_FILE)
+    if os.path.exists(current_path):
+        os.remove(current_path)
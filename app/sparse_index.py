@@ -0,0 +1,291 @@
+import os
+import re
+import json
+import math
+import mmap
+import shutil
+import unicodedata
+import numpy as np
+
+from collections import Counter
+
+# sparse index 目錄內的檔案
+TERMS_BLOB_FILE = "terms.bin"
+TERM_OFFSETS_FILE = "term_offsets.npy"
+POSTING_OFFSETS_FILE = "posting_offsets.npy"
+POSTING_IDS_FILE = "posting_ids.npy"
+POSTING_TF_FILE = "posting_tf.npy"
+DOC_LENGTHS_FILE = "doc_lengths.npy"
+META_FILE = "meta.json"
+
+TOKENIZER_VERSION = "cjk-bigram-1"
+# BM25 參數
+BM25_K1 = 1.2
+BM25_B = 0.75
+# reciprocal rank fusion 的平滑常數
+RRF_K = 60
+
+# 英數字詞（可包含 - _ . / 連接，例如表單編號 HR-001、法規條號 3.2.1）或連續的中日韓文字
+_TOKEN_RE = re.compile(
+    r"[0-9a-z]+(?:[-_./][0-9a-z]+)*"
+    r"|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+"
+)
+_WORD_RE = re.compile(r"[0-9a-z]+")
+
+
+def tokenize(text):
+    """
+    CJK 感知的斷詞：全形字元先正規化為半形並轉小寫
+    - 英數字詞整個保留，含連接符號時另外拆出各段，查詢「HR-001」或「001」都能命中
+    - 中日韓文字不做分詞，以相鄰兩字 (bigram) 為單位，只有一個字時保留單字
+    """
+    tokens = []
+    text = unicodedata.normalize("NFKC", text).lower()
+    for match in _TOKEN_RE.finditer(text):
+        token = match.group()
+        if token[0].isascii():
+            tokens.append(token)
+            parts = _WORD_RE.findall(token)
+            if len(parts) > 1:
+                tokens.extend(parts)
+        elif len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[i : i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+def write_sparse_index(path, chunks, previous=None, id_map=None):
+    """
+    以 chunk 內容建立 BM25 倒排索引，寫成可 mmap 的欄式檔案（chunk id 與 FAISS 相同）：
+    - terms.bin / term_offsets.npy       依 UTF-8 位元組排序的詞彙表，查詢時二分搜尋
+    - posting_offsets.npy                每個詞的 posting 在下列陣列內的起訖位置 (int64, T+1)
+    - posting_ids.npy / posting_tf.npy   出現該詞的 chunk id (int32) 與詞頻 (uint16)
+    - doc_lengths.npy                    每個 chunk 的詞數，已刪除的 chunk 為 0
+    提供上一版的 sparse index (previous) 時沿用其 posting，只對新增的 chunk 斷詞；
+    id_map 為上一版 chunk id 對應到本版的 id（-1 表示已移除），None 表示 id 不變
+    先寫到暫存目錄再整個換上
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    live = np.fromiter((chunk is not None for chunk in chunks), bool, len(chunks))
+    doc_lengths = np.zeros(len(chunks), dtype=np.int32)
+    covered = np.zeros(len(chunks), dtype=bool)
+    terms, term_parts, id_parts, tf_parts = [], [], [], []
+    carried = _carry_postings(previous, live, id_map)
+    if carried is not None:
+        terms, term_ids, posting_ids, posting_tf, old_ids, new_ids = carried
+        term_parts.append(term_ids)
+        id_parts.append(posting_ids)
+        tf_parts.append(posting_tf)
+        doc_lengths[new_ids] = previous._doc_lengths[old_ids]
+        covered[new_ids] = True
+
+    # 只對上一版沒有的 chunk 斷詞，posting 以平面陣列累積，最後一次排序
+    new_terms = {}
+    term_ids, posting_ids, posting_tf = [], [], []
+    for chunk_id in np.flatnonzero(live & ~covered).tolist():
+        counts = Counter(tokenize(chunks[chunk_id]["content"]))
+        doc_lengths[chunk_id] = sum(counts.values())
+        for term, tf in counts.items():
+            term_ids.append(new_terms.setdefault(term.encode("utf-8"), len(new_terms)))
+            posting_ids.append(chunk_id)
+            posting_tf.append(tf)
+    print(
+        f"[DEBUG] sparse index: 沿用 {int(covered.sum())} 個 chunk，"
+        f"斷詞 {int(live.sum() - covered.sum())} 個 chunk",
+        flush=True,
+    )
+
+    # 合併詞彙表，兩邊的詞彙編號都換成合併後的位置
+    merged = sorted(set(terms).union(new_terms))
+    position = {term: t for t, term in enumerate(merged)}
+    if term_parts:
+        old_position = np.fromiter((position[term] for term in terms), np.int64)
+        term_parts[0] = old_position[term_parts[0]]
+    new_position = np.fromiter((position[term] for term in new_terms), np.int64)
+    term_ids = new_position[np.asarray(term_ids, dtype=np.int64)]
+    order = np.lexsort((np.asarray(posting_ids, dtype=np.int32), term_ids))
+    term_parts.append(term_ids[order])
+    id_parts.append(np.asarray(posting_ids, dtype=np.int32)[order])
+    tf_parts.append(np.minimum(np.asarray(posting_tf, dtype=np.int64), 65535)[order])
+    # 沿用的 posting 已依 (詞, chunk id) 排序，新增的 chunk id 都排在後面，
+    # 以 stable sort 依詞合併兩段已排序的陣列即可
+    all_terms = np.concatenate(term_parts)
+    order = np.argsort(all_terms, kind="stable")
+    posting_ids = np.concatenate(id_parts)[order]
+    posting_tf = np.concatenate(tf_parts)[order].astype(np.uint16)
+
+    # 移除已沒有任何 posting 的詞
+    counts = np.bincount(all_terms, minlength=len(merged))
+    kept = np.flatnonzero(counts)
+    merged = [merged[t] for t in kept.tolist()]
+    posting_offsets = np.zeros(len(merged) + 1, dtype=np.int64)
+    np.cumsum(counts[kept], out=posting_offsets[1:])
+    term_offsets = np.zeros(len(merged) + 1, dtype=np.int64)
+    np.cumsum([len(term) for term in merged], out=term_offsets[1:])
+    with open(os.path.join(tmp_path, TERMS_BLOB_FILE), "wb") as blob:
+        blob.write(b"".join(merged))
+
+    np.save(os.path.join(tmp_path, TERM_OFFSETS_FILE), term_offsets)
+    np.save(os.path.join(tmp_path, POSTING_OFFSETS_FILE), posting_offsets)
+    np.save(os.path.join(tmp_path, POSTING_IDS_FILE), posting_ids)
+    np.save(os.path.join(tmp_path, POSTING_TF_FILE), posting_tf)
+    np.save(os.path.join(tmp_path, DOC_LENGTHS_FILE), doc_lengths)
+    docs = int(live.sum())
+    meta = {
+        "tokenizer": TOKENIZER_VERSION,
+        "terms": len(merged),
+        "docs": docs,
+        "avg_doc_length": float(doc_lengths.sum()) / docs if docs else 0.0,
+    }
+    with open(os.path.join(tmp_path, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return meta
+
+
+def _carry_postings(previous, live, id_map):
+    """
+    將上一版的 posting 換成本版的 chunk id，去掉已移除的 chunk
+    回傳 (詞彙表, 詞彙編號, chunk ids, 詞頻, 上一版 chunk ids, 對應的本版 chunk ids)，
+    斷詞方式不同或 id 對應不上時回傳 None，改為全部重新斷詞
+    """
+    if previous is None or previous.meta.get("tokenizer") != TOKENIZER_VERSION:
+        return None
+    previous_docs = len(previous._doc_lengths)
+    if id_map is None:
+        id_map = np.arange(previous_docs, dtype=np.int64)
+    id_map = np.asarray(id_map, dtype=np.int64)
+    if len(id_map) != previous_docs or id_map.max(initial=-1) >= len(live):
+        return None
+    # 上一版 chunk id → 本版 chunk id，已移除的 chunk 為 -1
+    mapped = np.where(id_map >= 0, id_map, 0)
+    id_map = np.where((id_map >= 0) & live[mapped], id_map, -1)
+    old_ids = np.flatnonzero(id_map >= 0)
+
+    term_offsets = np.asarray(previous._term_offsets)
+    blob = bytes(previous._terms)
+    terms = [
+        blob[start:end]
+        for start, end in zip(term_offsets[:-1].tolist(), term_offsets[1:].tolist())
+    ]
+    term_ids = np.repeat(
+        np.arange(len(terms), dtype=np.int64), np.diff(previous._posting_offsets)
+    )
+    posting_ids = id_map[np.asarray(previous._posting_ids)]
+    keep = posting_ids >= 0
+    return (
+        terms,
+        term_ids[keep],
+        posting_ids[keep].astype(np.int32),
+        np.asarray(previous._posting_tf)[keep].astype(np.int64),
+        old_ids,
+        id_map[old_ids],
+    )
+
+
+class SparseIndex:
+    """
+    唯讀的 BM25 倒排索引，use_mmap=True 時以 mmap 開啟，不會額外佔用一份記憶體
+    search() 回傳 (chunk ids, BM25 分數)，依分數由高到低排列；指定 allowed (chunk ids) 時只在這些 chunk 內搜尋
+    """
+
+    def __init__(self, path, use_mmap=True):
+        self.path = path
+        mmap_mode = "r" if use_mmap else None
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self._term_offsets = np.load(
+            os.path.join(path, TERM_OFFSETS_FILE), mmap_mode=mmap_mode
+        )
+        self._posting_offsets = np.load(
+            os.path.join(path, POSTING_OFFSETS_FILE), mmap_mode=mmap_mode
+        )
+        self._posting_ids = np.load(
+            os.path.join(path, POSTING_IDS_FILE), mmap_mode=mmap_mode
+        )
+        self._posting_tf = np.load(
+            os.path.join(path, POSTING_TF_FILE), mmap_mode=mmap_mode
+        )
+        self._doc_lengths = np.load(
+            os.path.join(path, DOC_LENGTHS_FILE), mmap_mode=mmap_mode
+        )
+        blob_path = os.path.join(path, TERMS_BLOB_FILE)
+        if use_mmap and os.path.getsize(blob_path) > 0:
+            with open(blob_path, "rb") as f:
+                self._terms = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            with open(blob_path, "rb") as f:
+                self._terms = f.read()
+
+    def __len__(self):
+        return len(self._term_offsets) - 1
+
+    def _term(self, t):
+        return self._terms[int(self._term_offsets[t]) : int(self._term_offsets[t + 1])]
+
+    def lookup(self, term):
+        """回傳詞彙編號，不存在時為 -1"""
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._term(lo) == key:
+            return lo
+        return -1
+
+    def search(self, query, k, allowed=None):
+        n_docs = self.meta["docs"]
+        avg_length = self.meta["avg_doc_length"] or 1.0
+        ids, scores = [], []
+        for term in set(tokenize(query)):
+            t = self.lookup(term)
+            if t < 0:
+                continue
+            start = int(self._posting_offsets[t])
+            end = int(self._posting_offsets[t + 1])
+            df = end - start
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            term_ids = np.asarray(self._posting_ids[start:end])
+            tf = self._posting_tf[start:end].astype(np.float32)
+            lengths = self._doc_lengths[term_ids].astype(np.float32)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_length)
+            ids.append(term_ids)
+            scores.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        unique_ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+        if allowed is not None:
+            keep = np.isin(unique_ids, allowed, assume_unique=True)
+            unique_ids, totals = unique_ids[keep], totals[keep]
+        if len(totals) > k:
+            top = np.argpartition(-totals, k)[:k]
+        else:
+            top = np.arange(len(totals))
+        top = top[np.argsort(-totals[top], kind="stable")]
+        return unique_ids[top].astype(np.int64), totals[top].astype(np.float32)
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K, limit=None):
+    """
+    合併多個檢索器的排名：每個 id 的分數為 Σ 1 / (k + 名次)，只看名次不看原始分數
+    rankings 為多個依相關度排序的 id 清單，回傳依融合分數排序的 [(id, 分數)]
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    ordered = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+    return ordered[:limit] if limit else ordered
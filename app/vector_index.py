@@ -0,0 +1,470 @@
+import math
+import time
+import threading
+import numpy as np
+import faiss
+
+# 支援的索引類型（對應 configs.index_type）
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+# 支援的向量儲存格式（對應 configs.index_storage）
+STORAGE_TYPES = ("float32", "fp16", "sq8", "pq")
+SQ_TYPES = {
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "sq8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+# PQ 每個子向量固定使用 8 bits（256 個中心點）
+PQ_NBITS = 8
+# faiss 建議每個 IVF 中心點至少要有 39 筆訓練資料
+IVF_MIN_POINTS_PER_CENTROID = 39
+# 限定文件搜尋時，允許的 chunk 不超過此數量就取回這些向量直接精確搜尋
+FILTER_EXACT_MAX_IDS = 4096
+# 搜尋時不接受 SearchParameters（無法使用 ID selector）的 index 類型
+NO_SELECTOR_TYPES = (faiss.IndexPQ,)
+
+# IVF 的 direct map 在第一次取回向量時建立，避免多個查詢同時建立
+_direct_map_lock = threading.Lock()
+
+
+def _int_config(config, key, default):
+    try:
+        return int(config.get(key, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def resolve_index_type(config) -> str:
+    index_type = str(config.get("index_type", "flat")).strip().lower()
+    if index_type not in INDEX_TYPES:
+        print(f"[WARN] 不支援的 index_type: {index_type}，改用 flat", flush=True)
+        return "flat"
+    return index_type
+
+
+def _resolve_nlist(config, ntrain):
+    nlist = _int_config(config, "ivf_nlist", 0)
+    if nlist <= 0:
+        # 自動決定：約 4 * sqrt(N)
+        nlist = int(4 * math.sqrt(max(ntrain, 1)))
+    # 訓練資料不足時縮小 nlist
+    return max(1, min(nlist, ntrain // IVF_MIN_POINTS_PER_CENTROID))
+
+
+def _resolve_pq_m(config, dimension):
+    m = _int_config(config, "pq_m", 64)
+    # PQ 的子向量數必須能整除向量維度
+    while m > 1 and dimension % m != 0:
+        m -= 1
+    return max(m, 1)
+
+
+def sample_training_vectors(vectors, config):
+    """從全部向量中抽樣作為訓練資料"""
+    sample_size = train_sample_size(config)
+    if sample_size <= 0 or len(vectors) <= sample_size:
+        return vectors
+    rng = np.random.default_rng(1234)
+    picked = rng.choice(len(vectors), size=sample_size, replace=False)
+    return vectors[np.sort(picked)]
+
+
+def train_sample_size(config) -> int:
+    return _int_config(config, "index_train_sample_size", 100000)
+
+
+def index_needs_training(config) -> bool:
+    """ivf 與 sq8 / pq 儲存需要先以向量訓練，建立索引前須先累積訓練資料"""
+    index_type = resolve_index_type(config)
+    storage = resolve_storage(config, index_type)
+    return index_type in ("ivf_flat", "ivf_pq") or storage in ("sq8", "pq")
+
+
+def resolve_storage(config, index_type) -> str:
+    if index_type == "ivf_pq":
+        return "pq"
+    storage = str(config.get("index_storage", "float32")).strip().lower()
+    if storage not in STORAGE_TYPES:
+        print(f"[WARN] 不支援的 index_storage: {storage}，改用 float32", flush=True)
+        return "float32"
+    return storage
+
+
+def _create_base_index(dimension, config, index_type, storage, nlist):
+    """依索引類型 (flat / ivf / hnsw) 與向量儲存格式建立未包裝的 index"""
+    pq_m = _resolve_pq_m(config, dimension)
+    hnsw_m = _int_config(config, "hnsw_m", 32)
+    if index_type == "flat":
+        if storage == "float32":
+            return faiss.IndexFlatL2(dimension)
+        if storage == "pq":
+            return faiss.IndexPQ(dimension, pq_m, PQ_NBITS)
+        return faiss.IndexScalarQuantizer(dimension, SQ_TYPES[storage])
+    if index_type == "hnsw":
+        if storage == "float32":
+            index = faiss.IndexHNSWFlat(dimension, hnsw_m)
+        elif storage == "pq":
+            index = faiss.IndexHNSWPQ(dimension, pq_m, hnsw_m)
+        else:
+            index = faiss.IndexHNSWSQ(dimension, SQ_TYPES[storage], hnsw_m)
+        index.hnsw.efConstruction = _int_config(config, "hnsw_ef_construction", 200)
+        return index
+    quantizer = faiss.IndexFlatL2(dimension)
+    if storage == "float32":
+        return faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
+    if storage == "pq":
+        return faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, PQ_NBITS)
+    return faiss.IndexIVFScalarQuantizer(
+        quantizer, dimension, nlist, SQ_TYPES[storage], faiss.METRIC_L2
+    )
+
+
+def create_index(dimension, config, train_vectors=None):
+    """
+    依 configs 設定建立 FAISS 索引，需要訓練的索引類型會以 train_vectors 抽樣訓練
+    訓練資料不足時自動退回較簡單的索引類型 / 儲存格式
+    """
+    index_type = resolve_index_type(config)
+    storage = resolve_storage(config, index_type)
+    if index_type == "ivf_pq":
+        index_type = "ivf_flat"
+    ntrain = 0 if train_vectors is None else len(train_vectors)
+
+    nlist = 0
+    if index_type == "ivf_flat":
+        nlist = _resolve_nlist(config, ntrain)
+        if ntrain < IVF_MIN_POINTS_PER_CENTROID or nlist < 2:
+            print(
+                f"[WARN] 訓練資料不足 ({ntrain} 筆)，ivf 改用 flat",
+                flush=True,
+            )
+            index_type = "flat"
+    if storage == "pq" and ntrain < (1 << PQ_NBITS):
+        print(f"[WARN] 訓練資料不足 ({ntrain} 筆)，pq 改用 sq8", flush=True)
+        storage = "sq8"
+    if storage == "sq8" and ntrain == 0:
+        storage = "float32"
+
+    index = _create_base_index(dimension, config, index_type, storage, nlist)
+
+    # 量化儲存時，可選擇以較精確的向量重新計算前 k * k_factor 筆候選的距離
+    refine = str(config.get("index_refine", "none")).strip().lower()
+    if storage != "float32" and refine in ("flat", "fp16"):
+        if refine == "flat":
+            refine_index = faiss.IndexFlatL2(dimension)
+        else:
+            refine_index = faiss.IndexScalarQuantizer(dimension, SQ_TYPES["fp16"])
+        index = faiss.IndexRefine(index, refine_index)
+
+    if not index.is_trained:
+        sample = sample_training_vectors(train_vectors, config)
+        print(
+            f"[DEBUG] 訓練 {index_type}/{storage} 索引，訓練資料 {len(sample)} 筆",
+            flush=True,
+        )
+        index.train(np.ascontiguousarray(sample, dtype="float32"))
+
+    # 以 IndexIDMap2 包裝，向量 id 即為 chunk id，可依文件移除 / 取代
+    index = faiss.IndexIDMap2(index)
+    apply_search_params(index, config)
+    print(f"[DEBUG] 建立索引: {describe_index(index)}", flush=True)
+    return index
+
+
+def has_id_map(index) -> bool:
+    return isinstance(faiss.downcast_index(index), faiss.IndexIDMap2)
+
+
+def _unwrap(index):
+    """取出 IndexIDMap2 內部實際存放向量的 index"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap2):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def _base_index(index):
+    """取出 IndexRefine 內用於初步搜尋的 index"""
+    index = _unwrap(index)
+    if isinstance(index, faiss.IndexRefine):
+        index = faiss.downcast_index(index.base_index)
+    return index
+
+
+def _empty_like(index):
+    """複製同類型且已訓練的空 index（保留 IVF 中心點 / PQ codebook）"""
+    inner = faiss.clone_index(_unwrap(index))
+    inner.reset()
+    return inner
+
+
+def reconstruct_vectors(index, ids=None):
+    """
+    從 index 取回向量；ids 為 None 時依存放順序取回全部向量
+    IVF 需要 direct map 才能取回，PQ / SQ 取回的是量化後的近似值
+    """
+    index_ivf = _extract_ivf(index)
+    if index_ivf is not None and index_ivf.direct_map.type == faiss.DirectMap.NoMap:
+        with _direct_map_lock:
+            if index_ivf.direct_map.type == faiss.DirectMap.NoMap:
+                index_ivf.make_direct_map()
+    if ids is None:
+        return _unwrap(index).reconstruct_n(0, index.ntotal)
+    ids = np.ascontiguousarray(ids, dtype="int64")
+    if len(ids) == 0:
+        return np.empty((0, index.d), dtype="float32")
+    # 一次在 C++ 內取回全部向量，不逐筆呼叫 reconstruct
+    return index.reconstruct_batch(ids).astype("float32", copy=False)
+
+
+def ensure_id_map(index):
+    """舊版未包裝 IndexIDMap2 的 index（id 等於存放位置），轉換成以 id 管理的 index"""
+    if index is None or has_id_map(index):
+        return index
+    print("[DEBUG] 轉換舊版 index 為 IndexIDMap2", flush=True)
+    vectors = reconstruct_vectors(index)
+    new_index = faiss.IndexIDMap2(_empty_like(index))
+    new_index.add_with_ids(vectors, np.arange(len(vectors), dtype="int64"))
+    return new_index
+
+
+def remove_vectors(index, ids):
+    """
+    依 chunk id 移除向量，回傳移除後的 index
+    HNSW 不支援移除，改以剩餘向量重建
+    IVF 的倒排清單存的是 IndexIDMap2 內的位置，移除後不會跟著位移，與 id_map 對不上，也改以重建處理
+    """
+    ids = np.asarray(ids, dtype="int64")
+    if len(ids) == 0:
+        return index
+    if _extract_ivf(index) is None:
+        try:
+            index.remove_ids(faiss.IDSelectorBatch(ids))
+            return index
+        except RuntimeError:
+            pass
+    print("[DEBUG] 此類型 index 不支援直接移除向量，以剩餘向量重建", flush=True)
+    all_ids = faiss.vector_to_array(index.id_map)
+    keep_ids = all_ids[~np.isin(all_ids, ids)]
+    vectors = reconstruct_vectors(index, keep_ids)
+    new_index = faiss.IndexIDMap2(_empty_like(index))
+    if len(keep_ids):
+        new_index.add_with_ids(vectors, keep_ids)
+    return new_index
+
+
+def remap_ids(index, id_mapping):
+    """
+    依 id_mapping（舊 id → 新 id 的陣列）改寫 IndexIDMap2 的 id，不需重新計算向量
+    用於 compaction 後讓 chunk id 重新連續
+    """
+    old_ids = faiss.vector_to_array(index.id_map)
+    new_ids = np.asarray(id_mapping, dtype="int64")[old_ids]
+    if (new_ids < 0).any():
+        raise ValueError("index 內仍有已刪除的 chunk id")
+    faiss.copy_array_to_vector(new_ids, index.id_map)
+    index.construct_rev_map()
+    return index
+
+
+def apply_search_params(index, config):
+    """設定查詢時的參數（IVF 的 nprobe、HNSW 的 efSearch），可於執行期間調整"""
+    if index is None:
+        return
+    index_ivf = _extract_ivf(index)
+    if index_ivf is not None:
+        nprobe = _int_config(config, "ivf_nprobe", 16)
+        index_ivf.nprobe = max(1, min(nprobe, index_ivf.nlist))
+    index_hnsw = _extract_hnsw(index)
+    if index_hnsw is not None:
+        index_hnsw.hnsw.efSearch = _int_config(config, "hnsw_ef_search", 64)
+    index_refine = _unwrap(index)
+    if isinstance(index_refine, faiss.IndexRefine):
+        index_refine.k_factor = float(config.get("index_refine_k_factor", 4))
+
+
+def _extract_ivf(index):
+    try:
+        return faiss.extract_index_ivf(_base_index(index))
+    except Exception:
+        return None
+
+
+def _extract_hnsw(index):
+    index = _base_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return index
+    return None
+
+
+def _id_selector(ids):
+    """
+    以排序後的 chunk id 建立 FAISS ID selector：
+    id 連續時（例如只有一份文件）使用範圍，其餘使用 bitmap；回傳 (selector, 需保留的 bitmap)
+    """
+    first, last = int(ids[0]), int(ids[-1])
+    if last - first + 1 == len(ids):
+        return faiss.IDSelectorRange(first, last + 1), None
+    mask = np.zeros(last + 1, dtype=bool)
+    mask[ids] = True
+    bitmap = np.packbits(mask, bitorder="little")
+    # IDSelectorBitmap 的長度以 byte 計算
+    return faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap)), bitmap
+
+
+def l2_to_cosine(distances):
+    """index 回傳 L2 距離的平方；embedding 已正規化時 cosine 相似度 = 1 - d / 2"""
+    return 1.0 - np.asarray(distances, dtype="float32") / 2
+
+
+def supports_selector(index) -> bool:
+    """index 搜尋時是否能以 SearchParameters 的 ID selector 過濾（IndexPQ 等不支援）"""
+    return not isinstance(_base_index(index), NO_SELECTOR_TYPES)
+
+
+def search_index(index, queries, k, ids=None):
+    """
+    搜尋 index，ids 為允許的 chunk id（已排序）時只在這些 chunk 內搜尋：
+    - 允許的 chunk 不多（FILTER_EXACT_MAX_IDS 以內）或 index 不支援 ID selector 時，
+      取回這些 chunk 的向量直接精確搜尋
+    - 其餘在 FAISS 搜尋過程中以 ID selector 過濾，IVF / HNSW 只會在探訪到的分群 / 節點內過濾，
+      因此 nprobe / efSearch 依允許的比例放大；結果仍不足時改以精確搜尋補齊
+    """
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    if ids is None:
+        return index.search(queries, k)
+    ids = np.asarray(ids, dtype="int64")
+    if len(ids) == 0:
+        return (
+            np.full((len(queries), k), np.inf, dtype="float32"),
+            np.full((len(queries), k), -1, dtype="int64"),
+        )
+    if len(ids) <= FILTER_EXACT_MAX_IDS or not supports_selector(index):
+        return _search_subset(index, queries, k, ids)
+
+    distances, labels = _search_with_selector(index, queries, k, ids)
+    # IVF 允許的 chunk 集中在沒有探訪到的分群時仍可能不足 k 筆
+    short = np.flatnonzero((labels >= 0).sum(axis=1) < min(k, len(ids)))
+    if len(short):
+        print(
+            f"[DEBUG] 限定文件搜尋結果不足，{len(short)} 個查詢改以精確搜尋", flush=True
+        )
+        distances[short], labels[short] = _search_subset(index, queries[short], k, ids)
+    return distances, labels
+
+
+def _search_subset(index, queries, k, ids):
+    """取回允許的 chunk 向量做精確搜尋（PQ / SQ 取回的是量化後的向量，距離與 index 內相同）"""
+    vectors = reconstruct_vectors(index, ids)
+    distances, positions = faiss.knn(queries, vectors, min(k, len(ids)))
+    labels = np.where(positions >= 0, ids[np.maximum(positions, 0)], -1)
+    distances = np.where(positions >= 0, distances, np.inf).astype("float32")
+    if k > len(ids):
+        pad = k - len(ids)
+        labels = np.pad(labels, ((0, 0), (0, pad)), constant_values=-1)
+        distances = np.pad(distances, ((0, 0), (0, pad)), constant_values=np.inf)
+    return distances, labels
+
+
+def _search_with_selector(index, queries, k, ids):
+    selector, bitmap = _id_selector(ids)
+    # 查詢參數會覆寫 index 上的設定，以 apply_search_params 設定的 nprobe / efSearch
+    # 依允許的比例放大，讓搜尋範圍內仍有足夠的允許 chunk
+    scale = max(index.ntotal, 1) / len(ids)
+    index_ivf = _extract_ivf(index)
+    index_hnsw = _extract_hnsw(index)
+    if index_ivf is not None:
+        params = faiss.SearchParametersIVF()
+        params.nprobe = min(math.ceil(index_ivf.nprobe * scale), index_ivf.nlist)
+    elif index_hnsw is not None:
+        params = faiss.SearchParametersHNSW()
+        ef_search = max(index_hnsw.hnsw.efSearch, k)
+        params.efSearch = min(math.ceil(ef_search * scale), max(index.ntotal, k))
+    else:
+        params = faiss.SearchParameters()
+
+    translated = None
+    index_refine = _unwrap(index)
+    if isinstance(index_refine, faiss.IndexRefine):
+        # IndexIDMap2 只會轉換最外層參數的 selector，IndexRefine 內部的 base index
+        # 看到的是向量位置而非 chunk id，需自行以 id_map 轉換
+        if has_id_map(index):
+            translated = faiss.IDSelectorTranslated(
+                faiss.downcast_index(index).id_map, selector
+            )
+        params.sel = translated or selector
+        refine_params = faiss.IndexRefineSearchParameters()
+        refine_params.k_factor = index_refine.k_factor
+        refine_params.base_index_params = params
+        params = refine_params
+    else:
+        params.sel = selector
+    distances, labels = index.search(queries, k, params=params)
+    # selector 與 bitmap 需存活到搜尋結束
+    del selector, bitmap, translated
+    return distances, labels
+
+
+def describe_index(index) -> dict:
+    """回傳索引類型與主要參數，供 API 顯示"""
+    if index is None:
+        return {}
+    info = {
+        "class": type(_unwrap(index)).__name__,
+        "base": type(_base_index(index)).__name__,
+        "id_map": has_id_map(index),
+        "ntotal": index.ntotal,
+        "dimension": index.d,
+    }
+    index_ivf = _extract_ivf(index)
+    if index_ivf is not None:
+        info.update({"nlist": index_ivf.nlist, "nprobe": index_ivf.nprobe})
+    index_hnsw = _extract_hnsw(index)
+    if index_hnsw is not None:
+        info.update({"efSearch": index_hnsw.hnsw.efSearch})
+    return info
+
+
+def index_memory_bytes(index) -> int:
+    """以序列化後的大小估計 index 佔用的記憶體"""
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def storage_report(vectors, config, k=10, query_count=100):
+    """
+    以樣本向量比較各種儲存格式：每筆向量佔用的記憶體、recall@k 與查詢時間
+    樣本的一部分當作查詢，與 IndexFlatL2 精確搜尋的結果比對計算 recall
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    query_count = min(query_count, max(1, len(vectors) // 10))
+    queries, base = vectors[:query_count], vectors[query_count:]
+    k = min(k, len(base))
+    exact = faiss.IndexFlatL2(base.shape[1])
+    exact.add(base)
+    _, truth = exact.search(queries, k)
+
+    report = []
+    for storage in STORAGE_TYPES:
+        for refine in ("none", "fp16", "flat"):
+            if storage == "float32" and refine != "none":
+                continue
+            trial_config = dict(config, index_storage=storage, index_refine=refine)
+            index = create_index(base.shape[1], trial_config, base)
+            index.add_with_ids(base, np.arange(len(base), dtype="int64"))
+            start = time.perf_counter()
+            _, found = index.search(queries, k)
+            elapsed = time.perf_counter() - start
+            hits = sum(
+                len(set(found[q]) & set(truth[q])) for q in range(len(queries))
+            )
+            size = index_memory_bytes(index)
+            report.append(
+                {
+                    "index": describe_index(index),
+                    "storage": storage,
+                    "refine": refine,
+                    "bytes_per_vector": round(size / len(base), 1),
+                    f"recall@{k}": round(hits / (k * len(queries)), 4),
+                    "search_ms_per_query": round(elapsed * 1000 / len(queries), 3),
+                }
+            )
+    return report
@@ -55,14 +55,78 @@ CREATE TABLE IF NOT EXISTS llm_requests (
     INDEX idx_created_at (created_at)
 );
 
+-- 建立索引工作表
+CREATE TABLE IF NOT EXISTS index_jobs (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    job_type ENUM('files', 'rebuild', 'remove', 'compact') NOT NULL,
+    filenames MEDIUMTEXT,
+    status ENUM('queued', 'running', 'completed', 'failed', 'cancelled') DEFAULT 'queued',
+    cancel_requested BOOLEAN DEFAULT FALSE,
+    progress MEDIUMTEXT,
+    result MEDIUMTEXT,
+    error_message TEXT,
+    worker VARCHAR(100),
+    created_by INT(11),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP NULL,
+    finished_at TIMESTAMP NULL,
+    heartbeat_at TIMESTAMP NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_status (status),
+    INDEX idx_created_at (created_at)
+);
+
 -- 插入預設配置
 INSERT INTO configs (`key`, value) VALUES
 ('docling_image_export_mode', 'placeholder'),
+('docling_workers', '2'),
+('docling_shard_pages', '100'),
+('docling_images_scale', '2'),
+('docling_do_ocr', 'True'),
+('docling_ocr_auto', 'True'),
+('docling_text_layer_min_chars', '32'),
+('docling_do_table_structure', 'True'),
 ('embedding_model', 'intfloat/multilingual-e5-large'),
 ('chunk_size', '512'),
 ('chunk_overlap', '64'),
 ('idx_result_count', '20'),
 ('rerank_top_k_final', '16'),
+('reranker_backend', 'torch'),
+('rerank_max_batch_size', '64'),
+('rerank_max_wait_ms', '5'),
+('rerank_score_cache_max_entries', '50000'),
+('rerank_cascade', 'True'),
+('rerank_min_similarity', '0'),
+('rerank_margin', '0.15'),
+('rerank_max_candidates', '20'),
+('hybrid_search', 'True'),
+('bm25_top_k', '20'),
+('rrf_k', '60'),
+('answer_cache_enabled', 'True'),
+('answer_cache_max_entries', '1000'),
+('answer_cache_ttl_seconds', '86400'),
+('answer_cache_semantic_threshold', '0.95'),
+('index_type', 'flat'),
+('ivf_nlist', '0'),
+('ivf_nprobe', '16'),
+('hnsw_m', '32'),
+('hnsw_ef_construction', '200'),
+('hnsw_ef_search', '64'),
+('pq_m', '64'),
+('index_train_sample_size', '100000'),
+('index_storage', 'float32'),
+('index_refine', 'none'),
+('index_refine_k_factor', '4'),
+('index_mmap', 'False'),
+('index_compact_ratio', '0.3'),
+('snapshot_keep', '3'),
+('index_job_stale_seconds', '60'),
+('embedding_cache_max_entries', '500000'),
+('query_embedding_cache_max_entries', '10000'),
+('ingest_batch_size', '256'),
+('index_publish_every', '20'),
+('embedding_batch_size', '32'),
+('embedding_num_threads', '0'),
 ('llm_model', 'gemma3:12b'),
 ('is_enable_think', 'False'),
 ('llm_req_limit_total', '3'),
@@ -0,0 +1,49 @@
+"""多個 process 同時儲存轉換快取 manifest 時，彼此的項目不會遺失"""
+
+import multiprocessing
+
+from app.conversion_cache import ConversionManifest
+
+OPTIONS_KEY = (("do_ocr", True),)
+N_PROCESSES = 4
+N_ENTRIES = 30
+
+
+def record_entries(markdown_dir, worker_no):
+    manifest = ConversionManifest(markdown_dir)
+    for i in range(N_ENTRIES):
+        manifest.record(f"{worker_no}-{i}", OPTIONS_KEY, f"{worker_no}-{i}.md", "x")
+        if i % 5 == 0:
+            manifest.save()
+    manifest.save()
+
+
+def test_concurrent_saves_keep_all_entries(tmp_path):
+    markdown_dir = str(tmp_path)
+    first = ConversionManifest(markdown_dir)
+    first.record("existing", OPTIONS_KEY, "existing.md", "y")
+    first.save()
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(N_PROCESSES) as pool:
+        pool.starmap(record_entries, [(markdown_dir, n) for n in range(N_PROCESSES)])
+
+    entries = ConversionManifest(markdown_dir)._data["entries"]
+    assert len(entries) == N_PROCESSES * N_ENTRIES + 1
+
+
+def test_save_merges_entries_saved_by_others(tmp_path):
+    markdown_dir = str(tmp_path)
+    a = ConversionManifest(markdown_dir)
+    b = ConversionManifest(markdown_dir)
+    a.record("a", OPTIONS_KEY, "a.md", "a")
+    b.record("b", OPTIONS_KEY, "b.md", "b")
+
+    a.save()
+    b.save()
+
+    # b 儲存時讀入 a 的項目，a 下次儲存時也會取得 b 的項目
+    assert len(b._data["entries"]) == 2
+    a.save()
+    assert len(a._data["entries"]) == 2
+    assert len(ConversionManifest(markdown_dir)._data["entries"]) == 2
@@ -0,0 +1,127 @@
+"""限定文件搜尋 (search_index 的 ids) 在各種索引類型與儲存格式下的行為"""
+
+import numpy as np
+import pytest
+
+from app import vector_index
+from app.vector_index import (
+    INDEX_TYPES,
+    STORAGE_TYPES,
+    create_index,
+    reconstruct_vectors,
+    search_index,
+)
+
+DIMENSION = 32
+N_VECTORS = 3000
+K = 5
+# 分散在不同位置的少量 chunk，IVF / HNSW 只在探訪範圍內過濾時容易找不到
+SCATTERED_IDS = np.array([1, 2, 3, 1000, 2000], dtype="int64")
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    rng = np.random.default_rng(42)
+    x = rng.standard_normal((N_VECTORS, DIMENSION)).astype("float32")
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+_indexes = {}
+
+
+def build_index(vectors, index_type, storage, refine="none"):
+    key = (index_type, storage, refine)
+    if key not in _indexes:
+        config = {
+            "index_type": index_type,
+            "index_storage": storage,
+            "index_refine": refine,
+            "pq_m": 8,
+            "ivf_nprobe": 4,
+            "hnsw_ef_search": 16,
+        }
+        index = create_index(DIMENSION, config, vectors)
+        index.add_with_ids(vectors, np.arange(N_VECTORS, dtype="int64"))
+        _indexes[key] = index
+    return _indexes[key]
+
+
+def exact_subset_labels(index, queries, k, ids):
+    """以 index 內（可能已量化）的向量對允許的 chunk 暴力搜尋，作為正確答案"""
+    subset = reconstruct_vectors(index, ids)
+    distances = ((queries[:, None, :] - subset[None, :, :]) ** 2).sum(axis=2)
+    return ids[np.argsort(distances, axis=1)[:, :k]]
+
+
+COMBINATIONS = [
+    (index_type, storage, refine)
+    for index_type in INDEX_TYPES
+    for storage in STORAGE_TYPES
+    for refine in ("none", "flat")
+]
+
+
+@pytest.mark.parametrize("index_type,storage,refine", COMBINATIONS)
+@pytest.mark.parametrize("max_exact_ids", [vector_index.FILTER_EXACT_MAX_IDS, 0])
+def test_filtered_search_all_index_types(
+    vectors, monkeypatch, index_type, storage, refine, max_exact_ids
+):
+    # max_exact_ids=0 時強制走 ID selector 的路徑
+    monkeypatch.setattr(vector_index, "FILTER_EXACT_MAX_IDS", max_exact_ids)
+    index = build_index(vectors, index_type, storage, refine)
+    queries = vectors[[0, 500, 2500]]
+    allowed = np.arange(200, 1400, 3, dtype="int64")
+
+    distances, labels = search_index(index, queries, K, allowed)
+
+    assert labels.shape == (len(queries), K)
+    assert np.isin(labels, allowed).all()
+    assert np.isfinite(distances).all()
+
+
+@pytest.mark.parametrize("index_type", INDEX_TYPES)
+@pytest.mark.parametrize("max_exact_ids", [vector_index.FILTER_EXACT_MAX_IDS, 0])
+def test_selective_filter_returns_all_allowed(
+    vectors, monkeypatch, index_type, max_exact_ids
+):
+    monkeypatch.setattr(vector_index, "FILTER_EXACT_MAX_IDS", max_exact_ids)
+    index = build_index(vectors, index_type, "float32")
+    queries = vectors[[10, 1500]]
+
+    distances, labels = search_index(index, queries, K, SCATTERED_IDS)
+
+    # 允許的 chunk 只有 5 個，每個查詢都應該全部找到
+    for row in labels:
+        assert sorted(row.tolist()) == SCATTERED_IDS.tolist()
+    assert np.all(np.diff(distances, axis=1) >= 0)
+
+
+def test_filtered_search_matches_exact_subset(vectors):
+    index = build_index(vectors, "flat", "float32")
+    queries = vectors[[7, 70, 700]]
+    allowed = np.arange(0, N_VECTORS, 7, dtype="int64")
+
+    _, labels = search_index(index, queries, K, allowed)
+
+    np.testing.assert_array_equal(
+        labels, exact_subset_labels(index, queries, K, allowed)
+    )
+
+
+def test_filter_smaller_than_k_pads_results(vectors):
+    index = build_index(vectors, "ivf_flat", "float32")
+
+    distances, labels = search_index(index, vectors[:1], K, SCATTERED_IDS[:2])
+
+    assert sorted(labels[0, :2].tolist()) == SCATTERED_IDS[:2].tolist()
+    assert (labels[0, 2:] == -1).all()
+    assert np.isinf(distances[0, 2:]).all()
+
+
+def test_empty_filter_returns_no_results(vectors):
+    index = build_index(vectors, "flat", "float32")
+
+    distances, labels = search_index(index, vectors[:2], K, np.empty(0, "int64"))
+
+    assert (labels == -1).all()
+    assert np.isinf(distances).all()